@@ -38,9 +38,9 @@ else
 fi
 
 # We should be good at this point, run the actual script
-pushd ${SCRIPT_DIR} "$@" > /dev/null
+pushd ${SCRIPT_DIR} > /dev/null
 
 export PYTHONPATH=${PROG_DIR}:${PROTO_DIR}
-python3 "${PROG_DIR}/${APP}" -c "${SCRIPT_DIR}/${CONFIG_FILE}"
+python3 "${PROG_DIR}/${APP}" -c "${SCRIPT_DIR}/${CONFIG_FILE}" "$@"
 
-popd "$@" > /dev/null
+popd > /dev/null
@@ -0,0 +1,190 @@
+import hashlib
+import os.path
+import struct
+from collections.abc import Mapping
+
+from controller_client import ControllerClient
+from file_utils import write_file_atomically
+from snapper_metrics import span
+from startup_profile import lazy_import
+
+message_factory = lazy_import("google.protobuf.message_factory")
+GrowDatabase = lazy_import("pyproto.protomodel.database.grow_database", "GrowDatabase")
+SensorData = lazy_import("pyproto.protomodel.sensors.sensors", "SensorData")
+
+
+# Read only view of the cached sensor data. Sensors are only decoded from protobuf when they are looked up
+class LazySensorData(Mapping):
+    def __init__(self, serialized_sensors, sensor_data_class):
+        self._serialized_sensors = serialized_sensors
+        self._sensor_data_class = sensor_data_class
+        self._decoded_sensors = {}
+
+    def __getitem__(self, sensor_id):
+        sensor = self._decoded_sensors.get(sensor_id, None)
+        if sensor is None:
+            sensor_data_proto = self._sensor_data_class.FromString(self._serialized_sensors[sensor_id])
+            sensor = SensorData.from_protobuf(sensor_data_proto)
+            self._decoded_sensors[sensor_id] = sensor
+
+        return sensor
+
+    def __iter__(self):
+        return iter(self._serialized_sensors)
+
+    def __len__(self):
+        return len(self._serialized_sensors)
+
+
+# timestamp is when the data was last fetched from the controller
+class CachedAnnotationData(object):
+    def __init__(self, serialized_grow_database, serialized_sensors, content_hash, timestamp):
+        self.content_hash = content_hash
+        self.timestamp = timestamp
+        self.sensor_data = LazySensorData(serialized_sensors, AnnotationCache.sensor_data_class())
+
+        self._serialized_grow_database = serialized_grow_database
+        self._grow_database = None
+
+    @property
+    def grow_database(self):
+        # Only decoded if we actually end up needing it (i.e. the controller couldn't give us fresh data)
+        if self._grow_database is None and self._serialized_grow_database is not None:
+            grow_database_proto = AnnotationCache.grow_database_class().FromString(self._serialized_grow_database)
+            self._grow_database = GrowDatabase.from_protobuf(grow_database_proto)
+
+        return self._grow_database
+
+
+# Stores the latest controller data as serialized protobuf messages. File layout:
+#   header: magic, format version, SHA-256 of everything after the header
+#   records: type, key length, data length, key, data (one grow database record, one record per sensor)
+class AnnotationCache(object):
+    CACHE_FILE = "snapper_cache.bin"
+    MAGIC = b"ABSC"
+    VERSION = 1
+    HEADER = struct.Struct("<4sH32s")
+    RECORD_HEADER = struct.Struct("<BHI")
+    GROW_DATABASE_RECORD = 1
+    SENSOR_DATA_RECORD = 2
+
+    def __init__(self, cache_path):
+        self.cache_file = os.path.join(cache_path, AnnotationCache.CACHE_FILE)
+        self._last_content_hash = None
+
+    @staticmethod
+    def grow_database_class():
+        field = ControllerClient.response_class("GetGrowDatabase").DESCRIPTOR.fields_by_name["newGrowDatabase"]
+        return message_factory.GetMessageClass(field.message_type)
+
+    @staticmethod
+    def sensor_data_class():
+        field = ControllerClient.response_class("GetSensorSnapshot").DESCRIPTOR.fields_by_name["sensorData"]
+        return message_factory.GetMessageClass(field.message_type)
+
+    def read(self):
+        try:
+            with span("cache.read") as span_fields, open(self.cache_file, "rb") as f:
+                contents = f.read()
+                timestamp = os.fstat(f.fileno()).st_mtime
+                span_fields["bytes"] = len(contents)
+        except FileNotFoundError:
+            return None
+
+        if len(contents) < AnnotationCache.HEADER.size:
+            return None
+
+        magic, version, content_hash = AnnotationCache.HEADER.unpack_from(contents)
+        payload = memoryview(contents)[AnnotationCache.HEADER.size:]
+        if (
+            (magic != AnnotationCache.MAGIC) or
+            (version != AnnotationCache.VERSION) or
+            (hashlib.sha256(payload).digest() != content_hash)
+        ):
+            print("Ignoring invalid annotation cache {}".format(self.cache_file))
+            return None
+
+        serialized_grow_database = None
+        serialized_sensors = {}
+        offset = 0
+        while offset < len(payload):
+            record_type, key_length, data_length = AnnotationCache.RECORD_HEADER.unpack_from(payload, offset)
+            offset += AnnotationCache.RECORD_HEADER.size
+            key = bytes(payload[offset:(offset + key_length)]).decode("utf-8")
+            offset += key_length
+            data = bytes(payload[offset:(offset + data_length)])
+            offset += data_length
+
+            if record_type == AnnotationCache.GROW_DATABASE_RECORD:
+                serialized_grow_database = data
+            elif record_type == AnnotationCache.SENSOR_DATA_RECORD:
+                serialized_sensors[key] = data
+
+        self._last_content_hash = content_hash
+
+        return CachedAnnotationData(
+            serialized_grow_database=serialized_grow_database,
+            serialized_sensors=serialized_sensors,
+            content_hash=content_hash,
+            timestamp=timestamp
+        )
+
+    @staticmethod
+    def _pack_record(record_type, key, data):
+        key_bytes = key.encode("utf-8")
+        return AnnotationCache.RECORD_HEADER.pack(record_type, len(key_bytes), len(data)) + key_bytes + data
+
+    def write(self, grow_database_proto, sensor_data_protos):
+        # Returns True if the cache file was (re)written, False if it already held exactly this data
+        records = [
+            AnnotationCache._pack_record(
+                AnnotationCache.GROW_DATABASE_RECORD,
+                "",
+                grow_database_proto.SerializeToString(deterministic=True)
+            )
+        ]
+        for sensor_id in sorted(sensor_data_protos.keys()):
+            records.append(
+                AnnotationCache._pack_record(
+                    AnnotationCache.SENSOR_DATA_RECORD,
+                    sensor_id,
+                    sensor_data_protos[sensor_id].SerializeToString(deterministic=True)
+                )
+            )
+        payload = b"".join(records)
+        content_hash = hashlib.sha256(payload).digest()
+
+        if self._last_content_hash is None:
+            self._last_content_hash = self._read_content_hash()
+
+        # Nothing changed, save the SD card a write. We still bump the modification time though, as that is what
+        # records when the data was last confirmed by the controller
+        if content_hash == self._last_content_hash:
+            try:
+                os.utime(self.cache_file)
+                return False
+            except FileNotFoundError:
+                pass
+
+        contents = AnnotationCache.HEADER.pack(AnnotationCache.MAGIC, AnnotationCache.VERSION, content_hash) + payload
+        with span("cache.write", bytes=len(contents)):
+            write_file_atomically(self.cache_file, contents)
+        self._last_content_hash = content_hash
+
+        return True
+
+    def _read_content_hash(self):
+        try:
+            with open(self.cache_file, "rb") as f:
+                header = f.read(AnnotationCache.HEADER.size)
+        except FileNotFoundError:
+            return None
+
+        if len(header) < AnnotationCache.HEADER.size:
+            return None
+
+        magic, version, content_hash = AnnotationCache.HEADER.unpack(header)
+        if (magic != AnnotationCache.MAGIC) or (version != AnnotationCache.VERSION):
+            return None
+
+        return content_hash
@@ -1,35 +1,69 @@
-import hashlib
-import json
-import os.path
 from collections import namedtuple
 import datetime
-from typing import Dict
+import threading
+import time
 
-import grpc
-from google.protobuf import empty_pb2
-
-from pyproto.messages.controller_pb2_grpc import NetworkControllerStub
-from pyproto.messages.sensors_pb2 import SensorModuleStatus
-from pyproto.protomodel.database.grow_database import GrowDatabase
-from pyproto.protomodel.sensors.sensors import SensorData
-from pyproto.server.grpc_client_interceptor import PiFeederClientInterceptor
-from pyproto.server.grpc_server_auth_interceptor import GrpcServerAuthInterceptor
+from annotation_cache import AnnotationCache
+from circuit_breaker import CircuitBreaker
+from controller_client import ControllerClient
 from image_annotator import AnnotationDetails
+from snapper_metrics import span
+from startup_profile import lazy_import
+
+grpc = lazy_import("grpc")
 
 ReadingAnnotationDetails = namedtuple("ReadingAnnotationDetails", "sensor_id reading_id display_name")
 
+# Grow database and sensor data to annotate with, when it was fetched from the controller and whether it was fetched
+# for this snap (live) or came from earlier (stale)
+AnnotationData = namedtuple("AnnotationData", "grow_database sensor_data timestamp is_live")
 
-class AnnotationGrabber(object):
-    EMPTY = empty_pb2.Empty()
-    CACHE_FILE = 'snapper_cache.json'
-    GROW_DATABASE_CACHE_KEY = "grow_database"
-    SENSOR_DATA_CACHE_KEY = "sensor_data"
 
-    def __init__(self, cache_path, host, port, passphrase=None):
+# cache_ttl, failure_threshold and failure_backoff come from the config, which has their defaults
+class AnnotationGrabber(object):
+    def __init__(
+        self,
+        cache_path,
+        host,
+        port,
+        cache_ttl,
+        failure_threshold,
+        failure_backoff,
+        passphrase=None,
+        rpc_deadline=ControllerClient.DEFAULT_RPC_DEADLINE
+    ):
         self.cache_path = cache_path
         self.host = host
         self.port = port
         self.passphrase = passphrase
+        self.cache_ttl = cache_ttl
+        self.cache = AnnotationCache(cache_path)
+        self.circuit_breaker = CircuitBreaker(
+            state_path=cache_path,
+            failure_threshold=failure_threshold,
+            backoff_seconds=failure_backoff
+        )
+
+        # One client (and so one channel to the controller) for the lifetime of the grabber
+        self.controller_client = ControllerClient(
+            host=host,
+            port=port,
+            passphrase=passphrase,
+            rpc_deadline=rpc_deadline
+        )
+
+        # Most recent data we have, so a long running process doesn't have to go back to the cache file
+        self._data_lock = threading.Lock()
+        self._latest_data = None
+        self._refresh_thread = None
+
+    def close(self):
+        # Give any background refresh the chance to finish (and update the cache) before we go
+        refresh_thread = self._refresh_thread
+        if refresh_thread is not None:
+            refresh_thread.join(self.controller_client.rpc_deadline)
+
+        self.controller_client.close()
 
     @staticmethod
     def _add_reading_annotations(sensor_annotation_descriptions, sensor_data, annotation_details):
@@ -43,67 +77,139 @@ class AnnotationGrabber(object):
             return
 
         for annotation_description in sensor_annotation_descriptions:
-            sensor = sensor_data.get(annotation_description.sensor_id, None)
-            if not sensor:
-                continue
-
-            reading = next((x for x in sensor.sensor_readings if x.name == annotation_description.reading_id), None)
+            reading = AnnotationGrabber.find_reading(sensor_data, annotation_description)
             if not reading:
                 continue
 
-            label = annotation_description.display_name if annotation_description.display_name else reading.name
             annotation_details.add_sensor_value(
                 sensor_value=reading.value,
-                sensor_label=label
+                sensor_label=AnnotationGrabber.reading_label(annotation_description, reading)
+            )
+
+    @staticmethod
+    def find_reading(sensor_data, annotation_description):
+        # The reading described by a ReadingAnnotationDetails, or None if the sensor or reading isn't in the data
+        if sensor_data is None:
+            return None
+
+        sensor = sensor_data.get(annotation_description.sensor_id, None)
+        if not sensor:
+            return None
+
+        return next((x for x in sensor.sensor_readings if x.name == annotation_description.reading_id), None)
+
+    @staticmethod
+    def reading_label(annotation_description, reading):
+        return annotation_description.display_name if annotation_description.display_name else reading.name
+
+    def _fetch_from_controller(self):
+        # Get the latest data from the controller, updating the cache and the circuit breaker. Returns None on failure
+        try:
+            controller_data = self.controller_client.get_controller_data()
+        except grpc.RpcError as e:
+            print("Could not get data from controller: {}".format(e.code()))
+            self.circuit_breaker.record_failure()
+            return None
+        except Exception as e:
+            # A reply that couldn't be decoded or converted is a failed fetch too. Letting it escape would skip the
+            # circuit breaker, and end a background refresh without a word
+            print("Could not get data from controller: {!r}".format(e))
+            self.circuit_breaker.record_failure()
+            return None
+
+        self.circuit_breaker.record_success()
+        if controller_data.grow_database is None:
+            return None
+
+        annotation_data = AnnotationData(
+            grow_database=controller_data.grow_database,
+            sensor_data=controller_data.sensor_data if controller_data.sensor_data is not None else {},
+            timestamp=time.time(),
+            is_live=True
+        )
+        with self._data_lock:
+            self._latest_data = annotation_data
+
+        # The controller did its part, a full or read only disk only costs us the cache
+        try:
+            self.cache.write(
+                grow_database_proto=controller_data.grow_database_proto,
+                sensor_data_protos=(
+                    controller_data.sensor_data_protos if controller_data.sensor_data_protos is not None else {}
+                )
             )
+        except OSError as e:
+            print("Could not write the annotation cache: {}".format(e))
+
+        return annotation_data
+
+    def _get_previous_data(self):
+        with self._data_lock:
+            if self._latest_data is not None:
+                return self._latest_data._replace(is_live=False)
+
+        cached_data = self.cache.read()
+        if cached_data is None:
+            return None
+
+        return AnnotationData(
+            grow_database=cached_data.grow_database,
+            sensor_data=cached_data.sensor_data,
+            timestamp=cached_data.timestamp,
+            is_live=False
+        )
+
+    def _start_background_refresh(self):
+        with self._data_lock:
+            if (self._refresh_thread is not None) and self._refresh_thread.is_alive():
+                return
+
+            self._refresh_thread = threading.Thread(target=self._fetch_from_controller, name="annotation-refresh")
+            self._refresh_thread.start()
+
+    def _get_annotation_data(self):
+        previous_data = None
+
+        # Serve recent enough data straight away and refresh it in the background for next time
+        if self.cache_ttl > 0:
+            previous_data = self._get_previous_data()
+            if (previous_data is not None) and ((time.time() - previous_data.timestamp) < self.cache_ttl):
+                if self.circuit_breaker.allow_request():
+                    self._start_background_refresh()
+                return previous_data
+
+        if self.circuit_breaker.allow_request():
+            annotation_data = self._fetch_from_controller()
+            if annotation_data is not None:
+                return annotation_data
+
+        # Couldn't get anything from the controller, fall back to whatever we had last time
+        return previous_data if previous_data is not None else self._get_previous_data()
+
+    def get_annotation_data(self):
+        # Everything needed to build annotations for any of the controller's grow systems, from a single fetch
+        with span("annotation_data") as span_fields:
+            annotation_data = self._get_annotation_data()
+            span_fields["live"] = (annotation_data is not None) and annotation_data.is_live
+
+        return annotation_data
 
     def grab_annotations(self, grow_system_id, sensor_annotation_descriptions=None):
+        return AnnotationGrabber.build_annotations(
+            self._get_annotation_data(),
+            grow_system_id,
+            sensor_annotation_descriptions=sensor_annotation_descriptions
+        )
+
+    @staticmethod
+    def build_annotations(annotation_data, grow_system_id, sensor_annotation_descriptions=None):
         annotation_details = None
-        grow_database = None
-        sensor_data = {}
-
-        # Grab stuff from cache
-        cached_data = self._get_cached_data()
-        if cached_data is not None:
-            grow_database = cached_data[0]
-            sensor_data = cached_data[1]
-
-        # Create and hash the auth key if we have one and attach it to a channel interceptor
-        interceptor = None
-        if self.passphrase is not None:
-            m = hashlib.sha256()
-            m.update(self.passphrase.encode())
-            hash_auth_key = m.digest().hex()
-            interceptor = PiFeederClientInterceptor(GrpcServerAuthInterceptor.AUTH_HEADER_KEY, hash_auth_key)
-
-        # Connect to host
-        host_string = "{}:{}".format(self.host, self.port)
-        with grpc.insecure_channel(host_string) as channel:
-            read_channel = grpc.intercept_channel(channel, interceptor) if interceptor is not None else channel
-            stub = NetworkControllerStub(read_channel)
-
-            tmp_grow_database = None
-            tmp_sensor_data = {}
-
-            # Get database
-            grow_database_response = stub.GetGrowDatabase(AnnotationGrabber.EMPTY)
-            if grow_database_response.statusCode == GrowDatabase.OperationResponse.ResponseType.OPERATION_OK:
-                tmp_grow_database = GrowDatabase.from_protobuf(grow_database_response.newGrowDatabase)
-
-            # Get sensor data
-            sensor_snapshot_response = stub.GetSensorSnapshot(AnnotationGrabber.EMPTY)
-            if sensor_snapshot_response.moduleStatus == SensorModuleStatus.CONNECTED:
-
-                for sensor_data_proto in sensor_snapshot_response.sensorData:
-                    sd = (SensorData.from_protobuf(sensor_data_proto))
-                    tmp_sensor_data[sd.sensor_id] = sd
-
-        if (
-            (tmp_grow_database is not None) and
-            (tmp_sensor_data is not None)
-        ):
-            grow_database = tmp_grow_database
-            sensor_data = tmp_sensor_data
+
+        if annotation_data is None:
+            return None
+
+        grow_database = annotation_data.grow_database
+        sensor_data = annotation_data.sensor_data
 
         if grow_database is not None:
             grow_system = grow_database.get_grow_system(grow_system_id=grow_system_id)
@@ -111,7 +217,12 @@ class AnnotationGrabber(object):
                 date_now = datetime.date.today()
                 age = grow_system.inception_date.get_num_days_from_date(date_now)
 
-                annotation_details = AnnotationDetails(grow_system.name, age)
+                annotation_details = AnnotationDetails(
+                    grow_system.name,
+                    age,
+                    is_live=annotation_data.is_live,
+                    data_timestamp=annotation_data.timestamp
+                )
 
                 AnnotationGrabber._add_reading_annotations(
                     sensor_annotation_descriptions=sensor_annotation_descriptions,
@@ -119,33 +230,4 @@ class AnnotationGrabber(object):
                     annotation_details=annotation_details
                 )
 
-        self._write_cached_data(
-            grow_database=grow_database,
-            sensor_data=sensor_data
-        )
-
         return annotation_details
-
-    def _get_cached_data(self):
-        cache_file = os.path.join(self.cache_path, AnnotationGrabber.CACHE_FILE)
-
-        try:
-            with open(cache_file) as json_file:
-                cached_data = json.load(json_file)
-
-                grow_database = GrowDatabase.from_dict(cached_data[AnnotationGrabber.GROW_DATABASE_CACHE_KEY])
-                sensor_data = dict(map(lambda x: (x[0], SensorData.from_dict(x[1])), cached_data[AnnotationGrabber.SENSOR_DATA_CACHE_KEY].items()))
-                return grow_database, sensor_data
-        except FileNotFoundError:
-            return None
-
-    def _write_cached_data(self, grow_database, sensor_data: Dict):
-        cached_data = {
-            AnnotationGrabber.GROW_DATABASE_CACHE_KEY: grow_database.to_dict(),
-            AnnotationGrabber.SENSOR_DATA_CACHE_KEY: dict(map(lambda x: (x[0], x[1].to_dict()), sensor_data.items()))
-        }
-
-        cache_file = os.path.join(self.cache_path, AnnotationGrabber.CACHE_FILE)
-
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cached_data, f, ensure_ascii=False, indent=4)
@@ -1,77 +1,548 @@
 import argparse
+import atexit
 import os
+import signal
+import sqlite3
 import sys
+import time
+from concurrent import futures
 from datetime import datetime
 
+# First, so the startup profile covers the time taken by everything else imported here
+from startup_profile import mark_startup_stage, print_startup_profile
 from snapper_config import SnapperConfigOptions, SnapperConfigParseResponse
 from annotation_grabber import AnnotationGrabber
-from image_annotator import ImageAnnotator
-from image_grabber import ImageGrabber, ImageGrabberFactory
+from burst_capture import BurstImageGrabber
+from capture_scheduler import CaptureScheduler
+from change_detector import ChangeDetector, frame_fingerprint
+from image_annotator import AnnotationDetails
+from image_encoder import add_encoder_comparison_arguments, run_encoder_comparison
+from image_grabber import ImageGrabber, ImageGrabberFactory, SyntheticCameraOptions, SyntheticImageGrabber
+from snapshot_archive import RAW_CAPTURE_DIRECTORY, snapshot_basename, snapshot_filename
+from snapshot_index import IndexedFile, IndexedReading, SnapshotIndex, add_query_arguments, reading_value, run_query
+from snapshot_reannotator import add_reannotate_arguments, run_reannotate, write_annotation_record
+from snapshot_retention import BackgroundRetention, add_retention_arguments, run_retention
+from timelapse_builder import add_timelapse_arguments, run_timelapse
+from snapshot_renderer import frame_for_transfer, render_snapshot, save_frame
+from snapper_metrics import (
+    MetricsExporter, add_spans, bind_recorder, call_with_spans, span, start_recording, stop_recording
+)
+from snapshot_uploader import GrpcUploadTransport, SnapshotUploader, UploadSpool
 
 CONFIG_FILE = "../autobloomer_snapper_cfg.json"
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
 CACHE_PATH = os.path.join(SCRIPT_PATH, 'cache')
 IMAGE_WIDTH = 3840
 IMAGE_HEIGHT = 2160
+UPLOAD_SPOOL_DIRECTORY = "upload_spool"
+CONFIG_SNAPSHOT_FILE = "config_snapshot.pickle"
+
+
+# Holds everything needed to take a snap, so it can be reused between captures in daemon mode
+class Snapper(object):
+    # image_grabbers has one grabber per capture target in the config
+    def __init__(self, config, image_grabbers, cache_path=CACHE_PATH, capture_size=(IMAGE_WIDTH, IMAGE_HEIGHT)):
+        self.config = config
+        self.image_grabbers = image_grabbers
+        self.capture_size = capture_size
+        self.snapshot_index = SnapshotIndex(get_snapshot_index_file(config, cache_path))
+        self.change_detector = None
+        if config.change_detection_options is not None:
+            self.change_detector = ChangeDetector(config.change_detection_options, cache_path)
+        self.annotation_grabber = AnnotationGrabber(
+            host=config.host_name,
+            port=config.port_number,
+            passphrase=config.passphrase,
+            rpc_deadline=config.rpc_deadline,
+            cache_ttl=config.cache_ttl,
+            failure_threshold=config.failure_threshold,
+            failure_backoff=config.failure_backoff,
+            cache_path=cache_path
+        )
+
+        # Captures and the annotation fetch don't depend on each other, so they all run at the same time. Spare workers
+        # make sure a fetch that is still stuck from a previous snap can't stop the next one from starting
+        self.executor = futures.ThreadPoolExecutor(max_workers=(len(config.capture_targets) + 3))
+
+        # Annotating and encoding is CPU bound, so with several targets it is spread over worker processes
+        num_render_workers = config.annotation_workers
+        if num_render_workers is None:
+            num_render_workers = min(len(config.capture_targets), os.cpu_count() or 1)
+        self.render_pool = None
+        if num_render_workers > 1:
+            self.render_pool = futures.ProcessPoolExecutor(max_workers=num_render_workers)
+
+        self.metrics_exporter = None
+        if (config.metrics_json_lines_file is not None) or (config.metrics_prometheus_textfile is not None):
+            self.metrics_exporter = MetricsExporter(
+                json_lines_file=config.metrics_json_lines_file,
+                prometheus_textfile=config.metrics_prometheus_textfile
+            )
+
+        # Finished snapshots are queued up here and sent to the controller in the background, over the same connection
+        # as the annotation data
+        self.uploader = None
+        if config.upload_options is not None:
+            upload_options = config.upload_options
+            self.uploader = SnapshotUploader(
+                spool=UploadSpool(
+                    os.path.join(cache_path, UPLOAD_SPOOL_DIRECTORY),
+                    max_bytes=(upload_options.spool_max_mb * 1024 * 1024)
+                ),
+                transport=GrpcUploadTransport(
+                    self.annotation_grabber.controller_client,
+                    method_name=upload_options.method_name,
+                    chunk_size=(upload_options.chunk_size_kb * 1024),
+                    timeout=upload_options.timeout
+                ),
+                retry_min=upload_options.retry_min,
+                retry_max=upload_options.retry_max
+            )
+
+    def close(self):
+        for image_grabber in self.image_grabbers:
+            image_grabber.close()
+        self.executor.shutdown(wait=False)
+        if self.render_pool is not None:
+            self.render_pool.shutdown()
+        if self.uploader is not None:
+            self.uploader.close(drain_timeout=self.config.upload_options.drain_timeout)
+        self.annotation_grabber.close()
+        self.snapshot_index.close()
+
+    @staticmethod
+    def _wait_for_stage(future, deadline, stage_name):
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except futures.TimeoutError:
+            print("Timed out waiting for {}".format(stage_name))
+        except Exception as e:
+            print("Could not get {}: {}".format(stage_name, e))
+
+        return None
+
+    def snap(self, snap_time=None):
+        if snap_time is None:
+            snap_time = datetime.now()
+
+        if self.metrics_exporter is None:
+            return self._snap(snap_time)
+
+        recorder = start_recording()
+        succeeded = False
+        try:
+            with span("snap", targets=len(self.config.capture_targets)):
+                succeeded = self._snap(snap_time)
+        finally:
+            stop_recording()
+            self.metrics_exporter.export(recorder, snap_time, succeeded)
+
+        return succeeded
+
+    @staticmethod
+    def _capture(image_grabber, target, capture_size, fingerprint_frame=False):
+        # Returns the frame and, if asked for, its fingerprint. Working the fingerprint out here means it happens on
+        # the capture's thread, at the same time for every target
+        with span("capture", target=target.name) as span_fields:
+            frame = image_grabber.capture_image(width=capture_size[0], height=capture_size[1])
+            if (frame is not None) and (frame.encoded_image is not None):
+                span_fields["bytes"] = len(frame.encoded_image)
+
+        fingerprint = None
+        if fingerprint_frame and (frame is not None):
+            with span("fingerprint", target=target.name):
+                fingerprint = frame_fingerprint(frame)
+
+        return frame, fingerprint
+
+    def _snap(self, snap_time):
+        # Get the filename for the annotated images
+        output_filename = snapshot_filename(snap_time)
+        base_filename = snapshot_basename(snap_time)
+
+        # Grab the images and the annotation data at the same time. A single fetch from the controller covers all of
+        # the targets. The images stay in memory until the final (annotated) images are written
+        start_time = time.monotonic()
+        capture_futures = [
+            self.executor.submit(
+                bind_recorder(Snapper._capture),
+                image_grabber,
+                target,
+                self.capture_size,
+                fingerprint_frame=(self.change_detector is not None)
+            )
+            for image_grabber, target in zip(self.image_grabbers, self.config.capture_targets)
+        ]
+        annotation_future = self.executor.submit(bind_recorder(self.annotation_grabber.get_annotation_data))
+
+        captured_targets = []
+        for target, capture_future in zip(self.config.capture_targets, capture_futures):
+            frame, fingerprint = Snapper._wait_for_stage(
+                capture_future,
+                start_time + self.config.capture_timeout,
+                "image capture ({})".format(target.name)
+            ) or (None, None)
+            if frame is None:
+                print("Could not grab image ({})".format(target.name))
+                continue
+
+            # Captures that look the same as the last one stored are skipped (or only kept as a thumbnail) before
+            # they are annotated or encoded
+            unchanged = False
+            if fingerprint is not None:
+                with span("change_detection", target=target.name) as span_fields:
+                    difference = self.change_detector.difference_from_stored(target.name, fingerprint, snap_time)
+                    unchanged = self.change_detector.is_unchanged(difference)
+                    span_fields["difference"] = difference
+                    span_fields["unchanged"] = unchanged
+
+            if self.config.keep_raw_capture and not unchanged:
+                Snapper._save_raw_capture(frame, target, output_filename)
+
+            captured_targets.append((target, frame, fingerprint, unchanged))
+
+        if len(captured_targets) == 0:
+            return False
+
+        # A slow controller only ever costs us the annotation, the captures still get saved
+        annotation_data = Snapper._wait_for_stage(
+            annotation_future,
+            start_time + self.config.annotation_timeout,
+            "annotation data"
+        )
+
+        # A target that fails to render (disk full, a bad frame...) doesn't stop the others from being stored
+        num_render_failures = 0
+        render_futures = []
+        for target, frame, fingerprint, unchanged in captured_targets:
+            annotation_details = AnnotationGrabber.build_annotations(
+                annotation_data,
+                target.grow_system_id,
+                sensor_annotation_descriptions=target.sensor_readings
+            )
+
+            if unchanged and not self._keeps_unchanged_thumbnail():
+                print("No change since the last stored snap ({}), not stored".format(target.name))
+                self._finish_snapshot(
+                    snap_time, target, annotation_data, annotation_details, [], fingerprint, unchanged
+                )
+                continue
+
+            if self.config.keep_raw_capture and not unchanged:
+                # Lets the raw capture be annotated again later (see the reannotate command)
+                Snapper._save_annotation_record(target, output_filename, snap_time, annotation_details)
+
+            render_args = (
+                annotation_details,
+                target.image_destination,
+                base_filename,
+                self.config.output_levels,
+                self.config.rerender_overlay,
+                snap_time,
+                unchanged
+            )
+
+            if self.render_pool is not None:
+                # The worker's spans come back with the result, so they end up in this snap's metrics
+                render_futures.append((
+                    target,
+                    annotation_details,
+                    fingerprint,
+                    unchanged,
+                    self.render_pool.submit(
+                        call_with_spans,
+                        "render",
+                        {"target": target.name},
+                        render_snapshot,
+                        frame_for_transfer(frame),
+                        *render_args
+                    )
+                ))
+            else:
+                try:
+                    with span("render", target=target.name):
+                        output_paths = render_snapshot(frame, *render_args)
+                except Exception as e:
+                    print("Could not store snap ({}): {}".format(target.name, e))
+                    num_render_failures += 1
+                    continue
+                self._finish_snapshot(
+                    snap_time, target, annotation_data, annotation_details, output_paths, fingerprint, unchanged
+                )
+
+        for target, annotation_details, fingerprint, unchanged, render_future in render_futures:
+            try:
+                output_paths, render_spans = render_future.result()
+            except Exception as e:
+                print("Could not store snap ({}): {}".format(target.name, e))
+                num_render_failures += 1
+                continue
+            add_spans(render_spans)
+            self._finish_snapshot(
+                snap_time, target, annotation_data, annotation_details, output_paths, fingerprint, unchanged
+            )
+
+        if self.change_detector is not None:
+            try:
+                self.change_detector.save()
+            except OSError as e:
+                print("Could not save change detection state: {}".format(e))
+
+        return (len(captured_targets) == len(self.config.capture_targets)) and (num_render_failures == 0)
+
+    def _keeps_unchanged_thumbnail(self):
+        # With only one output the "thumbnail" would be the full size image
+        return (
+            (self.config.change_detection_options.unchanged_action == "thumbnail") and
+            (len(self.config.output_levels) > 1)
+        )
+
+    def _finish_snapshot(self, snap_time, target, annotation_data, annotation_details, output_paths, fingerprint,
+                         unchanged):
+        # Unchanged captures only have the thumbnail, if anything, which is indexed but not uploaded
+        stored_levels = self.config.output_levels[-1:] if unchanged else self.config.output_levels
+        self._index_snapshot(snap_time, target, annotation_data, annotation_details, output_paths, stored_levels)
+        if unchanged:
+            return
+
+        self._upload_snapshot(target, output_paths)
+        if fingerprint is not None:
+            self.change_detector.record_stored(target.name, fingerprint, snap_time)
+
+    def _index_snapshot(self, snap_time, target, annotation_data, annotation_details, output_paths, stored_levels):
+        # Every configured reading that was in the data goes in the index, alongside where the images ended up
+        readings = []
+        for annotation_description in target.sensor_readings:
+            reading = AnnotationGrabber.find_reading(
+                annotation_data.sensor_data if annotation_data is not None else None,
+                annotation_description
+            )
+            if reading is None:
+                continue
+
+            readings.append(IndexedReading(
+                sensor_id=annotation_description.sensor_id,
+                reading_id=annotation_description.reading_id,
+                label=AnnotationGrabber.reading_label(annotation_description, reading),
+                value=reading_value(reading.value),
+                value_text=AnnotationDetails.format_sensor_value(reading.value)
+            ))
+
+        try:
+            with span("index"):
+                self.snapshot_index.add(
+                    snap_time=snap_time,
+                    target=target.name,
+                    grow_system_id=target.grow_system_id,
+                    grow_system_name=(annotation_details.grow_system_name if annotation_details is not None else None),
+                    age=(annotation_details.age if annotation_details is not None else None),
+                    is_live=(annotation_data.is_live if annotation_data is not None else None),
+                    data_timestamp=(annotation_data.timestamp if annotation_data is not None else None),
+                    readings=readings,
+                    files=[
+                        IndexedFile(level=level.name, path=os.path.abspath(path), size=os.path.getsize(path))
+                        for level, path in zip(stored_levels, output_paths)
+                    ]
+                )
+        except (sqlite3.Error, OSError) as e:
+            print("Could not add snapshot to the index ({}): {}".format(target.name, e))
+
+    def _upload_snapshot(self, target, output_paths):
+        # Only the main (first) output is uploaded, under the target's name
+        if self.uploader is not None:
+            self.uploader.enqueue(output_paths[0], "{}/{}".format(target.name, os.path.basename(output_paths[0])))
+
+    @staticmethod
+    def _save_raw_capture(frame, target, output_filename):
+        raw_directory = os.path.join(target.image_destination, RAW_CAPTURE_DIRECTORY)
+        if not os.path.exists(raw_directory):
+            os.makedirs(raw_directory)
+
+        save_frame(frame, os.path.join(raw_directory, output_filename))
+
+    @staticmethod
+    def _save_annotation_record(target, output_filename, snap_time, annotation_details):
+        raw_capture_path = os.path.join(target.image_destination, RAW_CAPTURE_DIRECTORY, output_filename)
+        try:
+            write_annotation_record(raw_capture_path, snap_time, annotation_details)
+        except OSError as e:
+            print("Could not save annotation record ({}): {}".format(target.name, e))
+
+
+def run_daemon(snapper, config, retention_command=None):
+    scheduler = CaptureScheduler(
+        schedule=config.capture_schedule,
+        capture_callback=lambda tick: snapper.snap(snap_time=tick),
+        missed_tick_policy=config.missed_tick_policy
+    )
+
+    # Let a service manager stop us cleanly between captures
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+
+    # Old snapshots are tidied up in the background, by the retention command run as a separate low priority process
+    background_retention = None
+    if (config.retention_options is not None) and (retention_command is not None):
+        background_retention = BackgroundRetention(retention_command, config.retention_options.interval_seconds)
+        background_retention.start()
+
+    print("Snapper daemon running")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if background_retention is not None:
+            background_retention.stop()
+    print("Snapper daemon stopped")
+
+
+def get_snapshot_index_file(config, cache_path=CACHE_PATH):
+    if config.snapshot_index_file is not None:
+        return config.snapshot_index_file
+
+    return os.path.join(cache_path, SnapshotIndex.INDEX_FILE)
+
+
+def get_target_destination(config, target_name):
+    # The image destination of the named capture target, or of the first target if no name is given
+    if target_name is None:
+        return config.image_destination
+
+    target = next((x for x in config.capture_targets if x.name == target_name), None)
+    return target.image_destination if target is not None else None
 
 
 # Application entry point
 def main():
+    mark_startup_stage("imports")
+
     # Parse arguments
     parser = argparse.ArgumentParser(description="AutoBloomer Snapper")
     parser.add_argument("-c", "--config-file", default=CONFIG_FILE, dest="snapper_config_file")
     parser.add_argument("-d", "--dummy-camera-file", dest="dummy_camera_file")
+    parser.add_argument("--synthetic-camera", choices=SyntheticImageGrabber.PATTERNS, dest="synthetic_camera",
+                        help="Replace the cameras with generated images (for benchmarking and testing)")
+    parser.add_argument("--daemon", action="store_true", dest="daemon",
+                        help="Keep running and take snaps according to the config schedule_options")
+    parser.add_argument("--config-snapshot", action="store_true", dest="config_snapshot",
+                        help="Reuse the validated config from the cache for as long as the config file is unchanged")
+    parser.add_argument("--profile-startup", action="store_true", dest="profile_startup",
+                        help="Print how long each stage of startup took, and when the heavy modules were imported")
+
+    # Tools that work on the snapshot archive rather than taking a snap
+    subparsers = parser.add_subparsers(dest="command")
+    add_timelapse_arguments(
+        subparsers.add_parser("timelapse", help="Build a timelapse video, image sequence or contact sheets")
+    )
+    add_reannotate_arguments(
+        subparsers.add_parser("reannotate", help="Annotate the kept raw captures again with the current overlay")
+    )
+    add_query_arguments(subparsers.add_parser("query", help="Search the snapshot index"))
+    add_retention_arguments(
+        subparsers.add_parser("retention", help="Apply the config retention_options to the stored snapshots")
+    )
+    add_encoder_comparison_arguments(
+        subparsers.add_parser("compare-encoders", help="Compare the encode time and size of image formats and settings")
+    )
     args = parser.parse_args()
+    if args.profile_startup:
+        atexit.register(print_startup_profile)
+    mark_startup_stage("arguments")
 
     # Read config
-    config_parser = SnapperConfigOptions(None)
-    config_response = config_parser.read_config(args.snapper_config_file)
+    config_parser = SnapperConfigOptions()
+    config_response = config_parser.read_config(
+        args.snapper_config_file,
+        snapshot_file=(os.path.join(CACHE_PATH, CONFIG_SNAPSHOT_FILE) if args.config_snapshot else None)
+    )
     if config_response != SnapperConfigParseResponse.PARSE_OK:
         print("Could not obtain snapper config: {}".format(config_response))
         sys.exit()
+    mark_startup_stage("config (from snapshot)" if config_parser.from_snapshot else "config")
+
+    if args.command == "timelapse":
+        source_directory = get_target_destination(config_parser, args.target) if args.source is None else args.source
+        if source_directory is None:
+            print("Unknown capture target: {}".format(args.target))
+            sys.exit()
+
+        if not run_timelapse(args, source_directory):
+            sys.exit()
+        return
+
+    if args.command == "query":
+        if not run_query(args, get_snapshot_index_file(config_parser)):
+            sys.exit()
+        return
+
+    if args.command == "reannotate":
+        if not run_reannotate(args, config_parser):
+            sys.exit()
+        return
+
+    if args.command == "compare-encoders":
+        if not run_encoder_comparison(args, config_parser):
+            sys.exit()
+        return
+
+    if args.command == "retention":
+        if not run_retention(args, config_parser, get_snapshot_index_file(config_parser)):
+            sys.exit()
+        return
+
+    if args.daemon and config_parser.capture_schedule is None:
+        print("Daemon mode requires schedule_options in the snapper config")
+        sys.exit()
 
     # Create cache directory
     if not os.path.exists(CACHE_PATH):
         os.makedirs(CACHE_PATH)
 
-    # Get the image grabber
-    dummy_file = args.dummy_camera_file
-    image_grabber = ImageGrabberFactory.get_image_grabber(dummy_file=dummy_file)
-
-    # Get the filename for the annotated image
-    now = datetime.now()
-    timestamp_string = now.strftime("%Y-%m-%d__%H-%M")
-    output_filename = "{}.jpg".format(timestamp_string)
-    image_path = os.path.join(config_parser.image_destination, output_filename)
-
-    # Grab the image
-    if not image_grabber.grab_image(
-        width=IMAGE_WIDTH,
-        height=IMAGE_HEIGHT,
-        output_filename=image_path
-    ):
-        print("Could not grab image")
-        sys.exit()
+    # Get the image grabbers, one per capture target. A dummy file or synthetic camera on the command line replaces all
+    # of the cameras
+    synthetic_options = None
+    if args.synthetic_camera is not None:
+        synthetic_options = SyntheticCameraOptions(
+            pattern=args.synthetic_camera,
+            template_file=args.dummy_camera_file,
+            encode_jpeg=True
+        )
 
-    annotation_grabber = AnnotationGrabber(
-        host=config_parser.host_name,
-        port=config_parser.port_number,
-        passphrase=config_parser.passphrase,
-        cache_path=CACHE_PATH
-    )
+    image_grabbers = []
+    for target in config_parser.capture_targets:
+        image_grabber = ImageGrabberFactory.get_image_grabber(
+            dummy_file=(args.dummy_camera_file if args.dummy_camera_file is not None else target.dummy_camera_file),
+            camera_index=target.camera_index,
+            synthetic_options=(synthetic_options if synthetic_options is not None else target.synthetic_camera),
+            session_options=target.camera_session
+        )
+        # Targets with a burst merge several frames into every capture
+        if target.burst is not None:
+            image_grabber = BurstImageGrabber(image_grabber, target.burst)
+        image_grabbers.append(image_grabber)
 
-    annotation_details = annotation_grabber.grab_annotations(
-        config_parser.grow_system_id,
-        sensor_annotation_descriptions=config_parser.sensor_readings
-    )
+    snapper = Snapper(config=config_parser, image_grabbers=image_grabbers)
+    mark_startup_stage("setup")
 
-    if annotation_details is not None:
-        annotated_image = ImageAnnotator.annotate_image(
-            image_file=image_path,
-            annotation_details=annotation_details
-        )
+    try:
+        if args.daemon:
+            retention_command = [
+                sys.executable,
+                os.path.abspath(__file__),
+                "-c", os.path.abspath(args.snapper_config_file)
+            ]
+            if args.config_snapshot:
+                retention_command.append("--config-snapshot")
+            retention_command.append("retention")
 
-        annotated_image.save(image_path)
+            run_daemon(snapper, config_parser, retention_command=retention_command)
+        else:
+            snapped = snapper.snap()
+            mark_startup_stage("snap")
+            if not snapped:
+                sys.exit()
+    finally:
+        snapper.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+import io
+import time
+from collections import namedtuple
+
+from image_grabber import CapturedFrame
+from snapper_metrics import span
+from startup_profile import lazy_import
+
+numpy = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+# Takes several frames for every snap and merges them into one, which averages away most of the sensor noise in low
+# light without the motion blur of a longer exposure. frames is how many are taken (at most 255), interval_seconds the
+# pause between them. method is one of BURST_METHODS:
+#   "mean": the average of every frame
+#   "sigma_clip": the average, leaving out anything more than sigma times the noise level away from it (e.g. a leaf
+#       that moved in some of the frames)
+#   "median": the median of every pixel. Holds every frame until the end, so at most MAX_MEDIAN_FRAMES of them
+# align lines each frame up with the first before it is merged, for cameras that move a little (fans, pumps...).
+# Frames that would have to move further than max_shift pixels are merged as they are
+BurstOptions = namedtuple(
+    "BurstOptions",
+    "frames method sigma align max_shift interval_seconds",
+    defaults=(4, "sigma_clip", 3.0, False, 32, 0)
+)
+
+BURST_METHODS = ("mean", "sigma_clip", "median")
+
+MAX_BURST_FRAMES = 255
+MAX_MEDIAN_FRAMES = 9
+
+# The frames are merged a band of rows at a time, so the temporary arrays stay small however big the frames are
+BAND_ROWS = 128
+
+
+def _bands(height):
+    for top in range(0, height, BAND_ROWS):
+        yield slice(top, min(top + BAND_ROWS, height))
+
+
+# Every 4th row and column, plenty for measuring the noise level and far quicker than the whole frame
+NOISE_SAMPLE = (slice(None, None, 4), slice(None, None, 4))
+
+
+def _noise_level(frame, average):
+    # Robust estimate of the noise standard deviation, from the median absolute difference. Never below one grey level
+    difference = frame.astype(numpy.int16) - average.astype(numpy.int16)
+    return max(1.0, 1.4826 * float(numpy.median(numpy.abs(difference))))
+
+
+# The merged frame is kept as a running sum, so memory is one uint16 accumulator plus the frame being added
+class MeanStack(object):
+    def __init__(self, options):
+        self.options = options
+        self._sum = None
+        self._count = 0
+
+    def add(self, frame):
+        if self._sum is None:
+            self._sum = frame.astype(numpy.uint16)
+        else:
+            numpy.add(self._sum, frame, out=self._sum)
+        self._count += 1
+
+    def result(self):
+        merged = numpy.empty(self._sum.shape, dtype=numpy.uint8)
+        for rows in _bands(self._sum.shape[0]):
+            merged[rows] = (self._sum[rows] + (self._count // 2)) // self._count
+
+        return merged
+
+
+# Streaming sigma clipping. Each pixel has a running sum and a count of the values that agreed with it. A value within
+# sigma times the noise level of the pixel's current average is added to it, anything else takes one value's worth
+# away instead. That way a pixel whose first value was an outlier isn't stuck with it: once the values that disagree
+# outnumber it, the count drops to zero and the next value starts the pixel again
+class SigmaClipStack(object):
+    def __init__(self, options):
+        self.options = options
+        self._sum = None
+        self._count = None
+        self._last_frame = None
+
+    def add(self, frame):
+        self._last_frame = frame
+        if self._sum is None:
+            self._sum = frame.astype(numpy.uint16)
+            self._count = numpy.ones(frame.shape, dtype=numpy.uint8)
+            return
+
+        # One noise level for the whole frame, measured against the average so far
+        limit = self.options.sigma * _noise_level(frame[NOISE_SAMPLE], self._average(NOISE_SAMPLE))
+
+        for rows in _bands(frame.shape[0]):
+            band_sum = self._sum[rows]
+            band_count = self._count[rows]
+            band_frame = frame[rows]
+
+            average = self._average(rows)
+            empty = band_count == 0
+            accepted = numpy.abs(band_frame.astype(numpy.int16) - average.astype(numpy.int16)) <= limit
+            accepted |= empty
+            rejected = ~accepted
+
+            # Updated in place, a pixel with nothing left starts again from this value
+            numpy.copyto(band_sum, 0, where=empty)
+            numpy.add(band_sum, band_frame, out=band_sum, where=accepted)
+            numpy.subtract(band_sum, average, out=band_sum, where=rejected)
+            numpy.add(band_count, 1, out=band_count, where=accepted)
+            numpy.subtract(band_count, 1, out=band_count, where=rejected)
+
+    def _average(self, index):
+        count = self._count[index]
+        return (self._sum[index] + (count // 2)) // numpy.maximum(count, 1)
+
+    def result(self):
+        merged = numpy.empty(self._sum.shape, dtype=numpy.uint8)
+        for rows in _bands(self._sum.shape[0]):
+            # Only pixels whose last value cancelled the only one they had have nothing left, they take the last value
+            merged[rows] = numpy.where(self._count[rows] > 0, self._average(rows), self._last_frame[rows])
+
+        return merged
+
+
+# The exact median of every pixel. Unlike the other methods this needs every frame, so they are all held until the
+# end: a median burst is limited to MAX_MEDIAN_FRAMES frames (about 225MB of frames at 4K), which the config checks
+class MedianStack(object):
+    def __init__(self, options):
+        self.options = options
+        self._frames = []
+
+    def add(self, frame):
+        self._frames.append(frame)
+
+    def result(self):
+        # Every pixel's values are sorted with an odd-even transposition sort, which for so few frames is far quicker
+        # as whole-band minimums and maximums than numpy's sorting along the frames. With an even number of frames the
+        # two in the middle are averaged
+        num_frames = len(self._frames)
+        if num_frames == 1:
+            return self._frames[0]
+
+        middle = num_frames // 2
+        merged = numpy.empty(self._frames[0].shape, dtype=numpy.uint8)
+        for rows in _bands(merged.shape[0]):
+            values = [x[rows] for x in self._frames]
+            for sort_pass in range(num_frames):
+                for index in range((sort_pass % 2), (num_frames - 1), 2):
+                    values[index], values[index + 1] = (
+                        numpy.minimum(values[index], values[index + 1]),
+                        numpy.maximum(values[index], values[index + 1])
+                    )
+
+            if num_frames % 2 == 1:
+                merged[rows] = values[middle]
+            else:
+                merged[rows] = (values[middle - 1].astype(numpy.uint16) + values[middle] + 1) // 2
+
+        return merged
+
+
+STACK_CLASSES = {
+    "mean": MeanStack,
+    "sigma_clip": SigmaClipStack,
+    "median": MedianStack
+}
+
+
+# Finds how far each frame has moved from the first one by phase correlation of small greyscale copies. Only the
+# first frame's spectrum is kept, not the frame
+class FrameAligner(object):
+    ALIGNMENT_WIDTH = 512
+
+    def __init__(self, max_shift):
+        self.max_shift = max_shift
+        self._reference_spectrum = None
+        self._scale = 1
+        self._window = None
+
+    def _spectrum(self, image):
+        small_image = image.convert("L").reduce(self._scale)
+        values = numpy.asarray(small_image, dtype=numpy.float32)
+        if (self._window is None) or (self._window.shape != values.shape):
+            # Tapering the edges stops them from looking like a match at no shift
+            self._window = numpy.outer(numpy.hanning(values.shape[0]), numpy.hanning(values.shape[1])).astype(
+                numpy.float32
+            )
+
+        return numpy.fft.rfft2((values - values.mean()) * self._window)
+
+    def shift(self, image):
+        # How many pixels (x, y) the image has to be moved by to line up with the first frame. None for the first frame
+        # itself, or if it has moved further than max_shift
+        if self._reference_spectrum is None:
+            self._scale = max(1, image.size[0] // FrameAligner.ALIGNMENT_WIDTH)
+            self._reference_spectrum = self._spectrum(image)
+            return None
+
+        spectrum = self._spectrum(image)
+        if spectrum.shape != self._reference_spectrum.shape:
+            return None
+
+        cross_power = self._reference_spectrum * numpy.conj(spectrum)
+        cross_power /= numpy.maximum(numpy.abs(cross_power), 1e-12)
+        correlation = numpy.fft.irfft2(cross_power, s=self._window.shape)
+
+        peak_y, peak_x = numpy.unravel_index(int(numpy.argmax(correlation)), correlation.shape)
+        shift_y = FrameAligner._refine_peak(correlation, peak_y, peak_x, axis=0)
+        shift_x = FrameAligner._refine_peak(correlation, peak_y, peak_x, axis=1)
+
+        shift = (int(round(shift_x * self._scale)), int(round(shift_y * self._scale)))
+        if max(abs(shift[0]), abs(shift[1])) > self.max_shift:
+            return None
+
+        return shift
+
+    @staticmethod
+    def _refine_peak(correlation, peak_y, peak_x, axis):
+        # The peak to a fraction of a (small image) pixel, by fitting a parabola through it and its neighbours. Shifts
+        # past half way round are negative
+        size = correlation.shape[axis]
+        peak = peak_y if axis == 0 else peak_x
+
+        def value(offset):
+            position = (peak + offset) % size
+            return correlation[position, peak_x] if axis == 0 else correlation[peak_y, position]
+
+        before, centre, after = value(-1), value(0), value(1)
+        denominator = before - (2 * centre) + after
+        fraction = 0.5 * (before - after) / denominator if denominator != 0 else 0
+
+        position = peak + fraction
+        return position - size if position > (size / 2) else position
+
+
+def shift_frame(frame, shift):
+    # Moves the frame by (x, y) whole pixels. The strip left uncovered at the edge repeats the nearest pixels
+    shift_x, shift_y = shift
+    if (shift_x == 0) and (shift_y == 0):
+        return frame
+
+    height, width = frame.shape[:2]
+    source = frame[max(0, -shift_y):(height - max(0, shift_y)), max(0, -shift_x):(width - max(0, shift_x))]
+    padding = [(max(0, shift_y), max(0, -shift_y)), (max(0, shift_x), max(0, -shift_x))] + [(0, 0)] * (frame.ndim - 2)
+
+    return numpy.pad(source, padding, mode="edge")
+
+
+def frame_image(frame):
+    # A captured frame as an RGB image, decoding the camera's JPEG if that is all there is
+    image = frame.image
+    if image is None:
+        image = Image.open(io.BytesIO(frame.encoded_image))
+
+    return image.convert("RGB") if image.mode != "RGB" else image
+
+
+# Wraps any image grabber (camera, dummy or synthetic) so that every capture is a merged burst of frames. The merged
+# frame has no encoded image, it is encoded when it is stored like any other
+class BurstImageGrabber(object):
+    def __init__(self, image_grabber, options):
+        self.image_grabber = image_grabber
+        self.options = options
+
+    def capture_image(self, width, height):
+        stack = STACK_CLASSES[self.options.method](self.options)
+        aligner = FrameAligner(self.options.max_shift) if self.options.align else None
+        frame_shape = None
+        num_frames = 0
+
+        for frame_number in range(self.options.frames):
+            if (frame_number > 0) and (self.options.interval_seconds > 0):
+                time.sleep(self.options.interval_seconds)
+
+            frame = self.image_grabber.capture_image(width, height)
+            if frame is None:
+                print("Burst frame {} could not be captured".format(frame_number))
+                continue
+
+            with span("stack", frame=frame_number) as span_fields:
+                image = frame_image(frame)
+                pixels = numpy.asarray(image)
+                if frame_shape is None:
+                    frame_shape = pixels.shape
+                elif pixels.shape != frame_shape:
+                    print("Burst frame {} is a different size, left out".format(frame_number))
+                    continue
+
+                if aligner is not None:
+                    shift = aligner.shift(image)
+                    if shift is not None:
+                        span_fields["shift"] = shift
+                        pixels = shift_frame(pixels, shift)
+
+                stack.add(pixels)
+                num_frames += 1
+
+        if num_frames == 0:
+            return None
+
+        return CapturedFrame(image=Image.fromarray(stack.result(), "RGB"), encoded_image=None)
+
+    def grab_image(self, width, height, output_filename):
+        frame = self.capture_image(width, height)
+        if frame is None:
+            return False
+
+        frame.image.save(output_filename)
+        return True
+
+    def close(self):
+        self.image_grabber.close()
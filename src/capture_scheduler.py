@@ -0,0 +1,187 @@
+import threading
+from datetime import datetime, timedelta
+from enum import Enum
+
+
+class MissedTickPolicy(str, Enum):
+    # Ticks that fell due while a capture was running are dropped, the next capture happens on the next future tick
+    SKIP = "skip"
+    # Ticks that fell due while a capture was running are coalesced into a single capture that runs straight away
+    CATCH_UP = "catch_up"
+
+
+class IntervalSchedule(object):
+    # Snaps are named to the minute, so anything more often would overwrite the previous snap
+    MIN_INTERVAL_SECONDS = 60
+
+    # Ticks are counted from a fixed local time rather than from each midnight, so an interval that doesn't divide a
+    # day (e.g. 420) stays evenly spaced across midnight instead of being cut short there
+    ALIGNMENT_ORIGIN = datetime(2000, 1, 1)
+
+    def __init__(self, interval_seconds):
+        if interval_seconds < IntervalSchedule.MIN_INTERVAL_SECONDS:
+            raise ValueError(
+                "Capture interval must be at least {} seconds".format(IntervalSchedule.MIN_INTERVAL_SECONDS)
+            )
+
+        self.interval_seconds = interval_seconds
+
+    def next_tick(self, after):
+        # Ticks are aligned to the wall clock (e.g. an interval of 300 fires at :00, :05, :10...) so a restart of the
+        # daemon doesn't shift the capture times around
+        elapsed = (after - IntervalSchedule.ALIGNMENT_ORIGIN).total_seconds()
+        num_intervals = int(elapsed // self.interval_seconds) + 1
+
+        return IntervalSchedule.ALIGNMENT_ORIGIN + timedelta(seconds=(num_intervals * self.interval_seconds))
+
+
+class CronSchedule(object):
+    FIELD_RANGES = [
+        (0, 59),    # Minute
+        (0, 23),    # Hour
+        (1, 31),    # Day of month
+        (1, 12),    # Month
+        (0, 7)      # Day of week (0 and 7 are both Sunday)
+    ]
+
+    # Give up looking for a matching time after this many years (e.g. "0 0 31 2 *" never matches)
+    MAX_SEARCH_YEARS = 5
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != len(CronSchedule.FIELD_RANGES):
+            raise ValueError("Cron expression must have 5 fields: '{}'".format(expression))
+
+        self.expression = expression
+        parsed = [
+            CronSchedule._parse_field(field, lower, upper)
+            for field, (lower, upper) in zip(fields, CronSchedule.FIELD_RANGES)
+        ]
+        self.minutes, self.hours, self.days_of_month, self.months, self.days_of_week = parsed
+
+        # Sunday can be written as either 0 or 7
+        if 7 in self.days_of_week:
+            self.days_of_week = (self.days_of_week - {7}) | {0}
+
+        # Standard cron behaviour: if both day fields are restricted, a day matches if EITHER of them matches
+        self.day_of_month_restricted = (fields[2] != "*")
+        self.day_of_week_restricted = (fields[4] != "*")
+
+    @staticmethod
+    def _parse_field(field, lower, upper):
+        values = set()
+
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_string = part.split("/", 1)
+                step = int(step_string)
+                if step <= 0:
+                    raise ValueError("Invalid cron step: '{}'".format(field))
+
+            if part == "*":
+                start, end = lower, upper
+            elif "-" in part:
+                start_string, end_string = part.split("-", 1)
+                start, end = int(start_string), int(end_string)
+            else:
+                start = int(part)
+                end = upper if step > 1 else start
+
+            if start < lower or end > upper or start > end:
+                raise ValueError("Cron field out of range: '{}'".format(field))
+
+            values.update(range(start, end + 1, step))
+
+        return values
+
+    def _day_matches(self, date_time):
+        day_of_month_match = date_time.day in self.days_of_month
+        # datetime.weekday() has Monday as 0, cron has Sunday as 0
+        day_of_week_match = ((date_time.weekday() + 1) % 7) in self.days_of_week
+
+        if self.day_of_month_restricted and self.day_of_week_restricted:
+            return day_of_month_match or day_of_week_match
+
+        return day_of_month_match and day_of_week_match
+
+    def next_tick(self, after):
+        tick = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        search_limit = tick.replace(year=tick.year + CronSchedule.MAX_SEARCH_YEARS)
+
+        while tick < search_limit:
+            if tick.month not in self.months:
+                # Skip to the start of next month
+                tick = (tick.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(tick):
+                tick = tick.replace(hour=0, minute=0) + timedelta(days=1)
+            elif tick.hour not in self.hours:
+                tick = tick.replace(minute=0) + timedelta(hours=1)
+            elif tick.minute not in self.minutes:
+                tick += timedelta(minutes=1)
+            else:
+                return tick
+
+        raise ValueError("Cron expression never fires: '{}'".format(self.expression))
+
+
+class CaptureScheduler(object):
+    # Longest single sleep between clock checks. Keeps us honest if the wall clock jumps (e.g. NTP sync after boot)
+    MAX_SLEEP_SECONDS = 30
+
+    def __init__(self, schedule, capture_callback, missed_tick_policy=MissedTickPolicy.SKIP):
+        self.schedule = schedule
+        self.capture_callback = capture_callback
+        self.missed_tick_policy = missed_tick_policy
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def _wait_until(self, tick):
+        while not self._stop_event.is_set():
+            remaining = (tick - datetime.now()).total_seconds()
+            if remaining <= 0:
+                return True
+
+            self._stop_event.wait(min(remaining, CaptureScheduler.MAX_SLEEP_SECONDS))
+
+        return False
+
+    def _run_capture(self, tick):
+        try:
+            self.capture_callback(tick)
+        except Exception as e:
+            # A single bad capture shouldn't take the daemon down
+            print("Capture for {} failed: {}".format(tick, e))
+
+    def run(self):
+        tick = self.schedule.next_tick(datetime.now())
+
+        while self._wait_until(tick):
+            self._run_capture(tick)
+
+            # Captures run one at a time on this thread so they can never overlap. Any ticks that became due while
+            # this capture was running are dealt with according to the missed tick policy
+            now = datetime.now()
+            next_tick = self.schedule.next_tick(tick)
+            missed_ticks = []
+            while next_tick <= now:
+                missed_ticks.append(next_tick)
+                next_tick = self.schedule.next_tick(next_tick)
+
+            if missed_ticks:
+                print("Capture overran, {} tick(s) missed".format(len(missed_ticks)))
+                if (self.missed_tick_policy == MissedTickPolicy.CATCH_UP) and not self._stop_event.is_set():
+                    self._run_capture(missed_ticks[-1])
+
+                    # Ticks missed during the catch up capture are always skipped, otherwise a capture that is
+                    # consistently slower than the schedule would never let us get back on track
+                    now = datetime.now()
+                    while next_tick <= now:
+                        next_tick = self.schedule.next_tick(next_tick)
+
+            tick = next_tick
@@ -0,0 +1,103 @@
+import io
+import json
+import os
+from collections import namedtuple
+from datetime import datetime
+
+from file_utils import write_file_atomically
+from startup_profile import lazy_import
+
+numpy = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+# Skips storing captures that look the same as the last one stored (e.g. overnight with the lights off).
+# max_difference is the mean difference between the two fingerprints in grey levels (0-255). unchanged_action is what
+# happens to an unchanged capture: "skip" stores nothing, "thumbnail" only stores the smallest of the outputs. Either
+# way its sensor readings still go in the snapshot index. A capture is always stored in full if the last one stored is
+# more than max_unchanged_seconds old
+ChangeDetectionOptions = namedtuple(
+    "ChangeDetectionOptions",
+    "max_difference unchanged_action max_unchanged_seconds",
+    defaults=(2.0, "skip", 3600)
+)
+
+UNCHANGED_ACTIONS = ("skip", "thumbnail")
+
+FINGERPRINT_SIZE = (64, 36)
+
+
+def frame_fingerprint(frame):
+    # A tiny greyscale copy of the capture. The camera's JPEG is decoded in draft mode, so the decoder only produces
+    # the brightness at (up to) 1/8 scale and a 4K capture is never decoded at full size
+    if frame.encoded_image is not None:
+        image = Image.open(io.BytesIO(frame.encoded_image))
+        image.draft("L", FINGERPRINT_SIZE)
+    else:
+        image = frame.image
+
+    fingerprint_image = image.resize(FINGERPRINT_SIZE, Image.Resampling.BOX).convert("L")
+    return numpy.asarray(fingerprint_image, dtype=numpy.uint8)
+
+
+def fingerprint_difference(fingerprint, other_fingerprint):
+    return float(numpy.mean(numpy.abs(fingerprint.astype(numpy.int16) - other_fingerprint.astype(numpy.int16))))
+
+
+# The fingerprint of the last capture stored for each target, kept in the cache so one snap per process works too.
+# Captures are compared with the last one stored rather than the last one taken, so a slow change (e.g. plants
+# growing) still gets stored once it adds up
+class ChangeDetector(object):
+    STATE_FILE = "change_detection.json"
+
+    def __init__(self, options, cache_path):
+        self.options = options
+        self.state_file = os.path.join(cache_path, ChangeDetector.STATE_FILE)
+        self._stored = {}
+        self._changed = False
+
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            for target_name, entry in state.items():
+                fingerprint = numpy.frombuffer(bytes.fromhex(entry["fingerprint"]), dtype=numpy.uint8)
+                self._stored[target_name] = (
+                    datetime.fromisoformat(entry["snap_time"]),
+                    fingerprint.reshape(entry["shape"])
+                )
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._stored = {}
+
+    def difference_from_stored(self, target_name, fingerprint, snap_time):
+        # None if the capture has to be stored whatever it looks like
+        stored = self._stored.get(target_name, None)
+        if stored is None:
+            return None
+
+        stored_time, stored_fingerprint = stored
+        if stored_fingerprint.shape != fingerprint.shape:
+            return None
+        if abs((snap_time - stored_time).total_seconds()) >= self.options.max_unchanged_seconds:
+            return None
+
+        return fingerprint_difference(fingerprint, stored_fingerprint)
+
+    def is_unchanged(self, difference):
+        return (difference is not None) and (difference <= self.options.max_difference)
+
+    def record_stored(self, target_name, fingerprint, snap_time):
+        self._stored[target_name] = (snap_time, fingerprint)
+        self._changed = True
+
+    def save(self):
+        if not self._changed:
+            return
+
+        write_file_atomically(self.state_file, json.dumps({
+            target_name: {
+                "snap_time": snap_time.isoformat(),
+                "shape": list(fingerprint.shape),
+                "fingerprint": fingerprint.tobytes().hex()
+            }
+            for target_name, (snap_time, fingerprint) in self._stored.items()
+        }))
+        self._changed = False
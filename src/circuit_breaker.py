@@ -0,0 +1,71 @@
+import json
+import os.path
+import threading
+import time
+
+from file_utils import write_file_atomically
+
+
+# Stops us from talking to the controller for a while after it has failed several times in a row. The state is kept
+# on disk so it carries over between runs when the snapper is started by cron
+class CircuitBreaker(object):
+    STATE_FILE = "controller_circuit_breaker.json"
+    CONSECUTIVE_FAILURES_KEY = "consecutive_failures"
+    OPEN_UNTIL_KEY = "open_until"
+
+    def __init__(self, state_path, failure_threshold, backoff_seconds):
+        self.state_file = os.path.join(state_path, CircuitBreaker.STATE_FILE) if state_path is not None else None
+        self.failure_threshold = failure_threshold
+        self.backoff_seconds = backoff_seconds
+
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self._read_state()
+
+    def _read_state(self):
+        if self.state_file is None:
+            return
+
+        try:
+            with open(self.state_file) as json_file:
+                state = json.load(json_file)
+                self.consecutive_failures = state.get(CircuitBreaker.CONSECUTIVE_FAILURES_KEY, 0)
+                self.open_until = state.get(CircuitBreaker.OPEN_UNTIL_KEY, 0)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def _write_state(self):
+        if self.state_file is None:
+            return
+
+        write_file_atomically(self.state_file, json.dumps({
+            CircuitBreaker.CONSECUTIVE_FAILURES_KEY: self.consecutive_failures,
+            CircuitBreaker.OPEN_UNTIL_KEY: self.open_until
+        }))
+
+    def allow_request(self):
+        # Once the backoff window is over we let requests through again. If the next one fails the breaker opens
+        # straight away, as we are still over the failure threshold
+        with self._lock:
+            return time.time() >= self.open_until
+
+    def record_success(self):
+        with self._lock:
+            if (self.consecutive_failures == 0) and (self.open_until == 0):
+                return
+
+            self.consecutive_failures = 0
+            self.open_until = 0
+            self._write_state()
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if (self.failure_threshold > 0) and (self.consecutive_failures >= self.failure_threshold):
+                self.open_until = time.time() + self.backoff_seconds
+                print("Controller failed {} times in a row, not trying it again for {} seconds".format(
+                    self.consecutive_failures,
+                    self.backoff_seconds
+                ))
+            self._write_state()
@@ -0,0 +1,149 @@
+import hashlib
+import threading
+from collections import namedtuple
+
+from snapper_metrics import record_future
+from startup_profile import lazy_import
+
+grpc = lazy_import("grpc")
+empty_pb2 = lazy_import("google.protobuf.empty_pb2")
+message_factory = lazy_import("google.protobuf.message_factory")
+controller_pb2 = lazy_import("pyproto.messages.controller_pb2")
+NetworkControllerStub = lazy_import("pyproto.messages.controller_pb2_grpc", "NetworkControllerStub")
+SensorModuleStatus = lazy_import("pyproto.messages.sensors_pb2", "SensorModuleStatus")
+GrowDatabase = lazy_import("pyproto.protomodel.database.grow_database", "GrowDatabase")
+SensorData = lazy_import("pyproto.protomodel.sensors.sensors", "SensorData")
+PiFeederClientInterceptor = lazy_import("pyproto.server.grpc_client_interceptor", "PiFeederClientInterceptor")
+GrpcServerAuthInterceptor = lazy_import("pyproto.server.grpc_server_auth_interceptor", "GrpcServerAuthInterceptor")
+
+# Data fetched from the controller, along with the protobuf messages it was decoded from. Either part can be None if
+# the controller couldn't supply it
+ControllerData = namedtuple(
+    "ControllerData",
+    "grow_database sensor_data grow_database_proto sensor_data_protos"
+)
+
+
+class ControllerClient(object):
+    SERVICE_NAME = "NetworkController"
+    DEFAULT_RPC_DEADLINE = 10
+
+    # Keepalive pings stop idle connections from being silently dropped between snaps. gRPC servers reject pings more
+    # often than every 5 minutes on idle connections by default, so don't go below that
+    CHANNEL_OPTIONS = [
+        ("grpc.keepalive_time_ms", 5 * 60 * 1000),
+        ("grpc.keepalive_timeout_ms", 20 * 1000),
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+        ("grpc.initial_reconnect_backoff_ms", 1000),
+        ("grpc.min_reconnect_backoff_ms", 1000),
+        ("grpc.max_reconnect_backoff_ms", 60 * 1000)
+    ]
+
+    def __init__(self, host, port, passphrase=None, rpc_deadline=DEFAULT_RPC_DEADLINE):
+        self.host = host
+        self.port = port
+        self.passphrase = passphrase
+        self.rpc_deadline = rpc_deadline
+
+        self._lock = threading.Lock()
+        self._channel = None
+        self._stub = None
+        self._auth_metadata = []
+
+    @staticmethod
+    def empty_request():
+        # Made when needed rather than once up front, so protobuf isn't imported until we talk to the controller
+        return empty_pb2.Empty()
+
+    @staticmethod
+    def response_class(method_name):
+        # The response message type for one of the NetworkController RPCs
+        service = controller_pb2.DESCRIPTOR.services_by_name[ControllerClient.SERVICE_NAME]
+        return message_factory.GetMessageClass(service.methods_by_name[method_name].output_type)
+
+    def _get_stub(self):
+        with self._lock:
+            if self._stub is None:
+                # Create and hash the auth key if we have one and attach it to a channel interceptor
+                interceptor = None
+                if self.passphrase is not None:
+                    m = hashlib.sha256()
+                    m.update(self.passphrase.encode())
+                    hash_auth_key = m.digest().hex()
+                    interceptor = PiFeederClientInterceptor(GrpcServerAuthInterceptor.AUTH_HEADER_KEY, hash_auth_key)
+                    self._auth_metadata = [(GrpcServerAuthInterceptor.AUTH_HEADER_KEY, hash_auth_key)]
+
+                host_string = "{}:{}".format(self.host, self.port)
+                self._channel = grpc.insecure_channel(host_string, options=ControllerClient.CHANNEL_OPTIONS)
+                read_channel = (
+                    grpc.intercept_channel(self._channel, interceptor) if interceptor is not None else self._channel
+                )
+                self._stub = NetworkControllerStub(read_channel)
+
+            return self._stub
+
+    def close(self):
+        with self._lock:
+            if self._channel is not None:
+                self._channel.close()
+            self._channel = None
+            self._stub = None
+
+    def upload(self, method_name, chunks, metadata, timeout):
+        # Client streaming call that sends raw byte chunks, on the same channel as the other calls. The generated
+        # protobuf code has no upload call, so this goes through the channel directly with no (de)serializers and the
+        # auth header is added here rather than by the interceptor. Returns the raw response, raises grpc.RpcError
+        self._get_stub()
+        service = controller_pb2.DESCRIPTOR.services_by_name[ControllerClient.SERVICE_NAME]
+        upload_call = self._channel.stream_unary("/{}/{}".format(service.full_name, method_name))
+
+        return upload_call(chunks, metadata=(list(metadata) + self._auth_metadata), timeout=timeout)
+
+    def call(self, method_name):
+        # A single call to one of the NetworkController RPCs that take no arguments (e.g. "GetGrowDatabase"), on its own
+        # rather than alongside the other as in get_controller_data. Returns the response, raises grpc.RpcError
+        stub_call = getattr(self._get_stub(), method_name)
+        return stub_call(ControllerClient.empty_request(), timeout=self.rpc_deadline)
+
+    def get_controller_data(self):
+        # Raises grpc.RpcError if either of the calls fails or misses its deadline
+        stub = self._get_stub()
+
+        # Both requests go out at the same time
+        empty_request = ControllerClient.empty_request()
+        grow_database_future = stub.GetGrowDatabase.future(empty_request, timeout=self.rpc_deadline)
+        sensor_snapshot_future = stub.GetSensorSnapshot.future(empty_request, timeout=self.rpc_deadline)
+        record_future(grow_database_future, "controller.get_grow_database")
+        record_future(sensor_snapshot_future, "controller.get_sensor_snapshot")
+
+        try:
+            grow_database_response = grow_database_future.result()
+            sensor_snapshot_response = sensor_snapshot_future.result()
+        except grpc.RpcError:
+            grow_database_future.cancel()
+            sensor_snapshot_future.cancel()
+            raise
+
+        grow_database = None
+        grow_database_proto = None
+        if grow_database_response.statusCode == GrowDatabase.OperationResponse.ResponseType.OPERATION_OK:
+            grow_database_proto = grow_database_response.newGrowDatabase
+            grow_database = GrowDatabase.from_protobuf(grow_database_proto)
+
+        sensor_data = None
+        sensor_data_protos = None
+        if sensor_snapshot_response.moduleStatus == SensorModuleStatus.CONNECTED:
+            sensor_data = {}
+            sensor_data_protos = {}
+            for sensor_data_proto in sensor_snapshot_response.sensorData:
+                sd = SensorData.from_protobuf(sensor_data_proto)
+                sensor_data[sd.sensor_id] = sd
+                sensor_data_protos[sd.sensor_id] = sensor_data_proto
+
+        return ControllerData(
+            grow_database=grow_database,
+            sensor_data=sensor_data,
+            grow_database_proto=grow_database_proto,
+            sensor_data_protos=sensor_data_protos
+        )
@@ -0,0 +1,120 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from image_grabber import SyntheticCameraOptions, SyntheticImageGrabber
+
+# Stands in for libcamera-still (and for ffmpeg reading the camera stream) so the camera grabbers can be run and tested
+# without camera hardware, e.g. with a camera_session command of "python3 src/fake_camera.py". Understands the
+# arguments the grabbers pass:
+#   one shot:   -t 1 --immediate -o <file or ->
+#   persistent: -t 0 --keypress|--signal -o <pattern with %d>
+#   stream:     -i <url> -vf fps=N,scale=W:H -f rawvideo -pix_fmt rgb24 -
+# The --fake-* options control how it misbehaves
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Fake camera for testing")
+    parser.add_argument("-t", "--timeout", type=int, default=5000, dest="timeout")
+    parser.add_argument("-o", "--output", dest="output")
+    parser.add_argument("--width", type=int, default=640, dest="width")
+    parser.add_argument("--height", type=int, default=480, dest="height")
+    parser.add_argument("--keypress", action="store_true", dest="keypress")
+    parser.add_argument("--signal", action="store_true", dest="signal")
+    parser.add_argument("-i", dest="stream_url")
+    parser.add_argument("-vf", dest="video_filter")
+    parser.add_argument("--fake-template", dest="template_file", help="Image to use for every frame")
+    parser.add_argument("--fake-startup", type=float, default=0, dest="startup_time",
+                        help="Seconds to wait before the camera is ready")
+    parser.add_argument("--fake-latency", type=float, default=0, dest="latency", help="Seconds each capture takes")
+    parser.add_argument("--fake-exit-after", type=int, dest="exit_after",
+                        help="Crash after this many captures")
+    args, _ = parser.parse_known_args()
+
+    return args
+
+
+def make_grabber(args):
+    return SyntheticImageGrabber(SyntheticCameraOptions(
+        pattern=("template" if args.template_file is not None else "gradient"),
+        template_file=args.template_file,
+        latency=args.latency,
+        encode_jpeg=True
+    ))
+
+
+def write_slowly(file_name, data):
+    # libcamera-still writes its output files in place, so the reader has to cope with seeing half of one
+    with open(file_name, "wb") as f:
+        half = len(data) // 2
+        f.write(data[:half])
+        f.flush()
+        time.sleep(0.05)
+        f.write(data[half:])
+
+
+def run_triggered(args, grabber):
+    capture_event = threading.Event()
+    if args.signal:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: capture_event.set())
+    else:
+        def read_keypresses():
+            for line in sys.stdin:
+                if line.strip().lower() == "x":
+                    break
+                capture_event.set()
+            os._exit(0)
+
+        threading.Thread(target=read_keypresses, daemon=True).start()
+
+    still_count = 0
+    while True:
+        capture_event.wait()
+        capture_event.clear()
+
+        frame = grabber.capture_image(args.width, args.height)
+        write_slowly(args.output % still_count, frame.encoded_image)
+        still_count += 1
+        if (args.exit_after is not None) and (still_count >= args.exit_after):
+            sys.exit(1)
+
+
+def run_stream(args, grabber):
+    # Frames at the requested rate and size, like ffmpeg's output
+    filters = dict(x.split("=", 1) for x in args.video_filter.split(","))
+    frame_rate = float(filters.get("fps", 1))
+    width, height = (int(x) for x in filters.get("scale", "640:480").split(":"))
+
+    frame_count = 0
+    while True:
+        frame = grabber.capture_image(width, height)
+        sys.stdout.buffer.write(frame.image.tobytes())
+        sys.stdout.buffer.flush()
+        frame_count += 1
+        if (args.exit_after is not None) and (frame_count >= args.exit_after):
+            sys.exit(1)
+        time.sleep(1 / frame_rate)
+
+
+def main():
+    args = parse_arguments()
+    grabber = make_grabber(args)
+    time.sleep(args.startup_time)
+
+    if args.stream_url is not None:
+        run_stream(args, grabber)
+    elif args.keypress or args.signal:
+        run_triggered(args, grabber)
+    else:
+        frame = grabber.capture_image(args.width, args.height)
+        if args.output == "-":
+            sys.stdout.buffer.write(frame.encoded_image)
+        else:
+            write_slowly(args.output, frame.encoded_image)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
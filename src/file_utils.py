@@ -0,0 +1,46 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# mkstemp always creates files only we can read, so the permissions a normal open() would have given are put back.
+# Reading the umask means setting it, so it is done once here rather than every time a file is written
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+NEW_FILE_MODE = 0o666 & ~_UMASK
+
+
+@contextmanager
+def atomic_write(file_name, mode="wb"):
+    # Write to a temporary file next to the destination and rename it into place once everything has been written,
+    # so readers (and a power cut halfway through a write) never see a partially written file
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_file_name = tempfile.mkstemp(
+        dir=directory,
+        prefix=".{}.".format(os.path.basename(file_name)),
+        suffix=".tmp"
+    )
+
+    try:
+        os.fchmod(fd, NEW_FILE_MODE)
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        try:
+            os.remove(temp_file_name)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def write_file_atomically(file_name, data):
+    with atomic_write(file_name, mode=("wb" if isinstance(data, bytes) else "w")) as f:
+        f.write(data)
+
+
+def save_image_atomically(image, file_name, image_format="JPEG", **save_params):
+    # Encode straight into the temporary file, the image is only ever encoded once
+    with atomic_write(file_name) as f:
+        image.save(f, format=image_format, **save_params)
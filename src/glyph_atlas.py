@@ -0,0 +1,120 @@
+import math
+from collections import namedtuple
+
+from startup_profile import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+
+# A pre-rendered character. The masks are the glyph's coverage (0-255) and the offsets are the position of their top
+# left corner relative to the pen position on the baseline. stroke_mask is None for atlases without a stroke
+GlyphTile = namedtuple("GlyphTile", "fill_offset fill_mask stroke_offset stroke_mask")
+
+
+# Characters for one font, size and stroke width, rasterised once by FreeType and then drawn by pasting the cached
+# masks. Only the coverage is kept, so the same atlas draws text in any color. The characters sensor values and day
+# counters are made of are rendered up front, anything else is added the first time it is drawn
+class GlyphAtlas(object):
+    PRELOADED_CHARACTERS = "0123456789.-+ ?:DayTRUEFALS"
+
+    def __init__(self, font, stroke_width=0, characters=PRELOADED_CHARACTERS):
+        self.font = font
+        self.stroke_width = stroke_width
+        self._glyphs = {}
+        self._advances = {}
+
+        # Distance from the top ("lt" anchor) to the baseline ("ls" anchor)
+        self._ascent = self.font.getbbox("0", anchor="lt")[1] - self.font.getbbox("0", anchor="ls")[1]
+
+        for character in characters:
+            self._glyph(character)
+
+    def _render_mask(self, character, stroke_width):
+        left, top, right, bottom = self.font.getbbox(character, anchor="ls", stroke_width=stroke_width)
+        if (right <= left) or (bottom <= top):
+            return None, None
+
+        mask = Image.new("L", ((right - left), (bottom - top)), 0)
+        ImageDraw.Draw(mask).text(
+            xy=(-left, -top),
+            text=character,
+            fill=255,
+            font=self.font,
+            anchor="ls",
+            stroke_width=stroke_width,
+            stroke_fill=255
+        )
+
+        return (left, top), mask
+
+    def _glyph(self, character):
+        glyph = self._glyphs.get(character, None)
+        if glyph is None:
+            fill_offset, fill_mask = self._render_mask(character, 0)
+            stroke_offset, stroke_mask = None, None
+            if self.stroke_width > 0:
+                stroke_offset, stroke_mask = self._render_mask(character, self.stroke_width)
+
+            glyph = GlyphTile(
+                fill_offset=fill_offset,
+                fill_mask=fill_mask,
+                stroke_offset=stroke_offset,
+                stroke_mask=stroke_mask
+            )
+            self._glyphs[character] = glyph
+
+        return glyph
+
+    def _advance(self, character, next_character):
+        # How far the pen moves after character, including any kerning with the character that follows it
+        cache_key = (character, next_character)
+        advance = self._advances.get(cache_key, None)
+        if advance is None:
+            if next_character is None:
+                advance = self.font.getlength(character)
+            else:
+                advance = self.font.getlength(character + next_character) - self.font.getlength(next_character)
+            self._advances[cache_key] = advance
+
+        return advance
+
+    def _layout(self, xy, text, anchor):
+        # Pen position on the baseline for each character
+        if anchor not in ("ls", "lt"):
+            raise ValueError("Unsupported anchor: {}".format(anchor))
+
+        pen_x, pen_y = xy
+        if anchor == "lt":
+            pen_y += self._ascent
+
+        positions = []
+        for count, character in enumerate(text):
+            next_character = text[count + 1] if (count + 1) < len(text) else None
+            positions.append((character, pen_x, pen_y))
+            pen_x += self._advance(character, next_character)
+
+        return positions
+
+    def draw(self, image, xy, text, fill, stroke_fill=None, anchor="ls"):
+        # Equivalent to ImageDraw.text with this atlas's font and stroke width. All of the stroke is drawn before any of
+        # the fill, as ImageDraw does, so a stroke never covers the neighbouring character
+        positions = self._layout(xy, text, anchor)
+
+        passes = [(fill, "fill")]
+        if (self.stroke_width > 0) and (stroke_fill is not None):
+            passes.insert(0, (stroke_fill, "stroke"))
+
+        for color, mask_type in passes:
+            for character, pen_x, pen_y in positions:
+                glyph = self._glyph(character)
+                offset, mask = (
+                    (glyph.fill_offset, glyph.fill_mask) if mask_type == "fill"
+                    else (glyph.stroke_offset, glyph.stroke_mask)
+                )
+                if mask is None:
+                    continue
+
+                # Rounded the same way FreeType rounds the start of a string (halves go right and up)
+                x = math.floor(pen_x + 0.5) + offset[0]
+                y = math.ceil(pen_y - 0.5) + offset[1]
+                image.paste(color, (x, y, (x + mask.width), (y + mask.height)), mask)
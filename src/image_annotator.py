@@ -1,20 +1,38 @@
+import math
 import os
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from contextlib import nullcontext
+from datetime import datetime
 
-from PIL import ImageFont, Image, ImageDraw
+from glyph_atlas import GlyphAtlas
+from startup_profile import lazy_import
+
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
 
 SensorDataStrings = namedtuple("SensorDataStrings", "label value")
+# A sensor reading as it came from the controller, before being formatted for display
+SensorValue = namedtuple("SensorValue", "label value")
 
 
 class AnnotationDetails(object):
     MAX_SENSOR_VALUE_LENGTH = 7
 
-    def __init__(self, grow_system_name, age, sensor_data_strings=None):
+    def __init__(self, grow_system_name, age, sensor_data_strings=None, is_live=True, data_timestamp=None,
+                 sensor_values=None):
         self.grow_system_name = grow_system_name
         self.age = age
+        # Whether the data was fetched from the controller for this snap, or is older cached data
+        self.is_live = is_live
+        self.data_timestamp = data_timestamp
         self.sensor_data_strings = sensor_data_strings
         if self.sensor_data_strings is None:
             self.sensor_data_strings = []
+        self.sensor_values = sensor_values
+        if self.sensor_values is None:
+            self.sensor_values = []
 
     def add_sensor_value(self, sensor_label, sensor_value):
         sensor_label_string = "{}:".format(sensor_label)
@@ -25,6 +43,39 @@ class AnnotationDetails(object):
                 value=sensor_value_string
             )
         )
+        self.sensor_values.append(SensorValue(label=sensor_label, value=sensor_value))
+
+    def to_record(self):
+        # Everything needed to draw these annotations again later, as plain JSON types. Each sensor is stored as its
+        # label, value and the string it was displayed as. Values that aren't numbers (or booleans) are stored as None
+        return {
+            "grow_system_name": self.grow_system_name,
+            "age": self.age,
+            "is_live": self.is_live,
+            "data_timestamp": self.data_timestamp,
+            "sensors": [
+                [
+                    sensor_value.label,
+                    sensor_value.value if isinstance(sensor_value.value, (bool, int, float)) else None,
+                    sensor_data_string.value
+                ]
+                for sensor_value, sensor_data_string in zip(self.sensor_values, self.sensor_data_strings)
+            ]
+        }
+
+    @staticmethod
+    def from_record(record):
+        # The sensor values are formatted again, so any change to the formatting applies to old records too
+        annotation_details = AnnotationDetails(
+            record["grow_system_name"],
+            record["age"],
+            is_live=record.get("is_live", True),
+            data_timestamp=record.get("data_timestamp", None)
+        )
+        for label, value, _ in record.get("sensors", []):
+            annotation_details.add_sensor_value(sensor_label=label, sensor_value=value)
+
+        return annotation_details
 
     @staticmethod
     def format_sensor_value(value):
@@ -59,9 +110,19 @@ class AnnotationDetails(object):
 
         return max(self.sensor_data_strings, key=lambda x: len(x.value)).value
 
+    def data_freshness_description(self):
+        if self.is_live:
+            return "live"
+
+        if self.data_timestamp is None:
+            return "stale"
+
+        return "stale (fetched {})".format(datetime.fromtimestamp(self.data_timestamp).strftime("%Y-%m-%d %H:%M:%S"))
+
     def print_details(self):
         print("Grow system name: {}".format(self.grow_system_name))
         print(" Grow system age: {}".format(self.age))
+        print("     Sensor data: {}".format(self.data_freshness_description()))
         print("         Sensors: {}".format("" if len(self.sensor_data_strings) > 0 else "None"))
         for sd in self.sensor_data_strings:
             print("                - {} {}".format(sd.label, sd.value))
@@ -82,6 +143,7 @@ class ImageAnnotator(object):
     GROW_SYSTEM_NAME_COLOR = (137, 255, 142, 255)
     GROW_SYSTEM_NAME_STROKE_COLOR = (12, 33, 13, 255)
     SENSOR_VALUE_COLOR = (0, 242, 255, 255)
+    SENSOR_STALE_VALUE_COLOR = (255, 178, 0, 255)
     SENSOR_LABEL_COLOR = (220, 220, 220, 255)
     SENSOR_BACKGROUND_COLOR = (0, 0, 0, 165)
     SENSOR_OUTLINE_COLOR = (255, 255, 255, 255)
@@ -96,70 +158,321 @@ class ImageAnnotator(object):
     IMAGE_HEIGHT_TO_SENSOR_PADDING_RATIO = 0.015
     IMAGE_WIDTH_TO_SENSOR_BOX_RADIUS_RATIO = 0.01
 
+    # Static overlay cache. Anything that doesn't change from snap to snap (sensor panel background, sensor labels,
+    # logo) is rendered once per layout and reused, only the dynamic text is drawn on every snap
+    OVERLAY_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+    # Sensor panel background edges, see _get_edge_profile and _rounded_rect_pixels
+    EDGE_PROFILE_SCALE = 4
+    EDGE_PROFILE_REACH = 4
+    EDGE_OVERHANG = 0.25
+    CORNER_RADIUS_OFFSET = 0.1
+
+    # Loaded fonts/assets, kept between annotations so long-running processes only pay the loading cost once
+    _font_cache = {}
+    _glyph_atlas_cache = {}
+    _logo_image = None
+    _overlay_cache = OrderedDict()
+    _overlay_cache_bytes = 0
+    _asset_fingerprint = None
+    _edge_profile = None
+
+    SensorPanelLayout = namedtuple("SensorPanelLayout", "font_height box_xy box_size label_positions value_positions")
+    # A piece of the overlay: an RGBA image and the position of its top left corner in the final image
+    OverlayTile = namedtuple("OverlayTile", "xy image")
+
+    @staticmethod
+    def _load_font(font_file, font_height):
+        cache_key = (font_file, font_height)
+        font = ImageAnnotator._font_cache.get(cache_key, None)
+        if font is None:
+            font = ImageFont.truetype(os.path.join(ImageAnnotator.SCRIPT_DIR, font_file), font_height)
+            ImageAnnotator._font_cache[cache_key] = font
+
+        return font
+
+    @staticmethod
+    def _load_glyph_atlas(font_file, font_height, stroke_width=0):
+        # Text that changes every snap (sensor values, names, day counters) is drawn from pre-rendered glyphs rather
+        # than being rasterised by FreeType each time
+        cache_key = (font_file, font_height, stroke_width)
+        glyph_atlas = ImageAnnotator._glyph_atlas_cache.get(cache_key, None)
+        if glyph_atlas is None:
+            glyph_atlas = GlyphAtlas(ImageAnnotator._load_font(font_file, font_height), stroke_width)
+            ImageAnnotator._glyph_atlas_cache[cache_key] = glyph_atlas
+
+        return glyph_atlas
+
+    @staticmethod
+    def _load_logo():
+        if ImageAnnotator._logo_image is None:
+            logo_path = os.path.join(ImageAnnotator.SCRIPT_DIR, ImageAnnotator.LOGO_ASSET_FILE)
+            with Image.open(logo_path) as logo_image:
+                logo_image.load()
+                ImageAnnotator._logo_image = logo_image.copy()
+
+        return ImageAnnotator._logo_image
+
+    @staticmethod
+    def _get_asset_fingerprint():
+        asset_files = sorted({
+            ImageAnnotator.LOGO_ASSET_FILE,
+            ImageAnnotator.SENSOR_DATA_FONT_FILE,
+            ImageAnnotator.AGE_FONT_FILE,
+            ImageAnnotator.GROW_SYSTEM_NAME_FONT_FILE
+        })
+
+        fingerprint = []
+        for asset_file in asset_files:
+            stat = os.stat(os.path.join(ImageAnnotator.SCRIPT_DIR, asset_file))
+            fingerprint.append((asset_file, stat.st_mtime_ns, stat.st_size))
+
+        return tuple(fingerprint)
+
+    @staticmethod
+    def _check_assets():
+        # Throw away everything derived from the fonts/logo if any of them have been changed on disk
+        fingerprint = ImageAnnotator._get_asset_fingerprint()
+        if fingerprint != ImageAnnotator._asset_fingerprint:
+            ImageAnnotator.clear_caches()
+            ImageAnnotator._asset_fingerprint = fingerprint
+
+        return fingerprint
+
+    @staticmethod
+    def clear_caches():
+        ImageAnnotator._font_cache.clear()
+        ImageAnnotator._glyph_atlas_cache.clear()
+        ImageAnnotator._logo_image = None
+        ImageAnnotator._overlay_cache.clear()
+        ImageAnnotator._overlay_cache_bytes = 0
+        ImageAnnotator._asset_fingerprint = None
+
+    @staticmethod
+    def _time_step(step_timer, step_name):
+        return step_timer(step_name) if step_timer is not None else nullcontext()
+
+    @staticmethod
+    def _get_static_overlay(image_size, sensor_data, panel_layout, asset_fingerprint, step_timer=None):
+        labels = tuple(entry.label for entry in sensor_data)
+        cache_key = (image_size, panel_layout, labels, asset_fingerprint)
+
+        overlay = ImageAnnotator._overlay_cache.get(cache_key, None)
+        if overlay is not None:
+            ImageAnnotator._overlay_cache.move_to_end(cache_key)
+            return overlay
+
+        overlay = ImageAnnotator._render_static_overlay(image_size, sensor_data, panel_layout, step_timer)
+
+        # Keep the cache within its memory bound, dropping the least recently used layers first
+        overlay_bytes = ImageAnnotator._overlay_size_bytes(overlay)
+        if overlay_bytes <= ImageAnnotator.OVERLAY_CACHE_MAX_BYTES:
+            while (ImageAnnotator._overlay_cache_bytes + overlay_bytes) > ImageAnnotator.OVERLAY_CACHE_MAX_BYTES:
+                _, evicted = ImageAnnotator._overlay_cache.popitem(last=False)
+                ImageAnnotator._overlay_cache_bytes -= ImageAnnotator._overlay_size_bytes(evicted)
+
+            ImageAnnotator._overlay_cache[cache_key] = overlay
+            ImageAnnotator._overlay_cache_bytes += overlay_bytes
+
+        return overlay
+
+    @staticmethod
+    def _overlay_size_bytes(overlay):
+        return sum((tile.image.width * tile.image.height * len(tile.image.getbands())) for tile in overlay.values())
+
+    @staticmethod
+    def _render_static_overlay(image_size, sensor_data, panel_layout, step_timer=None):
+        overlay = {
+            "logo": ImageAnnotator._annotate_logo(image_size)
+        }
+        if panel_layout is not None:
+            overlay["sensor_panel"] = ImageAnnotator._annotate_sensor_panel(
+                sensor_data,
+                panel_layout,
+                image_size,
+                step_timer
+            )
+
+        return overlay
+
     @staticmethod
     def annotate_image(image_file, annotation_details):
-        with Image.open(image_file).convert("RGBA") as image:
-            # Make a blank image for the annotations, initialized to transparent background color
-            annotation_image = Image.new("RGBA", image.size, (255, 255, 255, 0))
-
-            ImageAnnotator._annotate_grow_system_name_and_age(
-                name=annotation_details.grow_system_name,
-                age=annotation_details.age,
-                dst_image=annotation_image
+        return ImageAnnotator.annotate_frame(Image.open(image_file), annotation_details)
+
+    @staticmethod
+    def annotate_frame(image, annotation_details, step_timer=None):
+        # Annotates an image that is already in memory. The returned image may be the passed in image, modified.
+        # step_timer (if given) is called with the name of each step (check_assets, layout, static_overlay and within
+        # it rounded_rect when the overlay isn't cached, name_and_age, sensor_values, composite) and the context
+        # manager it returns is wrapped around the step, which lets the steps be timed (see snapper_benchmark.py)
+        with ImageAnnotator._time_step(step_timer, "check_assets"):
+            asset_fingerprint = ImageAnnotator._check_assets()
+
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+
+        sensor_data = annotation_details.sensor_data_strings
+        with ImageAnnotator._time_step(step_timer, "layout"):
+            panel_layout = ImageAnnotator._layout_sensor_data(sensor_data, image.size)
+        with ImageAnnotator._time_step(step_timer, "static_overlay"):
+            static_overlay = ImageAnnotator._get_static_overlay(
+                image.size,
+                sensor_data,
+                panel_layout,
+                asset_fingerprint,
+                step_timer
             )
-            ImageAnnotator._annotate_sensor_data(annotation_details.sensor_data_strings, annotation_image)
-            ImageAnnotator._annotate_logo(annotation_image)
 
-            return Image.alpha_composite(image, annotation_image).convert('RGB')
+        # The overlay only covers a few small regions of the image, so rather than compositing a full frame layer
+        # we build a tile for each region and blend just those into the image
+        with ImageAnnotator._time_step(step_timer, "name_and_age"):
+            tiles = [
+                ImageAnnotator._annotate_grow_system_name_and_age(
+                    name=annotation_details.grow_system_name,
+                    age=annotation_details.age,
+                    image_size=image.size
+                )
+            ]
+        if panel_layout is not None:
+            # Sensor values are drawn on top of a copy of the (possibly cached) panel background
+            with ImageAnnotator._time_step(step_timer, "sensor_values"):
+                panel_tile = static_overlay["sensor_panel"]
+                panel_tile = ImageAnnotator.OverlayTile(xy=panel_tile.xy, image=panel_tile.image.copy())
+                value_color = (
+                    ImageAnnotator.SENSOR_VALUE_COLOR if annotation_details.is_live
+                    else ImageAnnotator.SENSOR_STALE_VALUE_COLOR
+                )
+                ImageAnnotator._annotate_sensor_values(sensor_data, panel_layout, panel_tile, value_color)
+            tiles.append(panel_tile)
+        tiles.append(static_overlay["logo"])
+
+        with ImageAnnotator._time_step(step_timer, "composite"):
+            for tile in tiles:
+                # Pasting with the tile as its own mask blends it over the (opaque) image, same as an alpha composite
+                image.paste(tile.image, tile.xy, tile.image)
+
+        return image
+
+    @staticmethod
+    def _get_edge_profile():
+        # How much of a pixel a straight edge covers, by the distance of the pixel's center from the edge (negative
+        # inside), at distances a quarter pixel apart. The sensor panel used to be drawn 4 times the size and shrunk
+        # with a Lanczos filter, and this is how much of that filter's weight lands on the inside of the edge, so the
+        # panel keeps the look it had (including the slight ringing inside the stroke) without the large drawing
+        if ImageAnnotator._edge_profile is None:
+            scale = ImageAnnotator.EDGE_PROFILE_SCALE
+            reach = ImageAnnotator.EDGE_PROFILE_REACH
+            sample_centers = (np.arange((-reach * scale), (reach * scale)) + 0.5) / scale
+            weights = np.sinc(sample_centers) * np.sinc(sample_centers / 3) * (np.abs(sample_centers) < 3)
+            weights /= weights.sum()
+            distances = np.arange((-reach * scale), ((reach * scale) + 1)) / scale
+            coverage = np.array([weights[sample_centers < -distance].sum() for distance in distances])
+            ImageAnnotator._edge_profile = (distances, coverage)
+
+        return ImageAnnotator._edge_profile
+
+    @staticmethod
+    def _edge_coverage(distance):
+        distances, coverage = ImageAnnotator._get_edge_profile()
+        return np.interp(distance, distances, coverage)
 
     @staticmethod
-    def _antialiased_rounded_rect(width, height, radius, stroke, stroke_width, fill):
-        scale_factor = 4
-
-        im = Image.new("RGBA", ((scale_factor * width), (scale_factor * height)), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(im, "RGBA")
-        draw.rounded_rectangle(
-            xy=(
-                0,
-                0,
-                im.width,
-                im.height
-            ),
-            radius=(radius * scale_factor),
-            outline=stroke,
-            width=(stroke_width * scale_factor),
-            fill=fill
+    def _rounded_rect_pixels(xs, ys, width, height, radius, stroke, stroke_width, fill):
+        # RGBA values for the pixels at columns xs and rows ys, from each pixel center's signed distance to the edge of
+        # the rectangle (negative inside) looked up in the edge profile. Like the old drawing, the shape reaches a
+        # quarter pixel past the right and bottom of the image (PIL drew it one large pixel past the last one) and its
+        # corners have a slightly larger radius, as PIL's arcs lie a little inside a true circle
+        outer_width = width + ImageAnnotator.EDGE_OVERHANG
+        outer_height = height + ImageAnnotator.EDGE_OVERHANG
+        radius = min(radius, (outer_width / 2), (outer_height / 2)) + ImageAnnotator.CORNER_RADIUS_OFFSET
+        centers_x = xs + 0.5
+        centers_y = ys + 0.5
+        x = np.abs(centers_x - (outer_width / 2))[np.newaxis, :] - ((outer_width / 2) - radius)
+        y = np.abs(centers_y - (outer_height / 2))[:, np.newaxis] - ((outer_height / 2) - radius)
+        distance = np.hypot(np.maximum(x, 0), np.maximum(y, 0)) + np.minimum(np.maximum(x, y), 0) - radius
+
+        # Nothing was drawn past the edges of the image, so the shape is cut off there
+        image_distance = np.maximum(
+            np.maximum(-centers_x, (centers_x - width))[np.newaxis, :],
+            np.maximum(-centers_y, (centers_y - height))[:, np.newaxis]
         )
-        return im.resize((width, height), Image.LANCZOS)
+        outer_coverage = ImageAnnotator._edge_coverage(np.maximum(distance, image_distance))[..., np.newaxis]
+        fill_coverage = ImageAnnotator._edge_coverage(distance + stroke_width)[..., np.newaxis]
+        stroke_coverage = outer_coverage - fill_coverage
+
+        # The filter only took in the part of its reach that lies inside the image, which makes up for the rest
+        reach_x = ImageAnnotator._edge_coverage(-centers_x) + ImageAnnotator._edge_coverage(centers_x - width) - 1
+        reach_y = ImageAnnotator._edge_coverage(-centers_y) + ImageAnnotator._edge_coverage(centers_y - height) - 1
+        reach = (reach_y[:, np.newaxis] * reach_x[np.newaxis, :])[..., np.newaxis]
+
+        # Blend the stroke and fill with premultiplied alpha (as resizing an RGBA image does), the ringing can take
+        # the values slightly past what the colors allow so they're clipped
+        stroke = np.array(stroke, dtype=np.float64)
+        fill = np.array(fill, dtype=np.float64)
+        stroke_alpha = stroke_coverage * (stroke[3] / 255)
+        fill_alpha = fill_coverage * (fill[3] / 255)
+        premultiplied_color = np.clip(((stroke_alpha * stroke[:3]) + (fill_alpha * fill[:3])) / reach, 0, 255)
+        alpha = np.clip((stroke_alpha + fill_alpha) / reach, 0, 1)
+        color = np.minimum((premultiplied_color / np.maximum(alpha, 1e-6)), 255)
+
+        return np.concatenate((color, (alpha * 255)), axis=2) + 0.5
 
     @staticmethod
-    def _annotate_grow_system_name_and_age(name, age, dst_image):
-        grow_system_name_font_path = os.path.join(ImageAnnotator.SCRIPT_DIR, ImageAnnotator.GROW_SYSTEM_NAME_FONT_FILE)
-        grow_system_name_font_height = int(dst_image.height * ImageAnnotator.IMAGE_HEIGHT_TO_GROW_SYSTEM_NAME_RATIO)
-        grow_system_name_font = ImageFont.truetype(
-            grow_system_name_font_path,
+    def antialiased_rounded_rect(width, height, radius, stroke, stroke_width, fill):
+        xs = np.arange(width, dtype=np.float64)
+        ys = np.arange(height, dtype=np.float64)
+
+        # Only a band around the edge (as deep as the corners and stroke, plus the reach of the edge profile) needs
+        # working out, everything inside it is just the fill color
+        border = int(math.ceil(max(radius, stroke_width))) + ImageAnnotator.EDGE_PROFILE_REACH + 1
+        pixels = np.empty((height, width, 4), dtype=np.uint8)
+        pixels[:] = fill
+        edge_bands = (
+            (slice(0, border), slice(0, width)),
+            (slice(max(border, (height - border)), height), slice(0, width)),
+            (slice(border, (height - border)), slice(0, border)),
+            (slice(border, (height - border)), slice(max(border, (width - border)), width))
+        )
+        for rows, columns in edge_bands:
+            pixels[rows, columns] = ImageAnnotator._rounded_rect_pixels(
+                xs[columns],
+                ys[rows],
+                width,
+                height,
+                radius,
+                stroke,
+                stroke_width,
+                fill
+            )
+
+        return Image.fromarray(pixels, "RGBA")
+
+    @staticmethod
+    def _annotate_grow_system_name_and_age(name, age, image_size):
+        image_height = image_size[1]
+        grow_system_name_font_height = int(image_height * ImageAnnotator.IMAGE_HEIGHT_TO_GROW_SYSTEM_NAME_RATIO)
+        grow_system_name_font = ImageAnnotator._load_font(
+            ImageAnnotator.GROW_SYSTEM_NAME_FONT_FILE,
             grow_system_name_font_height
         )
 
-        age_font_path = os.path.join(ImageAnnotator.SCRIPT_DIR, ImageAnnotator.AGE_FONT_FILE)
-        age_font_height = int(dst_image.height * ImageAnnotator.IMAGE_HEIGHT_TO_AGE_RATIO)
-        age_font = ImageFont.truetype(
-            age_font_path,
+        age_font_height = int(image_height * ImageAnnotator.IMAGE_HEIGHT_TO_AGE_RATIO)
+        age_font = ImageAnnotator._load_font(
+            ImageAnnotator.AGE_FONT_FILE,
             age_font_height
         )
         age_string = "Day {}".format(age)
 
         padding = (grow_system_name_font_height / 2)
-
-        # Get a drawing context for our image
-        draw = ImageDraw.Draw(dst_image)
+        grow_system_name_stroke_width = int(grow_system_name_font_height / 5)
+        age_stroke_width = int(age_font_height / 5)
 
         # Calculate draw positions
         age_bb = age_font.getbbox(age_string, anchor="ls")
         age_height = age_bb[3] - age_bb[1]
         age_text_xy = (
             padding,
-            dst_image.height - padding - age_height
+            image_height - padding - age_height
         )
 
         grow_system_name_bb = grow_system_name_font.getbbox(name, anchor="lt")
@@ -170,43 +483,57 @@ class ImageAnnotator(object):
             age_text_xy[1] - padding - grow_system_name_height
         )
 
-        draw.text(
-            xy=grow_system_name_xy,
+        # Work out the region covered by both strings (including their strokes) and draw into a tile that size
+        name_box = grow_system_name_font.getbbox(name, anchor="lt", stroke_width=grow_system_name_stroke_width)
+        age_box = age_font.getbbox(age_string, anchor="lt", stroke_width=age_stroke_width)
+        tile_left = int(min(grow_system_name_xy[0] + name_box[0], age_text_xy[0] + age_box[0])) - 1
+        tile_top = int(min(grow_system_name_xy[1] + name_box[1], age_text_xy[1] + age_box[1])) - 1
+        tile_right = int(max(grow_system_name_xy[0] + name_box[2], age_text_xy[0] + age_box[2])) + 2
+        tile_bottom = int(max(grow_system_name_xy[1] + name_box[3], age_text_xy[1] + age_box[3])) + 2
+
+        # Make a blank tile for the text, initialized to transparent background color
+        tile = Image.new("RGBA", ((tile_right - tile_left), (tile_bottom - tile_top)), (255, 255, 255, 0))
+
+        grow_system_name_atlas = ImageAnnotator._load_glyph_atlas(
+            ImageAnnotator.GROW_SYSTEM_NAME_FONT_FILE,
+            grow_system_name_font_height,
+            grow_system_name_stroke_width
+        )
+        grow_system_name_atlas.draw(
+            image=tile,
+            xy=((grow_system_name_xy[0] - tile_left), (grow_system_name_xy[1] - tile_top)),
             text=name,
             fill=ImageAnnotator.GROW_SYSTEM_NAME_COLOR,
             stroke_fill=ImageAnnotator.GROW_SYSTEM_NAME_STROKE_COLOR,
-            stroke_width=int(grow_system_name_font_height / 5),
-            font=grow_system_name_font,
             anchor="lt"
         )
 
         # Draw
-        draw = ImageDraw.Draw(dst_image)
-        draw.text(
-            xy=age_text_xy,
+        age_atlas = ImageAnnotator._load_glyph_atlas(ImageAnnotator.AGE_FONT_FILE, age_font_height, age_stroke_width)
+        age_atlas.draw(
+            image=tile,
+            xy=((age_text_xy[0] - tile_left), (age_text_xy[1] - tile_top)),
             text=age_string,
             fill=ImageAnnotator.AGE_COLOR,
-            font=age_font,
-            stroke_width=int(age_font_height / 5),
             stroke_fill=ImageAnnotator.AGE_STROKE_COLOR,
             anchor="lt"
         )
 
-    @staticmethod
-    def _annotate_sensor_data(sensor_data, dst_image):
-        DataEntryDrawPos = namedtuple("DataEntryDrawPos", "label_pos value_pos")
+        return ImageAnnotator.OverlayTile(xy=(tile_left, tile_top), image=tile)
 
+    @staticmethod
+    def _layout_sensor_data(sensor_data, image_size):
         if len(sensor_data) == 0:
-            return
+            return None
 
-        sensor_data_font_path = os.path.join(ImageAnnotator.SCRIPT_DIR, ImageAnnotator.SENSOR_DATA_FONT_FILE)
-        sensor_data_font_height = int(dst_image.height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_DATA_RATIO)
-        sensor_data_font = ImageFont.truetype(
-            sensor_data_font_path,
+        image_width, image_height = image_size
+        sensor_data_font_height = int(image_height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_DATA_RATIO)
+        sensor_data_font = ImageAnnotator._load_font(
+            ImageAnnotator.SENSOR_DATA_FONT_FILE,
             sensor_data_font_height
         )
-        box_padding = int(dst_image.height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_PADDING_RATIO)
-        box_interior_padding = int(dst_image.height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_INTERIOR_PADDING_RATIO)
+        box_padding = int(image_height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_PADDING_RATIO)
+        box_interior_padding = int(image_height * ImageAnnotator.IMAGE_HEIGHT_TO_SENSOR_INTERIOR_PADDING_RATIO)
 
         # Calculate draw positions
         num_entries = len(sensor_data)
@@ -227,10 +554,10 @@ class ImageAnnotator(object):
         )
         sensor_data_background_height = ((num_entries - 1) * entry_spacing_vertical) + (2 * box_interior_padding)
 
-        sensor_data_draw_positions = []
-        x_pos = int(dst_image.width - sensor_data_background_width - box_padding)
+        relative_positions = []
+        x_pos = int(image_width - sensor_data_background_width - box_padding)
         entry_y_pos = box_interior_padding
-        for count, entry in enumerate(sensor_data):
+        for entry in sensor_data:
             lb = sensor_data_font.getbbox(entry.label, anchor="ls")
             lb_height = lb[3] - lb[1]
             lb_width = lb[2] - lb[0]
@@ -247,66 +574,85 @@ class ImageAnnotator(object):
 
             sensor_data_background_height += max_height
             entry_y_pos += (max_height + entry_spacing_vertical)
-            sensor_data_draw_positions.append(
-                DataEntryDrawPos(
-                    label_pos=(label_x, label_y),
-                    value_pos=(value_x, value_y)
-                )
-            )
-        y_pos = int(dst_image.height - sensor_data_background_height - box_padding)
-
-        # OK, done calculating. Draw stuff
-        draw = ImageDraw.Draw(dst_image)
-        sensor_data_box_radius = int(ImageAnnotator.IMAGE_WIDTH_TO_SENSOR_BOX_RADIUS_RATIO * dst_image.width)
-        rr_im = ImageAnnotator._antialiased_rounded_rect(
-            width=int(sensor_data_background_width),
-            height=int(sensor_data_background_height),
-            radius=sensor_data_box_radius,
-            stroke=ImageAnnotator.SENSOR_OUTLINE_COLOR,
-            stroke_width=2,
-            fill=ImageAnnotator.SENSOR_BACKGROUND_COLOR
+            relative_positions.append(((label_x, label_y), (value_x, value_y)))
+        y_pos = int(image_height - sensor_data_background_height - box_padding)
+
+        return ImageAnnotator.SensorPanelLayout(
+            font_height=sensor_data_font_height,
+            box_xy=(x_pos, y_pos),
+            box_size=(int(sensor_data_background_width), int(sensor_data_background_height)),
+            label_positions=tuple((lp[0], y_pos + lp[1]) for lp, _ in relative_positions),
+            value_positions=tuple((vp[0], y_pos + vp[1]) for _, vp in relative_positions)
         )
-        dst_image.paste(rr_im, (x_pos, y_pos))
 
+    @staticmethod
+    def _annotate_sensor_panel(sensor_data, panel_layout, image_size, step_timer=None):
+        sensor_data_font = ImageAnnotator._load_font(ImageAnnotator.SENSOR_DATA_FONT_FILE, panel_layout.font_height)
+
+        sensor_data_box_radius = int(ImageAnnotator.IMAGE_WIDTH_TO_SENSOR_BOX_RADIUS_RATIO * image_size[0])
+        with ImageAnnotator._time_step(step_timer, "rounded_rect"):
+            rr_im = ImageAnnotator.antialiased_rounded_rect(
+                width=panel_layout.box_size[0],
+                height=panel_layout.box_size[1],
+                radius=sensor_data_box_radius,
+                stroke=ImageAnnotator.SENSOR_OUTLINE_COLOR,
+                stroke_width=2,
+                fill=ImageAnnotator.SENSOR_BACKGROUND_COLOR
+            )
+        box_x, box_y = panel_layout.box_xy
+
+        draw = ImageDraw.Draw(rr_im)
         for count, entry in enumerate(sensor_data):
-            draw_positions = sensor_data_draw_positions[count]
+            label_x, label_y = panel_layout.label_positions[count]
             draw.text(
-                xy=(draw_positions.label_pos[0], y_pos + draw_positions.label_pos[1]),
+                xy=((label_x - box_x), (label_y - box_y)),
                 text=entry.label,
                 fill=ImageAnnotator.SENSOR_LABEL_COLOR,
                 font=sensor_data_font,
                 anchor="ls"
             )
 
-            draw.text(
-                xy=(draw_positions.value_pos[0], y_pos + draw_positions.value_pos[1]),
+        return ImageAnnotator.OverlayTile(xy=panel_layout.box_xy, image=rr_im)
+
+    @staticmethod
+    def _annotate_sensor_values(sensor_data, panel_layout, panel_tile, value_color):
+        sensor_data_atlas = ImageAnnotator._load_glyph_atlas(
+            ImageAnnotator.SENSOR_DATA_FONT_FILE,
+            panel_layout.font_height
+        )
+        tile_x, tile_y = panel_tile.xy
+
+        for count, entry in enumerate(sensor_data):
+            value_x, value_y = panel_layout.value_positions[count]
+            sensor_data_atlas.draw(
+                image=panel_tile.image,
+                xy=((value_x - tile_x), (value_y - tile_y)),
                 text=entry.value,
-                fill=ImageAnnotator.SENSOR_VALUE_COLOR,
-                font=sensor_data_font,
+                fill=value_color,
                 anchor="ls"
             )
 
     @staticmethod
-    def _annotate_logo(dst_image):
-        logo_path = os.path.join(ImageAnnotator.SCRIPT_DIR, ImageAnnotator.LOGO_ASSET_FILE)
+    def _annotate_logo(image_size):
+        image_width, image_height = image_size
+        logo_image = ImageAnnotator._load_logo()
 
-        with Image.open(logo_path) as logo_image:
-            # The logo will be centered and take up approximately 1/8 of the total width
-            final_logo_width = int(dst_image.width / 10)
-            scale_factor = (final_logo_width / logo_image.width)
-            final_logo_height = int(logo_image.height * scale_factor)
-            logo_scaled = logo_image.resize((final_logo_width, final_logo_height))
+        # The logo will be centered and take up approximately 1/8 of the total width
+        final_logo_width = int(image_width / 10)
+        scale_factor = (final_logo_width / logo_image.width)
+        final_logo_height = int(logo_image.height * scale_factor)
+        logo_scaled = logo_image.resize((final_logo_width, final_logo_height))
 
-            logo_scaled_alpha = logo_scaled.copy()
-            logo_scaled_alpha.putalpha(175)
-            logo_scaled.paste(logo_scaled_alpha, logo_scaled)
+        logo_scaled_alpha = logo_scaled.copy()
+        logo_scaled_alpha.putalpha(175)
+        logo_scaled.paste(logo_scaled_alpha, logo_scaled)
 
-            padding = int(dst_image.height / 75)
+        padding = int(image_height / 75)
 
-            # logo_y = int(dst_image.height / 20)
-            # logo_x = int((dst_image.width / 2) - (logo_scaled.width / 2))
+        # logo_y = int(image_height / 20)
+        # logo_x = int((image_width / 2) - (logo_scaled.width / 2))
 
-            logo_y = padding
-            logo_x = dst_image.width - padding - logo_scaled.width
+        logo_y = padding
+        logo_x = image_width - padding - logo_scaled.width
 
-            dst_image.paste(logo_scaled, (logo_x, logo_y))
+        return ImageAnnotator.OverlayTile(xy=(logo_x, logo_y), image=logo_scaled)
@@ -0,0 +1,327 @@
+import io
+import json
+import os
+import time
+from collections import namedtuple
+
+from snapshot_archive import iter_snapshots
+from startup_profile import lazy_import
+
+numpy = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+PngImagePlugin = lazy_import("PIL.PngImagePlugin")
+features = lazy_import("PIL.features")
+escape = lazy_import("xml.sax.saxutils", "escape")
+statistics = lazy_import("statistics")
+
+IMAGE_FORMAT_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "WEBP": ".webp",
+    "AVIF": ".avif",
+    "PNG": ".png"
+}
+
+# Encoder settings each format accepts in the config (the names are Pillow's save parameters) and their valid values
+BOOLEAN_VALUES = (True, False)
+ENCODER_PARAMS = {
+    "JPEG": {
+        "quality": range(1, 101),
+        "progressive": BOOLEAN_VALUES,
+        "optimize": BOOLEAN_VALUES,
+        "subsampling": ("4:4:4", "4:2:2", "4:2:0")
+    },
+    "WEBP": {
+        "quality": range(0, 101),
+        "method": range(0, 7),
+        "lossless": BOOLEAN_VALUES
+    },
+    "AVIF": {
+        "quality": range(0, 101),
+        "speed": range(0, 11),
+        "subsampling": ("4:4:4", "4:2:2", "4:2:0", "4:0:0")
+    },
+    "PNG": {
+        "optimize": BOOLEAN_VALUES,
+        "compress_level": range(0, 10)
+    }
+}
+
+# What the snapshot shows, stored in the image file alongside the pixels. Any of the fields can be None
+ImageMetadata = namedtuple("ImageMetadata", "comment exif xmp")
+
+SOFTWARE_NAME = "AutoBloomer Snapper"
+XMP_NAMESPACE = "https://github.com/plb500/AutoBloomer-Snapper/ns/1.0/"
+
+# EXIF tags
+EXIF_IFD_TAG = 0x8769
+IMAGE_DESCRIPTION_TAG = 0x010E
+SOFTWARE_TAG = 0x0131
+DATE_TIME_ORIGINAL_TAG = 0x9003
+USER_COMMENT_TAG = 0x9286
+USER_COMMENT_ASCII = b"ASCII\x00\x00\x00"
+
+
+def format_available(image_format):
+    # WebP and AVIF depend on the libraries Pillow was built with
+    if image_format in ("WEBP", "AVIF"):
+        return features.check(image_format.lower())
+
+    return image_format in IMAGE_FORMAT_EXTENSIONS
+
+
+def _param_value_valid(valid_values, value):
+    # bool is a kind of int, so True would otherwise pass as a quality of 1
+    if valid_values is BOOLEAN_VALUES:
+        return isinstance(value, bool)
+
+    return (not isinstance(value, bool)) and (value in valid_values)
+
+
+def encoder_params_valid(image_format, save_params):
+    valid_params = ENCODER_PARAMS.get(image_format, {})
+    return all(
+        (key in valid_params) and _param_value_valid(valid_params[key], value) for key, value in save_params.items()
+    )
+
+
+def _xmp_packet(annotation_details, snap_time):
+    fields = []
+    if snap_time is not None:
+        fields.append("<xmp:CreateDate>{}</xmp:CreateDate>".format(snap_time.isoformat(timespec="seconds")))
+    fields.append("<xmp:CreatorTool>{}</xmp:CreatorTool>".format(SOFTWARE_NAME))
+
+    if annotation_details is not None:
+        record = annotation_details.to_record()
+        fields.append(
+            "<autobloomer:GrowSystem>{}</autobloomer:GrowSystem>".format(escape(str(record["grow_system_name"])))
+        )
+        fields.append("<autobloomer:Age>{}</autobloomer:Age>".format(record["age"]))
+        fields.append("<autobloomer:DataIsLive>{}</autobloomer:DataIsLive>".format(
+            "True" if record["is_live"] else "False"
+        ))
+        if record["data_timestamp"] is not None:
+            fields.append("<autobloomer:DataTimestamp>{}</autobloomer:DataTimestamp>".format(record["data_timestamp"]))
+
+        sensors = "".join(
+            "<rdf:li rdf:parseType=\"Resource\"><autobloomer:Label>{}</autobloomer:Label>{}"
+            "<autobloomer:DisplayedValue>{}</autobloomer:DisplayedValue></rdf:li>".format(
+                escape(str(label)),
+                "<autobloomer:Value>{}</autobloomer:Value>".format(json.dumps(value)) if value is not None else "",
+                escape(displayed_value.strip())
+            )
+            for label, value, displayed_value in record["sensors"]
+        )
+        fields.append("<autobloomer:Sensors><rdf:Bag>{}</rdf:Bag></autobloomer:Sensors>".format(sensors))
+
+    return (
+        "<?xpacket begin=\"\ufeff\" id=\"W5M0MpCehiHzreSzNTczkc9d\"?>"
+        "<x:xmpmeta xmlns:x=\"adobe:ns:meta/\">"
+        "<rdf:RDF xmlns:rdf=\"http://www.w3.org/1999/02/22-rdf-syntax-ns#\">"
+        "<rdf:Description rdf:about=\"\" xmlns:xmp=\"http://ns.adobe.com/xap/1.0/\" xmlns:autobloomer=\"{}\">"
+        "{}"
+        "</rdf:Description>"
+        "</rdf:RDF>"
+        "</x:xmpmeta>"
+        "<?xpacket end=\"r\"?>"
+    ).format(XMP_NAMESPACE, "".join(fields)).encode("utf-8")
+
+
+def build_metadata(annotation_details, snap_time=None):
+    # The grow system, age and sensor readings go in the XMP (one field each) and, as the JSON annotation record, in the
+    # EXIF user comment. Tools that only show EXIF get the grow system and age from the image description
+    exif = Image.Exif()
+    exif[SOFTWARE_TAG] = SOFTWARE_NAME
+    if snap_time is not None:
+        exif.get_ifd(EXIF_IFD_TAG)[DATE_TIME_ORIGINAL_TAG] = snap_time.strftime("%Y:%m:%d %H:%M:%S")
+
+    comment = None
+    if annotation_details is not None:
+        exif[IMAGE_DESCRIPTION_TAG] = "{} day {}".format(annotation_details.grow_system_name, annotation_details.age)
+        exif.get_ifd(EXIF_IFD_TAG)[USER_COMMENT_TAG] = USER_COMMENT_ASCII + json.dumps(
+            annotation_details.to_record()
+        ).encode("ascii")
+        comment = "AutoBloomer sensor data: {}".format(annotation_details.data_freshness_description())
+
+    return ImageMetadata(comment=comment, exif=exif.tobytes(), xmp=_xmp_packet(annotation_details, snap_time))
+
+
+def metadata_save_params(image_format, metadata):
+    # Save parameters that write the metadata in the way the format supports
+    if metadata is None:
+        return {}
+
+    save_params = {}
+    if metadata.exif is not None:
+        save_params["exif"] = metadata.exif
+
+    if image_format == "PNG":
+        # Pillow only writes PNG XMP as a text chunk
+        if metadata.xmp is not None:
+            png_info = PngImagePlugin.PngInfo()
+            png_info.add_itxt("XML:com.adobe.xmp", metadata.xmp.decode("utf-8"))
+            save_params["pnginfo"] = png_info
+    elif metadata.xmp is not None:
+        save_params["xmp"] = metadata.xmp
+
+    if (image_format == "JPEG") and (metadata.comment is not None):
+        save_params["comment"] = metadata.comment
+
+    return save_params
+
+
+def stored_metadata(image):
+    # The metadata of an image that was saved with build_metadata, to carry it over when the image is re-encoded
+    return ImageMetadata(
+        comment=image.info.get("comment", None),
+        exif=image.info.get("exif", None),
+        xmp=image.info.get("xmp", image.info.get("XML:com.adobe.xmp", None))
+    )
+
+
+def encoder_description(image_format, save_params):
+    return " ".join([image_format] + ["{}={}".format(key, value) for key, value in sorted(save_params.items())])
+
+
+# Encoder settings tried by the comparison (as well as the configured outputs)
+EncoderCandidate = namedtuple("EncoderCandidate", "image_format save_params")
+
+COMPARISON_CANDIDATES = [
+    EncoderCandidate("JPEG", {}),
+    EncoderCandidate("JPEG", {"quality": 85, "optimize": True}),
+    EncoderCandidate("JPEG", {"quality": 85, "progressive": True, "optimize": True}),
+    EncoderCandidate("JPEG", {"quality": 90, "subsampling": "4:4:4"}),
+    EncoderCandidate("JPEG", {"quality": 95}),
+    EncoderCandidate("WEBP", {"quality": 75}),
+    EncoderCandidate("WEBP", {"quality": 85, "method": 6}),
+    EncoderCandidate("AVIF", {"quality": 60, "speed": 8}),
+    EncoderCandidate("AVIF", {"quality": 75, "speed": 6}),
+    EncoderCandidate("PNG", {})
+]
+
+EncoderComparison = namedtuple("EncoderComparison", "description encode_seconds size psnr")
+
+
+def peak_signal_to_noise(image, encoded_image):
+    # In dB, higher is closer to the original. None for a lossless encode
+    difference = numpy.asarray(image, dtype=numpy.float32) - numpy.asarray(encoded_image, dtype=numpy.float32)
+    mean_squared_error = float(numpy.mean(numpy.square(difference)))
+    if mean_squared_error == 0:
+        return None
+
+    return 10 * numpy.log10((255 * 255) / mean_squared_error)
+
+
+def compare_encoders(image, candidates, repeats=3):
+    # Encodes image with each candidate, in memory, and measures the median encode time, size and quality
+    comparisons = []
+    for candidate in candidates:
+        if not format_available(candidate.image_format):
+            print("{} is not supported by this build of Pillow, skipped".format(candidate.image_format))
+            continue
+
+        encode_times = []
+        for _ in range(repeats):
+            output = io.BytesIO()
+            start_time = time.perf_counter()
+            image.save(output, format=candidate.image_format, **candidate.save_params)
+            encode_times.append(time.perf_counter() - start_time)
+
+        with Image.open(io.BytesIO(output.getvalue())) as encoded_image:
+            psnr = peak_signal_to_noise(image, encoded_image.convert(image.mode))
+
+        comparisons.append(EncoderComparison(
+            description=encoder_description(candidate.image_format, candidate.save_params),
+            encode_seconds=statistics.median(encode_times),
+            size=len(output.getvalue()),
+            psnr=psnr
+        ))
+
+    return comparisons
+
+
+def parse_encoder_candidate(candidate_string):
+    # Command line encoder settings, e.g. "WEBP quality=80 method=6"
+    fields = candidate_string.split()
+    if len(fields) == 0:
+        raise ValueError("Empty encoder")
+
+    image_format = fields[0].upper()
+    save_params = {}
+    for field in fields[1:]:
+        key, _, value_string = field.partition("=")
+        if value_string.lower() in ("true", "false"):
+            value = (value_string.lower() == "true")
+        else:
+            try:
+                value = int(value_string)
+            except ValueError:
+                value = value_string
+        save_params[key] = value
+
+    if (image_format not in IMAGE_FORMAT_EXTENSIONS) or not encoder_params_valid(image_format, save_params):
+        raise ValueError("Invalid encoder: '{}'".format(candidate_string))
+
+    return EncoderCandidate(image_format, save_params)
+
+
+def add_encoder_comparison_arguments(parser):
+    parser.add_argument("--image", dest="image_file",
+                        help="Sample frame to encode (defaults to the newest snapshot of the first capture target)")
+    parser.add_argument("--size", dest="size", help="Scale the sample frame to fit this size first, e.g. 1920x1080")
+    parser.add_argument("--encoder", type=parse_encoder_candidate, action="append", dest="candidates",
+                        help="Encoder to try instead of the built-in list, e.g. 'WEBP quality=80 method=6'. "
+                             "Can be repeated")
+    parser.add_argument("--repeats", type=int, default=3, dest="repeats", help="Encodes of each, the median is shown")
+    parser.add_argument("--upload-kbps", type=float, dest="upload_kbps",
+                        help="Also show how long each image would take to upload at this many kilobits per second")
+
+
+def run_encoder_comparison(args, config):
+    image_file = args.image_file
+    if image_file is None:
+        snapshots = list(iter_snapshots(config.image_destination)) if os.path.isdir(config.image_destination) else []
+        if len(snapshots) == 0:
+            print("No snapshots in {}, use --image to give a sample frame".format(config.image_destination))
+            return False
+        image_file = snapshots[-1].path
+
+    with Image.open(image_file) as image:
+        sample_image = image.convert("RGB")
+    if args.size is not None:
+        width, height = args.size.lower().split("x")
+        sample_image.thumbnail((int(width), int(height)))
+
+    # The configured outputs go first, then the built-in list
+    candidates = args.candidates
+    if candidates is None:
+        candidates = [EncoderCandidate(x.image_format, x.save_params) for x in config.output_levels]
+        candidates.extend(x for x in COMPARISON_CANDIDATES if x not in candidates)
+
+    print("{} ({}x{}), median of {} encode(s)".format(
+        image_file,
+        sample_image.width,
+        sample_image.height,
+        args.repeats
+    ))
+
+    comparisons = compare_encoders(sample_image, candidates, repeats=args.repeats)
+    description_width = max([len("Encoder")] + [len(x.description) for x in comparisons])
+    num_pixels = sample_image.width * sample_image.height
+
+    print("{:<{}}  {:>10} {:>10} {:>8} {:>8}{}".format(
+        "Encoder", description_width, "Time (ms)", "Size (KB)", "Bits/px", "PSNR",
+        " {:>10}".format("Upload (s)") if args.upload_kbps is not None else ""
+    ))
+    for comparison in comparisons:
+        print("{:<{}}  {:>10.1f} {:>10.1f} {:>8.2f} {:>8}{}".format(
+            comparison.description,
+            description_width,
+            comparison.encode_seconds * 1000,
+            comparison.size / 1024,
+            (comparison.size * 8) / num_pixels,
+            "{:.1f}".format(comparison.psnr) if comparison.psnr is not None else "lossless",
+            " {:>10.1f}".format((comparison.size * 8) / (args.upload_kbps * 1000))
+            if args.upload_kbps is not None else ""
+        ))
+
+    return True
@@ -1,14 +1,73 @@
+import io
+import os
+import random
+import shlex
+import shutil
+import signal
 import subprocess
-from PIL import Image
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from startup_profile import lazy_import
+
+numpy = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+ImageChops = lazy_import("PIL.ImageChops")
+
+# A captured frame, kept in memory. encoded_image holds the camera's own encoded (JPEG) output if there is one, so it
+# can be stored without having to re-encode it
+CapturedFrame = namedtuple("CapturedFrame", "image encoded_image")
+
+# Settings for a SyntheticImageGrabber. pattern is one of SyntheticImageGrabber.PATTERNS, template_file is the image
+# used by the "template" pattern. latency (plus a random extra of up to latency_jitter) is in seconds, failure_rate is
+# the fraction of captures that fail. encode_jpeg also gives each frame an encoded JPEG, like the real camera does.
+# sensor_noise adds random noise with that standard deviation (in grey levels) to every frame, like a camera in low
+# light, and shake moves every frame by a random amount of up to that many pixels, like a camera that isn't held still
+SyntheticCameraOptions = namedtuple(
+    "SyntheticCameraOptions",
+    "pattern template_file latency latency_jitter failure_rate encode_jpeg seed sensor_noise shake",
+    defaults=("gradient", None, 0, 0, 0, False, None, 0, 0)
+)
+
+# How a target's camera is driven. "oneshot" starts libcamera-still for every snap (the original behaviour),
+# "persistent" keeps one libcamera-still running and triggers each still through it and "stream" takes frames from the
+# video stream started by stream_camera.sh. command replaces the program that is run (libcamera-still, or ffmpeg for
+# stream), e.g. with a fake camera for testing. trigger is "keypress" or "signal" (persistent only)
+CameraSessionOptions = namedtuple(
+    "CameraSessionOptions",
+    "mode command trigger stream_url frame_rate capture_timeout restart_backoff startup_time",
+    defaults=("oneshot", None, "keypress", "tcp://localhost:8888", 1, 10, 5, 2)
+)
+
+CAMERA_SESSION_MODES = ("oneshot", "persistent", "stream")
+
+
+def parse_command(command, default_command):
+    # Commands can be given as a list of arguments or a single string
+    if command is None:
+        return list(default_command)
+    if isinstance(command, str):
+        return shlex.split(command)
+
+    return list(command)
 
 
 class ImageGrabberFactory(object):
     @staticmethod
-    def get_image_grabber(dummy_file=None):
-        if dummy_file is not None:
+    def get_image_grabber(dummy_file=None, camera_index=None, synthetic_options=None, session_options=None):
+        if synthetic_options is not None:
+            return SyntheticImageGrabber(synthetic_options)
+        elif dummy_file is not None:
             return DummyImageGrabber(file=dummy_file)
+        elif (session_options is not None) and (session_options.mode == "persistent"):
+            return PersistentImageGrabber(camera_index=camera_index, options=session_options)
+        elif (session_options is not None) and (session_options.mode == "stream"):
+            return StreamImageGrabber(options=session_options)
         else:
-            return ImageGrabber()
+            command = session_options.command if session_options is not None else None
+            return ImageGrabber(camera_index=camera_index, command=command)
 
 
 class DummyImageGrabber(object):
@@ -22,14 +81,170 @@ class DummyImageGrabber(object):
 
         return True
 
+    def capture_image(self, width, height):
+        image = Image.open(self.file)
+        new_image = image.resize((width, height))
 
-class ImageGrabber(object):
-    COMMAND = "libcamera-still"
+        return CapturedFrame(image=new_image, encoded_image=None)
+
+    def close(self):
+        pass
+
+
+# Generates frames in memory without any camera or file I/O, so the rest of the pipeline can be benchmarked and soak
+# tested on any machine. Whatever is expensive to make (the base pattern, the decoded template and its JPEG) is made
+# once per frame size and cached, each frame after that is cheap
+class SyntheticImageGrabber(object):
+    PATTERNS = ("gradient", "noise", "template")
+    GRADIENT_STEP = 16
+
+    def __init__(self, options=SyntheticCameraOptions()):
+        if options.pattern not in SyntheticImageGrabber.PATTERNS:
+            raise ValueError("Unknown synthetic camera pattern: {}".format(options.pattern))
+        if (options.pattern == "template") and (options.template_file is None):
+            raise ValueError("The template pattern needs a template_file")
+
+        self.options = options
+
+        self._lock = threading.Lock()
+        self._random = random.Random(options.seed)
+        self._frame_count = 0
+        self._base_images = {}
+        self._encoded_templates = {}
+
+    def _next_frame_number(self):
+        with self._lock:
+            self._frame_count += 1
+            return self._frame_count
+
+    def _base_image(self, size):
+        with self._lock:
+            base_image = self._base_images.get(size, None)
+            if base_image is None:
+                if self.options.pattern == "template":
+                    with Image.open(self.options.template_file) as template:
+                        base_image = template.convert("RGB").resize(size)
+                else:
+                    # Horizontal, vertical and diagonal ramps in the three channels
+                    horizontal = Image.linear_gradient("L").rotate(90).resize(size)
+                    vertical = Image.linear_gradient("L").resize(size)
+                    base_image = Image.merge("RGB", (horizontal, vertical, ImageChops.blend(horizontal, vertical, 0.5)))
+                self._base_images[size] = base_image
+
+            return base_image
+
+    def _encoded_template(self, size):
+        # The template never changes, so neither does its JPEG
+        with self._lock:
+            encoded_template = self._encoded_templates.get(size, None)
+
+        if encoded_template is None:
+            encoded_template = SyntheticImageGrabber._encode(self._base_image(size))
+            with self._lock:
+                self._encoded_templates[size] = encoded_template
+
+        return encoded_template
 
     @staticmethod
-    def grab_image(width, height, output_filename):
-        run_pic = subprocess.run([
-            ImageGrabber.COMMAND,
+    def _encode(image):
+        jpeg_bytes = io.BytesIO()
+        image.save(jpeg_bytes, format="JPEG")
+        return jpeg_bytes.getvalue()
+
+    def _make_image(self, size, frame_number):
+        if self.options.pattern == "noise":
+            with self._lock:
+                noise_bytes = self._random.randbytes(size[0] * size[1] * 3)
+            return Image.frombytes("RGB", size, noise_bytes)
+
+        if self.options.pattern == "gradient":
+            # Scroll the pattern along a bit every frame so consecutive frames differ
+            offset = (frame_number * SyntheticImageGrabber.GRADIENT_STEP) % size[0]
+            return ImageChops.offset(self._base_image(size), offset, 0)
+
+        # The annotator draws on the frames it is given, so they must never share the cached template
+        return self._base_image(size).copy()
+
+    def _add_camera_effects(self, image):
+        if self.options.shake > 0:
+            with self._lock:
+                shake_x = self._random.randint(-self.options.shake, self.options.shake)
+                shake_y = self._random.randint(-self.options.shake, self.options.shake)
+            image = ImageChops.offset(image, shake_x, shake_y)
+
+        if self.options.sensor_noise > 0:
+            with self._lock:
+                noise_seed = self._random.getrandbits(64)
+            noise_shape = (image.size[1], image.size[0], 3)
+            noise = numpy.random.default_rng(noise_seed).standard_normal(noise_shape, dtype=numpy.float32)
+            noisy_pixels = (noise * self.options.sensor_noise) + numpy.asarray(image, dtype=numpy.float32)
+            image = Image.fromarray(numpy.clip(numpy.rint(noisy_pixels), 0, 255).astype(numpy.uint8), "RGB")
+
+        return image
+
+    def _simulate_capture(self):
+        # Returns False if this capture should fail
+        with self._lock:
+            delay = self.options.latency + self._random.uniform(0, self.options.latency_jitter)
+            failed = self._random.random() < self.options.failure_rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return not failed
+
+    def grab_image(self, width, height, output_filename):
+        frame = self.capture_image(width, height)
+        if frame is None:
+            return False
+
+        if frame.encoded_image is not None:
+            with open(output_filename, "wb") as f:
+                f.write(frame.encoded_image)
+        else:
+            frame.image.save(output_filename)
+
+        return True
+
+    def capture_image(self, width, height):
+        if not self._simulate_capture():
+            return None
+
+        size = (width, height)
+        has_camera_effects = (self.options.sensor_noise > 0) or (self.options.shake > 0)
+        if (self.options.pattern == "template") and self.options.encode_jpeg and not has_camera_effects:
+            # Like the real camera, the image is only decoded from the JPEG if something needs the pixels
+            encoded_image = self._encoded_template(size)
+            return CapturedFrame(image=Image.open(io.BytesIO(encoded_image)), encoded_image=encoded_image)
+
+        image = self._make_image(size, self._next_frame_number())
+        if has_camera_effects:
+            image = self._add_camera_effects(image)
+        encoded_image = SyntheticImageGrabber._encode(image) if self.options.encode_jpeg else None
+
+        return CapturedFrame(image=image, encoded_image=encoded_image)
+
+    def close(self):
+        pass
+
+
+class ImageGrabber(object):
+    COMMAND = ["libcamera-still"]
+
+    # camera_index selects the camera on boards with more than one, None uses the default camera. command replaces
+    # libcamera-still, e.g. with a fake camera for testing
+    def __init__(self, camera_index=None, command=None):
+        self.camera_index = camera_index
+        self.command = parse_command(command, ImageGrabber.COMMAND)
+
+    def _camera_args(self):
+        if self.camera_index is None:
+            return []
+
+        return ["--camera", "{}".format(self.camera_index)]
+
+    def grab_image(self, width, height, output_filename):
+        run_pic = subprocess.run(self.command + [
             "-t",
             "1",
             "--immediate",
@@ -41,6 +256,317 @@ class ImageGrabber(object):
             "{}".format(height),
             "-o",
             "{}".format(output_filename)
-        ])
+        ] + self._camera_args())
 
         return run_pic.returncode == 0
+
+    def capture_image(self, width, height):
+        # Same as grab_image, but the JPEG comes back to us over stdout instead of being written to disk
+        run_pic = subprocess.run(self.command + [
+            "-t",
+            "1",
+            "--immediate",
+            "-n",
+            "1",
+            "--width",
+            "{}".format(width),
+            "--height",
+            "{}".format(height),
+            "-o",
+            "-"
+        ] + self._camera_args(), stdout=subprocess.PIPE)
+
+        if (run_pic.returncode != 0) or (len(run_pic.stdout) == 0):
+            return None
+
+        return CapturedFrame(
+            image=Image.open(io.BytesIO(run_pic.stdout)),
+            encoded_image=run_pic.stdout
+        )
+
+    def close(self):
+        pass
+
+
+# Base for grabbers that keep a camera process running between snaps. Starts the process when it is first needed and
+# restarts it if it dies or stops responding, but never more often than every restart_backoff seconds so a missing or
+# broken camera doesn't turn into a tight restart loop
+class CameraProcessSession(object):
+    READS_STDOUT = False
+
+    def __init__(self, restart_backoff, startup_time):
+        self.restart_backoff = restart_backoff
+        self.startup_time = startup_time
+
+        self._lock = threading.Lock()
+        self._process = None
+        self._process_size = None
+        self._last_start_time = None
+        self.restart_count = 0
+
+    def _process_args(self, width, height):
+        raise NotImplementedError
+
+    def _on_process_started(self):
+        pass
+
+    def is_healthy(self):
+        return (self._process is not None) and (self._process.poll() is None)
+
+    def _ensure_process(self, width, height):
+        # Returns False if the process isn't running and can't be (re)started just yet
+        if self.is_healthy() and (self._process_size == (width, height)):
+            return True
+
+        if self._process is not None:
+            if self._process.poll() is not None:
+                print("Camera process exited with code {}, restarting it".format(self._process.returncode))
+            self._stop_process()
+
+        now = time.monotonic()
+        if self._last_start_time is not None:
+            if (now - self._last_start_time) < self.restart_backoff:
+                return False
+            self.restart_count += 1
+
+        self._last_start_time = now
+        try:
+            self._process = subprocess.Popen(
+                self._process_args(width, height),
+                stdin=subprocess.PIPE,
+                stdout=(subprocess.PIPE if self.READS_STDOUT else subprocess.DEVNULL),
+                start_new_session=True
+            )
+        except OSError as e:
+            print("Could not start camera process: {}".format(e))
+            self._process = None
+            return False
+
+        self._process_size = (width, height)
+        self._on_process_started()
+
+        return True
+
+    def _stop_process(self):
+        process = self._process
+        self._process = None
+        if process is None:
+            return
+
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        for pipe in (process.stdin, process.stdout):
+            if pipe is not None:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+    def grab_image(self, width, height, output_filename):
+        frame = self.capture_image(width, height)
+        if frame is None:
+            return False
+
+        if frame.encoded_image is not None:
+            with open(output_filename, "wb") as f:
+                f.write(frame.encoded_image)
+        else:
+            frame.image.save(output_filename)
+
+        return True
+
+    def close(self):
+        with self._lock:
+            self._stop_process()
+
+
+# Keeps one libcamera-still running in keypress (a newline on stdin) or signal (SIGUSR1) mode, so the camera is only
+# initialised and its exposure only settles once, rather than on every snap. Each still is written to a numbered file
+# in a private directory, which is read and removed once complete
+class PersistentImageGrabber(CameraProcessSession):
+    COMMAND = ["libcamera-still"]
+    STILL_FILE_PATTERN = "still%06d.jpg"
+    POLL_INTERVAL = 0.01
+    JPEG_END_MARKER = b"\xff\xd9"
+
+    def __init__(self, camera_index=None, options=CameraSessionOptions(mode="persistent")):
+        super().__init__(restart_backoff=options.restart_backoff, startup_time=options.startup_time)
+        self.camera_index = camera_index
+        self.command = parse_command(options.command, PersistentImageGrabber.COMMAND)
+        self.trigger = options.trigger
+        self.capture_timeout = options.capture_timeout
+
+        self._output_directory = tempfile.mkdtemp(prefix="snapper_camera_")
+        self._ready_time = 0
+
+    def _process_args(self, width, height):
+        camera_args = [] if self.camera_index is None else ["--camera", "{}".format(self.camera_index)]
+        return self.command + [
+            "-t",
+            "0",
+            "--{}".format(self.trigger),
+            "-n",
+            "--width",
+            "{}".format(width),
+            "--height",
+            "{}".format(height),
+            "-o",
+            os.path.join(self._output_directory, PersistentImageGrabber.STILL_FILE_PATTERN)
+        ] + camera_args
+
+    def _on_process_started(self):
+        # Stills left over from a previous process would be mistaken for new ones
+        for file_name in os.listdir(self._output_directory):
+            os.remove(os.path.join(self._output_directory, file_name))
+
+        # A keypress waits in stdin until the camera is ready for it, a signal sent too early would kill the process
+        self._ready_time = time.monotonic() + (self.startup_time if self.trigger == "signal" else 0)
+
+    def _trigger_capture(self):
+        if self.trigger == "signal":
+            os.kill(self._process.pid, signal.SIGUSR1)
+        else:
+            self._process.stdin.write(b"\n")
+            self._process.stdin.flush()
+
+    def _wait_for_still(self, deadline):
+        # libcamera-still writes straight to the output file, so wait for it to end with the JPEG end marker
+        while time.monotonic() < deadline:
+            file_names = sorted(x for x in os.listdir(self._output_directory) if x.endswith(".jpg"))
+            if len(file_names) > 0:
+                still_file = os.path.join(self._output_directory, file_names[0])
+                with open(still_file, "rb") as f:
+                    still_bytes = f.read()
+                if still_bytes.endswith(PersistentImageGrabber.JPEG_END_MARKER):
+                    os.remove(still_file)
+                    return still_bytes
+            elif not self.is_healthy():
+                return None
+
+            time.sleep(PersistentImageGrabber.POLL_INTERVAL)
+
+        return None
+
+    def capture_image(self, width, height):
+        with self._lock:
+            if not self._ensure_process(width, height):
+                return None
+
+            wait_time = self._ready_time - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            try:
+                self._trigger_capture()
+            except OSError as e:
+                print("Could not trigger capture: {}".format(e))
+                self._stop_process()
+                return None
+
+            still_bytes = self._wait_for_still(time.monotonic() + self.capture_timeout)
+            if still_bytes is None:
+                # Either it died or it is stuck, start again next time
+                print("Camera process did not deliver a still, restarting it")
+                self._stop_process()
+                return None
+
+        return CapturedFrame(image=Image.open(io.BytesIO(still_bytes)), encoded_image=still_bytes)
+
+    def close(self):
+        with self._lock:
+            if self.is_healthy() and (self.trigger == "keypress"):
+                # Ask it to quit nicely first
+                try:
+                    self._process.stdin.write(b"x\n")
+                    self._process.stdin.flush()
+                    self._process.wait(timeout=2)
+                except (OSError, subprocess.TimeoutExpired):
+                    pass
+            self._stop_process()
+        shutil.rmtree(self._output_directory, ignore_errors=True)
+
+
+# Takes frames from the H.264 stream served by stream_camera.sh. ffmpeg stays connected to the stream and hands us
+# frame_rate decoded frames a second, a background thread keeps the latest one. A capture returns the first frame that
+# arrives after it was asked for, so it is never older than the snap
+class StreamImageGrabber(CameraProcessSession):
+    COMMAND = ["ffmpeg"]
+    READS_STDOUT = True
+
+    def __init__(self, options=CameraSessionOptions(mode="stream")):
+        super().__init__(restart_backoff=options.restart_backoff, startup_time=options.startup_time)
+        self.command = parse_command(options.command, StreamImageGrabber.COMMAND)
+        self.stream_url = options.stream_url
+        self.frame_rate = options.frame_rate
+        self.capture_timeout = options.capture_timeout
+
+        self._frame_condition = threading.Condition()
+        self._latest_frame = None
+        self._latest_frame_time = 0
+        self._reader_thread = None
+
+    def _process_args(self, width, height):
+        return self.command + [
+            "-loglevel",
+            "error",
+            "-i",
+            self.stream_url,
+            "-vf",
+            "fps={},scale={}:{}".format(self.frame_rate, width, height),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "-"
+        ]
+
+    def _on_process_started(self):
+        self._reader_thread = threading.Thread(
+            target=self._read_frames,
+            args=(self._process, self._process_size),
+            name="camera-stream-reader",
+            daemon=True
+        )
+        self._reader_thread.start()
+
+    def _read_frames(self, process, frame_size):
+        frame_bytes = frame_size[0] * frame_size[1] * 3
+        while True:
+            try:
+                frame = process.stdout.read(frame_bytes)
+            except (OSError, ValueError):
+                return
+            if len(frame) < frame_bytes:
+                return
+
+            with self._frame_condition:
+                self._latest_frame = (frame_size, frame)
+                self._latest_frame_time = time.monotonic()
+                self._frame_condition.notify_all()
+
+    def capture_image(self, width, height):
+        with self._lock:
+            request_time = time.monotonic()
+            if not self._ensure_process(width, height):
+                return None
+
+            with self._frame_condition:
+                got_frame = self._frame_condition.wait_for(
+                    lambda: (self._latest_frame_time > request_time) and (self._latest_frame[0] == (width, height)),
+                    timeout=self.capture_timeout
+                )
+                latest_frame = self._latest_frame
+
+            if not got_frame:
+                # Stream stalled (or never started), reconnect next time
+                print("No frames from camera stream {}, reconnecting".format(self.stream_url))
+                self._stop_process()
+                return None
+
+        return CapturedFrame(image=Image.frombytes("RGB", latest_frame[0], latest_frame[1]), encoded_image=None)
@@ -0,0 +1,91 @@
+import math
+import os
+from collections import namedtuple
+from concurrent import futures
+
+from file_utils import save_image_atomically
+from image_encoder import IMAGE_FORMAT_EXTENSIONS, metadata_save_params
+from snapper_metrics import bind_recorder, span
+
+# One output size. reduce_factor is relative to the previous level (the first level is relative to the capture), so a
+# chain of 1, 2, 4 gives full size, half size and eighth size. save_params are the encoder settings (see image_encoder)
+OutputLevel = namedtuple("OutputLevel", "name reduce_factor image_format save_params")
+
+FULL_SIZE_OUTPUT = OutputLevel(name="full", reduce_factor=1, image_format="JPEG", save_params={})
+
+
+def output_path(image_destination, level_index, level, base_filename):
+    # The first level is the main snapshot and lives directly in the image destination, every other level gets its
+    # own sub-directory named after the level
+    filename = "{}{}".format(base_filename, IMAGE_FORMAT_EXTENSIONS[level.image_format])
+    if level_index == 0:
+        return os.path.join(image_destination, filename)
+
+    level_directory = os.path.join(image_destination, level.name)
+    if not os.path.exists(level_directory):
+        os.makedirs(level_directory, exist_ok=True)
+
+    return os.path.join(level_directory, filename)
+
+
+def build_levels(image, output_levels):
+    # Each level is box filtered down from the one before it with Image.reduce, which is a lot cheaper than resizing
+    # the full size image for every level
+    level_images = []
+    for level in output_levels:
+        if level.reduce_factor > 1:
+            image = image.reduce(level.reduce_factor)
+        level_images.append(image)
+
+    return level_images
+
+
+def build_smallest_level(image, output_levels):
+    # Only the last level, for when none of the others are stored. A JPEG that hasn't been decoded yet is scaled down
+    # by the decoder as it is decoded (see Image.draft), so the full size image is never decoded. The decoder can only
+    # scale by 1/2, 1/4 or 1/8, so it is left the largest of those that the total reduce factor is a multiple of.
+    # Whatever scale the decoder actually picked (none at all if the image isn't a JPEG waiting to be decoded) is read
+    # back from the box draft() returns, the rounded down sizes don't say (e.g. 1921 wide at 1/2 is 961)
+    reduce_factor = math.prod(x.reduce_factor for x in output_levels)
+    draft_scale = min(reduce_factor & -reduce_factor, 8)
+    if draft_scale > 1:
+        full_width = image.width
+        draft_result = image.draft(
+            "RGB",
+            (max(1, image.width // draft_scale), max(1, image.height // draft_scale))
+        )
+        if draft_result is not None:
+            _, draft_box = draft_result
+            reduce_factor //= round(full_width / draft_box[2])
+
+    return image.reduce(reduce_factor) if reduce_factor > 1 else image
+
+
+def save_levels(level_images, output_levels, output_paths, metadata=None):
+    # The first (largest) level is saved here, the rest are encoded and written in parallel with it. Pillow releases
+    # the GIL while encoding, so threads are enough
+    def save_level(level_index):
+        level = output_levels[level_index]
+        save_params = dict(level.save_params)
+        save_params.update(metadata_save_params(level.image_format, metadata))
+
+        with span("encode", level=level.name, image_format=level.image_format) as span_fields:
+            save_image_atomically(
+                level_images[level_index],
+                output_paths[level_index],
+                image_format=level.image_format,
+                **save_params
+            )
+            span_fields["bytes"] = os.path.getsize(output_paths[level_index])
+
+    if len(output_levels) == 1:
+        save_level(0)
+        return
+
+    with futures.ThreadPoolExecutor(max_workers=(len(output_levels) - 1)) as executor:
+        level_futures = [
+            executor.submit(bind_recorder(save_level), level_index) for level_index in range(1, len(output_levels))
+        ]
+        save_level(0)
+        for level_future in level_futures:
+            level_future.result()
@@ -0,0 +1,125 @@
+import argparse
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from image_annotator import ImageAnnotator
+
+# Checks the sensor panel background that ImageAnnotator draws from signed distances against the way it used to be
+# drawn, by PIL at 4 times the size and shrunk with a Lanczos filter, so changes to the renderer don't change the look.
+# Needs nothing but the annotator, so it can be run anywhere:
+#   python rounded_rect_check.py
+SUPERSAMPLE_SCALE = 4
+
+# How far the renderer can be from the old drawing, as the mean and the largest difference of any pixel channel (0-255,
+# with the color premultiplied by alpha). Straight edges, the stroke and the ringing inside it match to within
+# rounding. The differences are on the curve of the corners: PIL draws the arcs at 4 times the size a whole large pixel
+# (a quarter of a pixel here) in or out from a true circle depending on the radius, which moves the edge of a corner
+# pixel by up to about 40 on its own. Small panels are mostly corner, so their mean is the highest at just under 3
+MEAN_TOLERANCE = 3
+MAX_TOLERANCE = 45
+# Differences over this are counted and reported (they're all on the corners)
+VISIBLE_DIFFERENCE = 8
+
+# Panel sizes from the smallest the annotator draws (one sensor on a small image) to the largest (a dozen on 4K), with
+# the corner radius it uses for each of these image widths. Panels too small for the stroke to leave a gap inside
+# (under 6 pixels tall) are never drawn, and don't match as closely
+DEFAULT_IMAGE_WIDTHS = "320,640,1280,1920,3840"
+DEFAULT_PANEL_WIDTHS = "12,24,59,118,237,475,950"
+DEFAULT_PANEL_HEIGHTS = "6,11,22,45,90,180"
+STROKE_WIDTH = 2
+
+
+def parse_list(list_string):
+    return [int(item) for item in list_string.split(",") if len(item) > 0]
+
+
+def supersampled_rounded_rect(width, height, radius, stroke, stroke_width, fill):
+    # How ImageAnnotator drew the panel background before it was rendered from signed distances
+    im = Image.new("RGBA", ((SUPERSAMPLE_SCALE * width), (SUPERSAMPLE_SCALE * height)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(im, "RGBA")
+    draw.rounded_rectangle(
+        xy=(0, 0, im.width, im.height),
+        radius=(radius * SUPERSAMPLE_SCALE),
+        outline=stroke,
+        width=(stroke_width * SUPERSAMPLE_SCALE),
+        fill=fill
+    )
+    return im.resize((width, height), Image.LANCZOS)
+
+
+def premultiplied_pixels(image):
+    pixels = np.asarray(image, dtype=np.float32)
+    return np.concatenate(((pixels[..., :3] * (pixels[..., 3:] / 255)), pixels[..., 3:]), axis=2)
+
+
+def check_rounded_rect(width, height, radius):
+    # Returns the mean and largest difference from the old drawing, and how many pixel channels differ visibly
+    rect_args = dict(
+        width=width,
+        height=height,
+        radius=radius,
+        stroke=ImageAnnotator.SENSOR_OUTLINE_COLOR,
+        stroke_width=STROKE_WIDTH,
+        fill=ImageAnnotator.SENSOR_BACKGROUND_COLOR
+    )
+    difference = np.abs(
+        premultiplied_pixels(ImageAnnotator.antialiased_rounded_rect(**rect_args)) -
+        premultiplied_pixels(supersampled_rounded_rect(**rect_args))
+    )
+
+    return float(difference.mean()), float(difference.max()), int((difference > VISIBLE_DIFFERENCE).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the sensor panel background against the old supersampled rendering"
+    )
+    parser.add_argument("--image-widths", type=parse_list, default=DEFAULT_IMAGE_WIDTHS, dest="image_widths",
+                        help="Image widths to take the corner radius from, e.g. 640,1920")
+    parser.add_argument("--panel-widths", type=parse_list, default=DEFAULT_PANEL_WIDTHS, dest="panel_widths")
+    parser.add_argument("--panel-heights", type=parse_list, default=DEFAULT_PANEL_HEIGHTS, dest="panel_heights")
+    args = parser.parse_args()
+
+    num_checked = 0
+    num_failed = 0
+    worst_mean = 0
+    worst_max = 0
+    num_visible = 0
+    for image_width in args.image_widths:
+        radius = int(ImageAnnotator.IMAGE_WIDTH_TO_SENSOR_BOX_RADIUS_RATIO * image_width)
+        for width in args.panel_widths:
+            for height in args.panel_heights:
+                mean_difference, max_difference, visible_differences = check_rounded_rect(width, height, radius)
+                num_checked += 1
+                num_visible += visible_differences
+                worst_mean = max(worst_mean, mean_difference)
+                worst_max = max(worst_max, max_difference)
+
+                if (mean_difference > MEAN_TOLERANCE) or (max_difference > MAX_TOLERANCE):
+                    num_failed += 1
+                    print("{}x{} radius {} differs by {:.3f} on average, {:.0f} at most (OUT OF TOLERANCE)".format(
+                        width,
+                        height,
+                        radius,
+                        mean_difference,
+                        max_difference
+                    ))
+
+    print("{} of {} sizes out of tolerance, largest differences {:.3f} on average and {:.0f} at most, {} pixel "
+          "channels more than {} off in total".format(
+              num_failed,
+              num_checked,
+              worst_mean,
+              worst_max,
+              num_visible,
+              VISIBLE_DIFFERENCE
+          ))
+
+    if num_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from annotation_cache import AnnotationCache
+from autobloomer_snapper import CONFIG_FILE, SCRIPT_PATH, Snapper
+from controller_client import ControllerClient
+from file_utils import save_image_atomically
+from image_annotator import AnnotationDetails, ImageAnnotator
+from image_grabber import ImageGrabberFactory, SyntheticCameraOptions, SyntheticImageGrabber
+from rounded_rect_check import supersampled_rounded_rect
+from snapper_config import SnapperConfigOptions, SnapperConfigParseResponse
+from stand_in_controller import start_stand_in_controller, synthetic_controller_data
+
+# Times a whole snap and each of its stages against a stand-in controller running in this process, and writes the
+# results as JSON so runs from different commits can be compared (see --compare)
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_IMAGE_SIZES = "1920x1080,3840x2160"
+DEFAULT_SENSOR_COUNTS = "1,4,12"
+# Sensor panel sizes for one sensor on 1080p, a few on 4K and a dozen on 4K
+DEFAULT_PANEL_SIZES = "59x22,237x90,475x180"
+StageResult = namedtuple("StageResult", "stage image_size sensor_count times")
+
+
+def parse_list(list_string, item_parser):
+    return [item_parser(item) for item in list_string.split(",") if len(item) > 0]
+
+
+def parse_image_size(size_string):
+    width, height = size_string.lower().split("x")
+    return int(width), int(height)
+
+
+def time_stage(function, repeats, setup=None):
+    # Runs function repeats times and returns how long each run took in seconds. setup (if given) runs before each
+    # run, outside of the timing, and whatever it returns is passed to function
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup_result = setup()
+            start_time = time.perf_counter()
+            function(setup_result)
+        else:
+            start_time = time.perf_counter()
+            function()
+        times.append(time.perf_counter() - start_time)
+
+    return times
+
+
+def summarize(stage_result):
+    times = stage_result.times
+    return {
+        "stage": stage_result.stage,
+        "image_size": list(stage_result.image_size) if stage_result.image_size is not None else None,
+        "sensor_count": stage_result.sensor_count,
+        "repeats": len(times),
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "max": max(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0
+    }
+
+
+def result_key(result):
+    image_size = tuple(result["image_size"]) if result["image_size"] is not None else None
+    return result["stage"], image_size, result["sensor_count"]
+
+
+def git_commit():
+    try:
+        run_git = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SCRIPT_PATH,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        return None
+
+    return run_git.stdout.decode().strip() if run_git.returncode == 0 else None
+
+
+def benchmark_annotation_details(sensor_count):
+    annotation_details = AnnotationDetails("Benchmark Chamber", 42)
+    for count in range(sensor_count):
+        annotation_details.add_sensor_value(sensor_label="Sensor {}".format(count), sensor_value=(count * 10.25))
+
+    return annotation_details
+
+
+def benchmark_capture(grabber, image_size, repeats):
+    def capture_and_decode():
+        frame = grabber.capture_image(image_size[0], image_size[1])
+        frame.image.load()
+
+    return [
+        StageResult(
+            "capture",
+            image_size,
+            None,
+            time_stage(lambda: grabber.capture_image(image_size[0], image_size[1]), repeats)
+        ),
+        StageResult("capture_and_decode", image_size, None, time_stage(capture_and_decode, repeats))
+    ]
+
+
+class StepTimes(object):
+    # How long each step of ImageAnnotator.annotate_frame took, collected through its step_timer hook
+    def __init__(self):
+        self.times = defaultdict(list)
+
+    @contextmanager
+    def time_step(self, step_name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[step_name].append(time.perf_counter() - start_time)
+
+
+def benchmark_annotator(template_image, image_size, sensor_count, repeats):
+    annotation_details = benchmark_annotation_details(sensor_count)
+    image = template_image.resize(image_size)
+
+    def cold_frame():
+        # As the first snap of a new process, or after the fonts/logo changed: nothing is cached yet
+        ImageAnnotator.clear_caches()
+        return image.copy()
+
+    def annotate_frame(step_times):
+        return lambda frame_image: ImageAnnotator.annotate_frame(
+            frame_image,
+            annotation_details,
+            step_timer=step_times.time_step
+        )
+
+    cold_steps = StepTimes()
+    cold_times = time_stage(annotate_frame(cold_steps), repeats, setup=cold_frame)
+    # With the fonts, logo and static overlay already cached, as in a long running process
+    warm_steps = StepTimes()
+    warm_times = time_stage(annotate_frame(warm_steps), repeats, setup=image.copy)
+
+    stage_results = [
+        StageResult("annotate.cold", image_size, sensor_count, cold_times),
+        StageResult("annotate.total", image_size, sensor_count, warm_times),
+        StageResult("annotate.static_overlay_cold", image_size, sensor_count, cold_steps.times["static_overlay"])
+    ]
+    # The panel background is only drawn when the static overlay isn't cached (and there are sensors)
+    if "rounded_rect" in cold_steps.times:
+        stage_results.append(
+            StageResult("annotate.rounded_rect", image_size, sensor_count, cold_steps.times["rounded_rect"])
+        )
+    for step_name, times in warm_steps.times.items():
+        stage = "annotate.static_overlay_warm" if step_name == "static_overlay" else "annotate.{}".format(step_name)
+        stage_results.append(StageResult(stage, image_size, sensor_count, times))
+
+    return stage_results
+
+
+def benchmark_rounded_rect(image_size, panel_size, repeats):
+    # The sensor panel background as ImageAnnotator draws it, and as it used to be drawn at 4 times the size
+    rect_args = dict(
+        width=panel_size[0],
+        height=panel_size[1],
+        radius=int(ImageAnnotator.IMAGE_WIDTH_TO_SENSOR_BOX_RADIUS_RATIO * image_size[0]),
+        stroke=ImageAnnotator.SENSOR_OUTLINE_COLOR,
+        stroke_width=2,
+        fill=ImageAnnotator.SENSOR_BACKGROUND_COLOR
+    )
+    panel_name = "{}x{}".format(panel_size[0], panel_size[1])
+
+    return [
+        StageResult(
+            "rounded_rect.supersampled.{}".format(panel_name),
+            image_size,
+            None,
+            time_stage(lambda: supersampled_rounded_rect(**rect_args), repeats)
+        ),
+        StageResult(
+            "rounded_rect.sdf.{}".format(panel_name),
+            image_size,
+            None,
+            time_stage(lambda: ImageAnnotator.antialiased_rounded_rect(**rect_args), repeats)
+        )
+    ]
+
+
+def benchmark_encode(template_image, image_size, output_directory, repeats):
+    image = template_image.resize(image_size)
+    output_file = os.path.join(output_directory, "encode_benchmark.jpg")
+
+    return [
+        StageResult(
+            "encode.jpeg",
+            image_size,
+            None,
+            time_stage(lambda: image.save(io.BytesIO(), format="JPEG"), repeats)
+        ),
+        StageResult(
+            "save.jpeg",
+            image_size,
+            None,
+            time_stage(lambda: save_image_atomically(image, output_file), repeats)
+        )
+    ]
+
+
+def benchmark_controller(port, cache_directory, repeats):
+    client = ControllerClient(host="localhost", port=port)
+
+    try:
+        # Connect before timing anything, the connection is kept open between snaps
+        controller_data = client.get_controller_data()
+
+        def write_new_cache():
+            cache_file = os.path.join(cache_directory, AnnotationCache.CACHE_FILE)
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            return AnnotationCache(cache_directory)
+
+        def read_and_decode_cache():
+            cached_data = AnnotationCache(cache_directory).read()
+            _ = cached_data.grow_database
+            for sensor_id in cached_data.sensor_data:
+                _ = cached_data.sensor_data[sensor_id]
+
+        unchanged_cache = AnnotationCache(cache_directory)
+        sensor_data_protos = (
+            controller_data.sensor_data_protos if controller_data.sensor_data_protos is not None else {}
+        )
+
+        return [
+            StageResult(
+                "controller.get_grow_database",
+                None,
+                None,
+                time_stage(lambda: client.call("GetGrowDatabase"), repeats)
+            ),
+            StageResult(
+                "controller.get_sensor_snapshot",
+                None,
+                None,
+                time_stage(lambda: client.call("GetSensorSnapshot"), repeats)
+            ),
+            StageResult("controller.get_controller_data", None, None, time_stage(client.get_controller_data, repeats)),
+            StageResult(
+                "cache.write",
+                None,
+                None,
+                time_stage(
+                    lambda cache: cache.write(controller_data.grow_database_proto, sensor_data_protos),
+                    repeats,
+                    setup=write_new_cache
+                )
+            ),
+            StageResult(
+                "cache.write_unchanged",
+                None,
+                None,
+                time_stage(
+                    lambda: unchanged_cache.write(controller_data.grow_database_proto, sensor_data_protos),
+                    repeats
+                )
+            ),
+            StageResult("cache.read", None, None, time_stage(lambda: AnnotationCache(cache_directory).read(), repeats)),
+            StageResult("cache.read_and_decode", None, None, time_stage(read_and_decode_cache, repeats))
+        ]
+    finally:
+        client.close()
+
+
+def write_snap_config(config_file, port, grow_system_id, sensor_readings, sensor_count, image_destination):
+    # The configured readings are repeated (with different labels) until there are sensor_count of them
+    sensor_details = []
+    for count in range(sensor_count if len(sensor_readings) > 0 else 0):
+        sensor_reading = sensor_readings[count % len(sensor_readings)]
+        sensor_details.append({
+            SnapperConfigOptions.ConfigKeys.SENSOR_ID_KEY: sensor_reading.sensor_id,
+            SnapperConfigOptions.ConfigKeys.READING_ID_KEY: sensor_reading.reading_id,
+            SnapperConfigOptions.ConfigKeys.DISPLAY_NAME_KEY: "{} {}".format(
+                sensor_reading.display_name if sensor_reading.display_name else sensor_reading.reading_id,
+                count
+            )
+        })
+
+    with open(config_file, "w") as json_file:
+        json.dump({
+            SnapperConfigOptions.ConfigKeys.SERVER_OPTIONS_KEY: {
+                SnapperConfigOptions.ConfigKeys.HOST_NAME_KEY: "localhost",
+                SnapperConfigOptions.ConfigKeys.PORT_NUMBER_KEY: port
+            },
+            SnapperConfigOptions.ConfigKeys.DATA_OPTIONS_KEY: {
+                SnapperConfigOptions.ConfigKeys.GROW_SYSTEM_ID_KEY: grow_system_id,
+                SnapperConfigOptions.ConfigKeys.IMAGE_DESTINATION: image_destination,
+                SnapperConfigOptions.ConfigKeys.SENSOR_DETAILS_KEY: sensor_details
+            }
+        }, json_file)
+
+
+def benchmark_snap(config_file, camera_options, image_size, sensor_count, cache_directory, repeats):
+    def read_config():
+        config = SnapperConfigOptions()
+        if config.read_config(config_file) != SnapperConfigParseResponse.PARSE_OK:
+            raise ValueError("Could not read benchmark config {}".format(config_file))
+        return config
+
+    def main_flow():
+        # Everything main() does for a single snap, starting from nothing cached, as when run from cron
+        ImageAnnotator.clear_caches()
+        config = read_config()
+        image_grabbers = [
+            ImageGrabberFactory.get_image_grabber(synthetic_options=camera_options)
+            for _ in config.capture_targets
+        ]
+        snapper = Snapper(config, image_grabbers, cache_path=cache_directory, capture_size=image_size)
+        try:
+            snapper.snap()
+        finally:
+            snapper.close()
+
+    # Snaps in a long running process (daemon mode). Each one gets its own time so none overwrite each other
+    config = read_config()
+    image_grabbers = [SyntheticImageGrabber(camera_options) for _ in config.capture_targets]
+    snapper = Snapper(config, image_grabbers, cache_path=cache_directory, capture_size=image_size)
+    snap_times = iter(datetime(2000, 1, 1) + timedelta(minutes=count) for count in range(repeats + 1))
+    try:
+        snapper.snap(next(snap_times))
+        daemon_times = time_stage(lambda: snapper.snap(next(snap_times)), repeats)
+    finally:
+        snapper.close()
+
+    return [
+        StageResult("snap.main_flow", image_size, sensor_count, time_stage(main_flow, repeats)),
+        StageResult("snap.daemon", image_size, sensor_count, daemon_times)
+    ]
+
+
+def compare_results(results, baseline_file, tolerance):
+    # Prints every stage whose median got more than tolerance (a fraction) slower than in the baseline. Returns False
+    # if there were any
+    with open(baseline_file) as json_file:
+        baseline = json.load(json_file)
+
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = 0
+    for result in results:
+        baseline_result = baseline_results.get(result_key(result), None)
+        if baseline_result is None:
+            continue
+
+        change = (result["median"] - baseline_result["median"]) / baseline_result["median"]
+        if change > tolerance:
+            regressions += 1
+            print("Slower: {} size={} sensors={}: {:.2f}ms -> {:.2f}ms ({:+.0%})".format(
+                result["stage"],
+                result["image_size"],
+                result["sensor_count"],
+                baseline_result["median"] * 1000,
+                result["median"] * 1000,
+                change
+            ))
+
+    print("{} stage(s) slower than {} ({} commit {})".format(
+        regressions,
+        baseline_file,
+        baseline.get("timestamp", "?"),
+        baseline.get("git_commit", "?")
+    ))
+
+    return regressions == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AutoBloomer Snapper benchmarks")
+    parser.add_argument("-c", "--config-file", default=CONFIG_FILE, dest="snapper_config_file",
+                        help="Config to take the grow system and sensor readings from")
+    parser.add_argument("-a", "--cache-path", dest="cache_path",
+                        help="Serve the controller data in this snapper cache rather than made up data")
+    parser.add_argument("-d", "--dummy-camera-file", default=os.path.join(SCRIPT_PATH, "dummy-flower.jpg"),
+                        dest="dummy_camera_file", help="Image used as the camera picture")
+    parser.add_argument("--sizes", type=lambda x: parse_list(x, parse_image_size), default=DEFAULT_IMAGE_SIZES,
+                        dest="image_sizes", help="Image sizes to benchmark, e.g. 1920x1080,3840x2160")
+    parser.add_argument("--sensors", type=lambda x: parse_list(x, int), default=DEFAULT_SENSOR_COUNTS,
+                        dest="sensor_counts", help="Numbers of sensor readings to annotate, e.g. 1,4,12")
+    parser.add_argument("--panel-sizes", type=lambda x: parse_list(x, parse_image_size), default=DEFAULT_PANEL_SIZES,
+                        dest="panel_sizes", help="Sensor panel sizes to time the background of, e.g. 59x22,475x180")
+    parser.add_argument("--repeats", type=int, default=5, dest="repeats", help="Timed runs of each stage")
+    parser.add_argument("-o", "--output", dest="output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", dest="compare", help="Results JSON from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, dest="tolerance",
+                        help="Fraction a stage can slow down by before --compare reports it")
+    args = parser.parse_args()
+
+    config = SnapperConfigOptions()
+    config_response = config.read_config(args.snapper_config_file)
+    if config_response != SnapperConfigParseResponse.PARSE_OK:
+        print("Could not obtain snapper config: {}".format(config_response))
+        sys.exit(1)
+
+    if args.cache_path is not None:
+        cached_data = AnnotationCache(args.cache_path).read()
+        if cached_data is None:
+            print("No cached controller data found in {}".format(args.cache_path))
+            sys.exit(1)
+        grow_database, sensor_data = cached_data.grow_database, dict(cached_data.sensor_data)
+    else:
+        grow_database, sensor_data = synthetic_controller_data(config.grow_system_id, config.sensor_readings)
+
+    server, _, port = start_stand_in_controller(grow_database, sensor_data)
+    camera_options = SyntheticCameraOptions(pattern="template", template_file=args.dummy_camera_file, encode_jpeg=True)
+    template_grabber = SyntheticImageGrabber(camera_options)
+    template_image = template_grabber.capture_image(args.image_sizes[0][0], args.image_sizes[0][1]).image
+    template_image.load()
+    work_directory = tempfile.mkdtemp(prefix="snapper_benchmark_")
+
+    stage_results = [
+        StageResult(
+            "config.parse",
+            None,
+            None,
+            time_stage(lambda: SnapperConfigOptions().read_config(args.snapper_config_file), args.repeats)
+        )
+    ]
+    try:
+        stage_results.extend(benchmark_controller(port, work_directory, args.repeats))
+
+        for image_size in args.image_sizes:
+            print("Benchmarking {}x{}".format(image_size[0], image_size[1]))
+            stage_results.extend(benchmark_capture(template_grabber, image_size, args.repeats))
+            stage_results.extend(benchmark_encode(template_image, image_size, work_directory, args.repeats))
+            for panel_size in args.panel_sizes:
+                stage_results.extend(benchmark_rounded_rect(image_size, panel_size, args.repeats))
+
+            for sensor_count in args.sensor_counts:
+                stage_results.extend(benchmark_annotator(template_image, image_size, sensor_count, args.repeats))
+
+                config_file = os.path.join(work_directory, "benchmark_cfg.json")
+                image_destination = os.path.join(work_directory, "snaps")
+                os.makedirs(image_destination, exist_ok=True)
+                write_snap_config(
+                    config_file,
+                    port,
+                    config.grow_system_id,
+                    config.sensor_readings,
+                    sensor_count,
+                    image_destination
+                )
+                stage_results.extend(
+                    benchmark_snap(config_file, camera_options, image_size, sensor_count, work_directory, args.repeats)
+                )
+    finally:
+        server.stop(None)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    results = [summarize(stage_result) for stage_result in stage_results]
+    for result in results:
+        print("{:<34} {:<11} {:>7} {:>10.2f}ms".format(
+            result["stage"],
+            "x".join(str(x) for x in result["image_size"]) if result["image_size"] is not None else "-",
+            result["sensor_count"] if result["sensor_count"] is not None else "-",
+            result["median"] * 1000
+        ))
+
+    report = {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+        print("Results written to {}".format(args.output))
+
+    if (args.compare is not None) and not compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,29 @@
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import sys
+from collections import namedtuple
 from enum import Enum
 
-from pyproto.protomodel.helpers.data_factory import DataFactory
 from annotation_grabber import ReadingAnnotationDetails
+from burst_capture import BURST_METHODS, MAX_BURST_FRAMES, MAX_MEDIAN_FRAMES, BurstOptions
+from change_detector import UNCHANGED_ACTIONS, ChangeDetectionOptions
+from capture_scheduler import CronSchedule, IntervalSchedule, MissedTickPolicy
+from image_grabber import CAMERA_SESSION_MODES, CameraSessionOptions, SyntheticCameraOptions
+from snapshot_retention import RetentionOptions
+from snapshot_uploader import UploadOptions
+from image_encoder import ENCODER_PARAMS, IMAGE_FORMAT_EXTENSIONS, encoder_params_valid, format_available
+from file_utils import write_file_atomically
+from output_pyramid import FULL_SIZE_OUTPUT, OutputLevel
+
+# One camera pointed at one grow system
+CaptureTarget = namedtuple(
+    "CaptureTarget",
+    "name grow_system_id image_destination sensor_readings camera_index dummy_camera_file synthetic_camera "
+    "camera_session burst"
+)
 
 
 class SnapperConfigParseResponse(str, Enum):
@@ -11,14 +33,36 @@ class SnapperConfigParseResponse(str, Enum):
     ERROR_NO_DATA_OPTIONS = " Error: No data options"
     ERROR_SERVER_OPTIONS_MISSING = "Error: Server options missing required parameters"
     ERROR_DATA_OPTIONS_MISSING = "Error: Data options missing required parameters"
+    ERROR_SCHEDULE_OPTIONS_INVALID = "Error: Schedule options invalid"
+    ERROR_CAPTURE_TARGETS_INVALID = "Error: Capture targets missing required parameters"
+    ERROR_OUTPUT_OPTIONS_INVALID = "Error: Output options invalid"
+    ERROR_CAMERA_SESSION_INVALID = "Error: Camera session mode invalid"
+    ERROR_RETENTION_OPTIONS_INVALID = "Error: Retention options invalid"
+    ERROR_CHANGE_DETECTION_OPTIONS_INVALID = "Error: Change detection options invalid"
+    ERROR_BURST_OPTIONS_INVALID = "Error: Burst options invalid"
 
 
 class SnapperConfigOptions(object):
+    DEFAULT_CAPTURE_TIMEOUT = 60
+    DEFAULT_ANNOTATION_TIMEOUT = 20
+    DEFAULT_RPC_DEADLINE = 10
+    DEFAULT_CACHE_TTL = 0
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_FAILURE_BACKOFF = 300
+
+    # Bumped whenever the layout of the config snapshots changes
+    SNAPSHOT_VERSION = 1
+
     class ConfigKeys(str, Enum):
         SERVER_OPTIONS_KEY = "server_options"
         HOST_NAME_KEY = "host_name"
         PORT_NUMBER_KEY = "port_number"
         SERVER_PASSPHRASE_KEY = "server_passphrase"
+        ANNOTATION_TIMEOUT_KEY = "annotation_timeout"
+        RPC_DEADLINE_KEY = "rpc_deadline"
+        CACHE_TTL_KEY = "cache_ttl"
+        FAILURE_THRESHOLD_KEY = "failure_threshold"
+        FAILURE_BACKOFF_KEY = "failure_backoff"
         DATA_OPTIONS_KEY = "data_options"
         GROW_SYSTEM_ID_KEY = "grow_system_id"
         SENSOR_DETAILS_KEY = "sensor_details"
@@ -26,25 +70,153 @@ class SnapperConfigOptions(object):
         READING_ID_KEY = "reading_id"
         DISPLAY_NAME_KEY = "annotation_label"
         IMAGE_DESTINATION = "image_destination"
+        KEEP_RAW_CAPTURE_KEY = "keep_raw_capture"
+        SNAPSHOT_INDEX_FILE_KEY = "snapshot_index_file"
+        CAPTURE_TIMEOUT_KEY = "capture_timeout"
+        ANNOTATION_WORKERS_KEY = "annotation_workers"
+        CAPTURE_TARGETS_KEY = "capture_targets"
+        TARGET_NAME_KEY = "name"
+        CAMERA_INDEX_KEY = "camera"
+        DUMMY_CAMERA_FILE_KEY = "dummy_camera_file"
+        SYNTHETIC_CAMERA_KEY = "synthetic_camera"
+        CAMERA_SESSION_KEY = "camera_session"
+        CAMERA_SESSION_MODE_KEY = "mode"
+        BURST_KEY = "burst"
+        OUTPUTS_KEY = "outputs"
+        OUTPUT_NAME_KEY = "name"
+        OUTPUT_REDUCE_KEY = "reduce"
+        OUTPUT_FORMAT_KEY = "format"
+        RERENDER_OVERLAY_KEY = "rerender_overlay"
+        SCHEDULE_OPTIONS_KEY = "schedule_options"
+        METRICS_OPTIONS_KEY = "metrics_options"
+        UPLOAD_OPTIONS_KEY = "upload_options"
+        RETENTION_OPTIONS_KEY = "retention_options"
+        CHANGE_DETECTION_OPTIONS_KEY = "change_detection_options"
+        JSON_LINES_FILE_KEY = "json_lines_file"
+        PROMETHEUS_TEXTFILE_KEY = "prometheus_textfile"
+        INTERVAL_SECONDS_KEY = "interval_seconds"
+        CRON_KEY = "cron"
+        MISSED_TICK_POLICY_KEY = "missed_tick_policy"
 
-    def __init__(self, data_root):
+    def __init__(self):
         self.options_parsed = False
-        self.data_factory = DataFactory(data_root)
+        self.from_snapshot = False
 
         self.host_name = None
         self.port_number = None
         self.passphrase = None
+        self.annotation_timeout = SnapperConfigOptions.DEFAULT_ANNOTATION_TIMEOUT
+        self.rpc_deadline = SnapperConfigOptions.DEFAULT_RPC_DEADLINE
+        self.cache_ttl = SnapperConfigOptions.DEFAULT_CACHE_TTL
+        self.failure_threshold = SnapperConfigOptions.DEFAULT_FAILURE_THRESHOLD
+        self.failure_backoff = SnapperConfigOptions.DEFAULT_FAILURE_BACKOFF
         self.grow_system_id = None
         self.image_destination = None
+        self.keep_raw_capture = False
+        self.snapshot_index_file = None
+        self.capture_timeout = SnapperConfigOptions.DEFAULT_CAPTURE_TIMEOUT
+        self.annotation_workers = None
+        self.capture_targets = []
+        self.output_levels = [FULL_SIZE_OUTPUT]
+        self.rerender_overlay = True
         self.sensor_readings = []
+        self.capture_schedule = None
+        self.missed_tick_policy = MissedTickPolicy.SKIP
+        self.metrics_json_lines_file = None
+        self.metrics_prometheus_textfile = None
+        self.upload_options = None
+        self.retention_options = None
+        self.change_detection_options = None
 
-    def read_config(self, file_name):
+    def read_config(self, file_name, snapshot_file=None):
+        # With a snapshot file, the options are loaded as they were after the last successful parse of the same config
+        # instead, which skips the parsing and validation (and the imports the validation needs). The snapshot is only
+        # used while the config file and the snapper's own code are exactly as they were when it was written
         self.options_parsed = False
+        self.from_snapshot = False
+
+        try:
+            with open(file_name, "rb") as f:
+                config_data = f.read()
+        except OSError:
+            return SnapperConfigParseResponse.ERROR_JSON_UNREADABLE
+
+        snapshot_key = None
+        if snapshot_file is not None:
+            snapshot_key = SnapperConfigOptions._snapshot_key(file_name, config_data)
+            if self._load_snapshot(snapshot_file, snapshot_key):
+                return SnapperConfigParseResponse.PARSE_OK
 
-        config_dict = self.data_factory.container_from_json_file(file_name=file_name)
-        if config_dict is None:
+        try:
+            config_dict = json.loads(config_data)
+        except ValueError:
             return SnapperConfigParseResponse.ERROR_JSON_UNREADABLE
+        if not isinstance(config_dict, dict):
+            return SnapperConfigParseResponse.ERROR_JSON_UNREADABLE
+
+        config_response = self._parse_config(config_dict)
+        if (config_response == SnapperConfigParseResponse.PARSE_OK) and (snapshot_file is not None):
+            self._save_snapshot(snapshot_file, snapshot_key)
+
+        return config_response
+
+    @staticmethod
+    def _snapshot_key(file_name, config_data):
+        # Everything the parsed options depend on: the config itself, the snapper's code (the option types and their
+        # validation), and the Python and Pillow it runs on (Pillow decides which image formats are available)
+        code_directory = os.path.dirname(os.path.abspath(__file__))
+        stamp_files = sorted(os.path.join(code_directory, x) for x in os.listdir(code_directory) if x.endswith(".py"))
+        pillow_spec = importlib.util.find_spec("PIL")
+        if (pillow_spec is not None) and (pillow_spec.origin is not None):
+            stamp_files.append(pillow_spec.origin)
+
+        stamps = []
+        for stamp_file in stamp_files:
+            stat = os.stat(stamp_file)
+            stamps.append((stamp_file, stat.st_mtime_ns, stat.st_size))
+
+        return (
+            SnapperConfigOptions.SNAPSHOT_VERSION,
+            sys.version,
+            os.path.abspath(file_name),
+            hashlib.sha256(config_data).hexdigest(),
+            stamps
+        )
+
+    def _load_snapshot(self, snapshot_file, snapshot_key):
+        # Snapshots are only ever written by _save_snapshot, into the snapper's own cache. Anything unreadable or out
+        # of date is ignored and the config is parsed as normal
+        try:
+            with open(snapshot_file, "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError,
+                ValueError):
+            return False
+
+        if (not isinstance(snapshot, dict)) or (snapshot.get("key", None) != snapshot_key):
+            return False
+
+        self.__dict__.update(snapshot["options"])
+        self.options_parsed = True
+        self.from_snapshot = True
+
+        return True
+
+    def _save_snapshot(self, snapshot_file, snapshot_key):
+        snapshot = {
+            "key": snapshot_key,
+            "options": {
+                key: value for key, value in vars(self).items() if key not in ("options_parsed", "from_snapshot")
+            }
+        }
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(snapshot_file)), exist_ok=True)
+            write_file_atomically(snapshot_file, pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+        except (OSError, pickle.PicklingError) as e:
+            print("Could not save config snapshot: {}".format(e))
 
+    def _parse_config(self, config_dict):
         server_options = config_dict.get(SnapperConfigOptions.ConfigKeys.SERVER_OPTIONS_KEY, None)
         if server_options is None:
             return SnapperConfigParseResponse.ERROR_NO_SERVER_OPTIONS
@@ -66,18 +238,161 @@ class SnapperConfigOptions(object):
         if not all(item in server_options.keys() for item in server_options_required):
             return SnapperConfigParseResponse.ERROR_SERVER_OPTIONS_MISSING
 
-        if not all(item in data_options.keys() for item in data_options_required):
+        # With a list of capture targets the grow system and destination are given per target instead
+        target_params = data_options.get(SnapperConfigOptions.ConfigKeys.CAPTURE_TARGETS_KEY, None)
+        if target_params is not None:
+            if len(target_params) == 0:
+                return SnapperConfigParseResponse.ERROR_CAPTURE_TARGETS_INVALID
+
+            for target_param in target_params:
+                if not all(item in target_param.keys() for item in data_options_required):
+                    return SnapperConfigParseResponse.ERROR_CAPTURE_TARGETS_INVALID
+        elif not all(item in data_options.keys() for item in data_options_required):
             return SnapperConfigParseResponse.ERROR_DATA_OPTIONS_MISSING
 
+        target_bursts = []
+        for target_param in (target_params if target_params is not None else [data_options]):
+            session_params = target_param.get(SnapperConfigOptions.ConfigKeys.CAMERA_SESSION_KEY, {})
+            session_mode = session_params.get(SnapperConfigOptions.ConfigKeys.CAMERA_SESSION_MODE_KEY, "oneshot")
+            if session_mode not in CAMERA_SESSION_MODES:
+                return SnapperConfigParseResponse.ERROR_CAMERA_SESSION_INVALID
+
+            burst_params = target_param.get(SnapperConfigOptions.ConfigKeys.BURST_KEY, None)
+            burst_options = None
+            if burst_params is not None:
+                burst_options = SnapperConfigOptions._read_burst_options(burst_params)
+                if burst_options is None:
+                    return SnapperConfigParseResponse.ERROR_BURST_OPTIONS_INVALID
+            target_bursts.append(burst_options)
+
         # Server options
         self.host_name = server_options[SnapperConfigOptions.ConfigKeys.HOST_NAME_KEY]
         self.port_number = server_options[SnapperConfigOptions.ConfigKeys.PORT_NUMBER_KEY]
         self.passphrase = server_options.get(SnapperConfigOptions.ConfigKeys.SERVER_PASSPHRASE_KEY, None)
+        self.annotation_timeout = server_options.get(
+            SnapperConfigOptions.ConfigKeys.ANNOTATION_TIMEOUT_KEY,
+            SnapperConfigOptions.DEFAULT_ANNOTATION_TIMEOUT
+        )
+        self.rpc_deadline = server_options.get(
+            SnapperConfigOptions.ConfigKeys.RPC_DEADLINE_KEY,
+            SnapperConfigOptions.DEFAULT_RPC_DEADLINE
+        )
+        self.cache_ttl = server_options.get(
+            SnapperConfigOptions.ConfigKeys.CACHE_TTL_KEY,
+            SnapperConfigOptions.DEFAULT_CACHE_TTL
+        )
+        self.failure_threshold = server_options.get(
+            SnapperConfigOptions.ConfigKeys.FAILURE_THRESHOLD_KEY,
+            SnapperConfigOptions.DEFAULT_FAILURE_THRESHOLD
+        )
+        self.failure_backoff = server_options.get(
+            SnapperConfigOptions.ConfigKeys.FAILURE_BACKOFF_KEY,
+            SnapperConfigOptions.DEFAULT_FAILURE_BACKOFF
+        )
 
         # Data options
-        self.grow_system_id = data_options[SnapperConfigOptions.ConfigKeys.GROW_SYSTEM_ID_KEY]
-        self.image_destination = data_options[SnapperConfigOptions.ConfigKeys.IMAGE_DESTINATION]
-        reading_params = data_options.get(SnapperConfigOptions.ConfigKeys.SENSOR_DETAILS_KEY, None)
+        self.keep_raw_capture = data_options.get(SnapperConfigOptions.ConfigKeys.KEEP_RAW_CAPTURE_KEY, False)
+        self.snapshot_index_file = data_options.get(SnapperConfigOptions.ConfigKeys.SNAPSHOT_INDEX_FILE_KEY, None)
+        self.capture_timeout = data_options.get(
+            SnapperConfigOptions.ConfigKeys.CAPTURE_TIMEOUT_KEY,
+            SnapperConfigOptions.DEFAULT_CAPTURE_TIMEOUT
+        )
+        self.annotation_workers = data_options.get(SnapperConfigOptions.ConfigKeys.ANNOTATION_WORKERS_KEY, None)
+        default_sensor_readings = SnapperConfigOptions._read_sensor_readings(
+            data_options.get(SnapperConfigOptions.ConfigKeys.SENSOR_DETAILS_KEY, None)
+        )
+
+        # Built up separately, so reading the config again replaces the targets rather than adding to them
+        if target_params is None:
+            target_params = [data_options]
+        capture_targets = []
+        for count, target_param in enumerate(target_params):
+            target_reading_params = target_param.get(SnapperConfigOptions.ConfigKeys.SENSOR_DETAILS_KEY, None)
+            capture_targets.append(
+                CaptureTarget(
+                    name=target_param.get(SnapperConfigOptions.ConfigKeys.TARGET_NAME_KEY, "target{}".format(count)),
+                    grow_system_id=target_param[SnapperConfigOptions.ConfigKeys.GROW_SYSTEM_ID_KEY],
+                    image_destination=target_param[SnapperConfigOptions.ConfigKeys.IMAGE_DESTINATION],
+                    sensor_readings=(
+                        SnapperConfigOptions._read_sensor_readings(target_reading_params)
+                        if target_reading_params is not None else default_sensor_readings
+                    ),
+                    camera_index=target_param.get(SnapperConfigOptions.ConfigKeys.CAMERA_INDEX_KEY, None),
+                    dummy_camera_file=target_param.get(SnapperConfigOptions.ConfigKeys.DUMMY_CAMERA_FILE_KEY, None),
+                    synthetic_camera=SnapperConfigOptions._read_synthetic_camera(
+                        target_param.get(SnapperConfigOptions.ConfigKeys.SYNTHETIC_CAMERA_KEY, None)
+                    ),
+                    camera_session=SnapperConfigOptions._read_camera_session(
+                        target_param.get(SnapperConfigOptions.ConfigKeys.CAMERA_SESSION_KEY, None)
+                    ),
+                    burst=target_bursts[count]
+                )
+            )
+        self.capture_targets = capture_targets
+
+        output_params = data_options.get(SnapperConfigOptions.ConfigKeys.OUTPUTS_KEY, None)
+        if output_params is not None:
+            output_levels = SnapperConfigOptions._read_output_levels(output_params)
+            if output_levels is None:
+                return SnapperConfigParseResponse.ERROR_OUTPUT_OPTIONS_INVALID
+            self.output_levels = output_levels
+        self.rerender_overlay = data_options.get(SnapperConfigOptions.ConfigKeys.RERENDER_OVERLAY_KEY, True)
+
+        # The first target doubles as the single target of the original config layout
+        self.grow_system_id = self.capture_targets[0].grow_system_id
+        self.image_destination = self.capture_targets[0].image_destination
+        self.sensor_readings = self.capture_targets[0].sensor_readings
+
+        # Schedule options (optional, only used in daemon mode)
+        schedule_options = config_dict.get(SnapperConfigOptions.ConfigKeys.SCHEDULE_OPTIONS_KEY, None)
+        if schedule_options is not None:
+            if not self._read_schedule_options(schedule_options):
+                return SnapperConfigParseResponse.ERROR_SCHEDULE_OPTIONS_INVALID
+
+        # Metrics options (optional, no metrics are recorded without them)
+        metrics_options = config_dict.get(SnapperConfigOptions.ConfigKeys.METRICS_OPTIONS_KEY, {})
+        self.metrics_json_lines_file = metrics_options.get(SnapperConfigOptions.ConfigKeys.JSON_LINES_FILE_KEY, None)
+        self.metrics_prometheus_textfile = metrics_options.get(
+            SnapperConfigOptions.ConfigKeys.PROMETHEUS_TEXTFILE_KEY,
+            None
+        )
+
+        # Upload options (optional, nothing is uploaded without them). The keys are the same as the UploadOptions
+        # fields, anything left out keeps its default
+        upload_params = config_dict.get(SnapperConfigOptions.ConfigKeys.UPLOAD_OPTIONS_KEY, None)
+        if upload_params is not None:
+            self.upload_options = UploadOptions(**{
+                key: value for key, value in upload_params.items() if key in UploadOptions._fields
+            })
+
+        # Retention options (optional, snapshots are kept forever without them)
+        retention_params = config_dict.get(SnapperConfigOptions.ConfigKeys.RETENTION_OPTIONS_KEY, None)
+        if retention_params is not None:
+            self.retention_options = SnapperConfigOptions._read_retention_options(retention_params)
+            if self.retention_options is None:
+                return SnapperConfigParseResponse.ERROR_RETENTION_OPTIONS_INVALID
+
+        # Change detection options (optional, every capture is stored without them)
+        change_detection_params = config_dict.get(SnapperConfigOptions.ConfigKeys.CHANGE_DETECTION_OPTIONS_KEY, None)
+        if change_detection_params is not None:
+            self.change_detection_options = ChangeDetectionOptions(**{
+                key: value for key, value in change_detection_params.items() if key in ChangeDetectionOptions._fields
+            })
+            if (
+                (self.change_detection_options.unchanged_action not in UNCHANGED_ACTIONS) or
+                (not isinstance(self.change_detection_options.max_difference, (int, float))) or
+                (not isinstance(self.change_detection_options.max_unchanged_seconds, (int, float)))
+            ):
+                return SnapperConfigParseResponse.ERROR_CHANGE_DETECTION_OPTIONS_INVALID
+
+        self.options_parsed = True
+
+        return SnapperConfigParseResponse.PARSE_OK
+
+    @staticmethod
+    def _read_sensor_readings(reading_params):
+        sensor_readings = []
+
         if reading_params is not None:
             for reading_param in reading_params:
                 sensor_id = reading_param.get(SnapperConfigOptions.ConfigKeys.SENSOR_ID_KEY, None)
@@ -85,7 +400,7 @@ class SnapperConfigOptions(object):
                 display_name = reading_param.get(SnapperConfigOptions.ConfigKeys.DISPLAY_NAME_KEY, None)
 
                 if sensor_id is not None and reading_id is not None:
-                    self.sensor_readings.append(
+                    sensor_readings.append(
                         ReadingAnnotationDetails(
                             sensor_id=sensor_id,
                             reading_id=reading_id,
@@ -93,6 +408,133 @@ class SnapperConfigOptions(object):
                         )
                     )
 
-        self.options_parsed = True
+        return sensor_readings
 
-        return SnapperConfigParseResponse.PARSE_OK
+    @staticmethod
+    def _read_synthetic_camera(synthetic_params):
+        # The keys are the same as the SyntheticCameraOptions fields, anything left out keeps its default
+        if synthetic_params is None:
+            return None
+
+        return SyntheticCameraOptions(**{
+            key: value for key, value in synthetic_params.items() if key in SyntheticCameraOptions._fields
+        })
+
+    @staticmethod
+    def _read_camera_session(session_params):
+        # The keys are the same as the CameraSessionOptions fields, anything left out keeps its default
+        if session_params is None:
+            return None
+
+        return CameraSessionOptions(**{
+            key: value for key, value in session_params.items() if key in CameraSessionOptions._fields
+        })
+
+    @staticmethod
+    def _read_burst_options(burst_params):
+        # The keys are the same as the BurstOptions fields, anything left out keeps its default. Returns None if any of
+        # the options are invalid
+        if not isinstance(burst_params, dict):
+            return None
+
+        burst_options = BurstOptions(**{
+            key: value for key, value in burst_params.items() if key in BurstOptions._fields
+        })
+        if (
+            (not isinstance(burst_options.frames, int)) or
+            (not 1 <= burst_options.frames <= MAX_BURST_FRAMES) or
+            (burst_options.method not in BURST_METHODS) or
+            ((burst_options.method == "median") and (burst_options.frames > MAX_MEDIAN_FRAMES)) or
+            (not isinstance(burst_options.sigma, (int, float))) or
+            (burst_options.sigma <= 0) or
+            (not isinstance(burst_options.max_shift, int)) or
+            (burst_options.max_shift < 0) or
+            (not isinstance(burst_options.interval_seconds, (int, float))) or
+            (burst_options.interval_seconds < 0)
+        ):
+            return None
+
+        return burst_options
+
+    @staticmethod
+    def _read_retention_options(retention_params):
+        # The keys are the same as the RetentionOptions fields, anything left out keeps its default. Returns None if
+        # any of the options are invalid
+        retention_options = RetentionOptions(**{
+            key: value for key, value in retention_params.items() if key in RetentionOptions._fields
+        })
+        retention_options = retention_options._replace(archive_format=retention_options.archive_format.upper())
+
+        numeric_options = [
+            x for x in retention_options._replace(archive_format=None, archive_quality=None) if x is not None
+        ]
+        if (
+            (retention_options.archive_format not in IMAGE_FORMAT_EXTENSIONS) or
+            (not format_available(retention_options.archive_format)) or
+            (not all(isinstance(x, (int, float)) and (x >= 0) for x in numeric_options)) or
+            (retention_options.interval_seconds is None) or
+            (retention_options.interval_seconds <= 0)
+        ):
+            return None
+
+        return retention_options
+
+    @staticmethod
+    def _read_output_levels(output_params):
+        # Returns None if any of the levels are invalid
+        if len(output_params) == 0:
+            return None
+
+        output_levels = []
+        for output_param in output_params:
+            name = output_param.get(SnapperConfigOptions.ConfigKeys.OUTPUT_NAME_KEY, None)
+            reduce_factor = output_param.get(SnapperConfigOptions.ConfigKeys.OUTPUT_REDUCE_KEY, 1)
+            image_format = output_param.get(SnapperConfigOptions.ConfigKeys.OUTPUT_FORMAT_KEY, "JPEG").upper()
+
+            # Any encoder settings for the format are given alongside the other keys (e.g. "quality", "progressive")
+            save_params = {
+                key: value for key, value in output_param.items() if key in ENCODER_PARAMS.get(image_format, {})
+            }
+
+            if (
+                (name is None) or
+                (not isinstance(reduce_factor, int)) or
+                (reduce_factor < 1) or
+                (image_format not in IMAGE_FORMAT_EXTENSIONS) or
+                (not format_available(image_format)) or
+                (not encoder_params_valid(image_format, save_params))
+            ):
+                return None
+
+            output_levels.append(
+                OutputLevel(
+                    name=name,
+                    reduce_factor=reduce_factor,
+                    image_format=image_format,
+                    save_params=save_params
+                )
+            )
+
+        return output_levels
+
+    def _read_schedule_options(self, schedule_options):
+        interval_seconds = schedule_options.get(SnapperConfigOptions.ConfigKeys.INTERVAL_SECONDS_KEY, None)
+        cron_expression = schedule_options.get(SnapperConfigOptions.ConfigKeys.CRON_KEY, None)
+
+        # Exactly one of the schedule types must be given
+        if (interval_seconds is None) == (cron_expression is None):
+            return False
+
+        try:
+            if interval_seconds is not None:
+                self.capture_schedule = IntervalSchedule(interval_seconds)
+            else:
+                self.capture_schedule = CronSchedule(cron_expression)
+
+            self.missed_tick_policy = MissedTickPolicy(
+                schedule_options.get(SnapperConfigOptions.ConfigKeys.MISSED_TICK_POLICY_KEY, MissedTickPolicy.SKIP)
+            )
+        except (TypeError, ValueError):
+            return False
+
+        return True
@@ -0,0 +1,304 @@
+import json
+import os
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+from file_utils import write_file_atomically
+
+# Timing spans for the stages of a snap. Spans are only recorded on a thread with an active recorder (see
+# start_recording and bind_recorder), otherwise span() does nothing but check a thread local, so instrumented code costs
+# next to nothing when metrics are off. Background threads that aren't part of a snap (uploads, annotation refreshes)
+# never have one, so their spans don't end up in whichever snap happens to be running. start_time is wall clock time
+# so spans recorded in worker processes line up with the ones recorded here. peak_rss_kb is the most resident memory
+# the process that recorded the span used during it (see PeakMemoryTracker). fields holds anything else worth keeping
+# about the stage (byte counts, target name, error...)
+Span = namedtuple("Span", "name start_time duration peak_rss_kb fields")
+
+_thread_state = threading.local()
+
+
+class MetricsRecorder(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._spans = []
+
+    def add_span(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def add_spans(self, spans):
+        with self._lock:
+            self._spans.extend(spans)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+
+def _active_recorder():
+    return getattr(_thread_state, "recorder", None)
+
+
+def start_recording():
+    # Spans recorded on this thread go to the new recorder until stop_recording
+    _thread_state.recorder = MetricsRecorder()
+    return _thread_state.recorder
+
+
+def stop_recording():
+    recorder = _active_recorder()
+    _thread_state.recorder = None
+    return recorder
+
+
+def bind_recorder(function):
+    # For work a snap hands to other threads (e.g. executor.submit(bind_recorder(function), ...)). The returned function
+    # records its spans to the recorder that is active here, on whichever thread it runs
+    recorder = _active_recorder()
+    if recorder is None:
+        return function
+
+    def call_with_recorder(*args, **kwargs):
+        previous_recorder = _active_recorder()
+        _thread_state.recorder = recorder
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _thread_state.recorder = previous_recorder
+
+    return call_with_recorder
+
+
+# Peak resident memory for each span, from the high water mark the kernel keeps for the process (VmHWM), which writing
+# "5" to /proc/self/clear_refs resets. There is only the one mark but spans overlap (nested, or on other threads), so
+# before it is reset for a new span the peak so far is handed to every span still open. Linux only, anywhere else the
+# peak is None
+class PeakMemoryTracker(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open_peaks = {}
+        self._next_token = 0
+
+    @staticmethod
+    def _high_water_mark_kb():
+        try:
+            with open("/proc/self/status", "rb") as f:
+                for line in f:
+                    if line.startswith(b"VmHWM:"):
+                        return int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+
+        return None
+
+    @staticmethod
+    def _reset_high_water_mark():
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+    def start(self):
+        # Returns a token for finish, None if peaks can't be measured here
+        with self._lock:
+            high_water_mark = PeakMemoryTracker._high_water_mark_kb()
+            if high_water_mark is None:
+                return None
+
+            for token, peak in self._open_peaks.items():
+                self._open_peaks[token] = max(peak, high_water_mark)
+            if not PeakMemoryTracker._reset_high_water_mark():
+                return None
+
+            token = self._next_token
+            self._next_token += 1
+            self._open_peaks[token] = 0
+            return token
+
+    def finish(self, token):
+        # The peak in kilobytes since start returned token
+        if token is None:
+            return None
+
+        with self._lock:
+            peak = self._open_peaks.pop(token)
+            high_water_mark = PeakMemoryTracker._high_water_mark_kb()
+            return max(peak, high_water_mark) if high_water_mark is not None else None
+
+
+_peak_memory = PeakMemoryTracker()
+
+
+def _reset_after_fork():
+    # A worker process forked while another thread held the tracker's lock would otherwise wait on it forever, and the
+    # spans that were open belong to the parent
+    global _peak_memory
+    _peak_memory = PeakMemoryTracker()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _record(recorder, name, start_time, start_counter, peak_token, fields):
+    recorder.add_span(Span(
+        name=name,
+        start_time=start_time,
+        duration=(time.perf_counter() - start_counter),
+        peak_rss_kb=_peak_memory.finish(peak_token),
+        fields=fields
+    ))
+
+
+@contextmanager
+def span(name, **fields):
+    # Times the body of the with block. The fields dict is handed to the block so it can add to it, e.g.
+    #   with span("capture") as span_fields:
+    #       span_fields["bytes"] = len(data)
+    recorder = _active_recorder()
+    if recorder is None:
+        yield fields
+        return
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    peak_token = _peak_memory.start()
+    try:
+        yield fields
+    except BaseException as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        _record(recorder, name, start_time, start_counter, peak_token, fields)
+
+
+def record_future(future, name, **fields):
+    # For calls that run in the background (e.g. gRPC futures). Call straight after starting the call, the span ends
+    # when the future completes. The response size is recorded if the result is a protobuf message
+    recorder = _active_recorder()
+    if recorder is None:
+        return
+
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    peak_token = _peak_memory.start()
+
+    def future_done(done_future):
+        try:
+            fields["bytes"] = done_future.result().ByteSize()
+        except AttributeError:
+            pass
+        except Exception as e:
+            fields["error"] = type(e).__name__
+        _record(recorder, name, start_time, start_counter, peak_token, fields)
+
+    future.add_done_callback(future_done)
+
+
+def call_with_spans(span_name, span_fields, function, *args):
+    # Runs function (typically in a worker process) in a span of its own, with its own recorder. Returns the function's
+    # result along with the spans it recorded, for the caller to merge into its own recorder with add_spans
+    recorder = start_recording()
+    try:
+        with span(span_name, **span_fields):
+            result = function(*args)
+    finally:
+        stop_recording()
+
+    return result, recorder.spans()
+
+
+def add_spans(spans):
+    recorder = _active_recorder()
+    if recorder is not None:
+        recorder.add_spans(spans)
+
+
+class MetricsExporter(object):
+    METRIC_PREFIX = "autobloomer_snapper"
+
+    # json_lines_file gets one line per snap with all of its spans. prometheus_textfile is rewritten after every snap
+    # with the latest values, for node_exporter's textfile collector (it must end in .prom and be in the collector's
+    # directory)
+    def __init__(self, json_lines_file=None, prometheus_textfile=None):
+        self.json_lines_file = json_lines_file
+        self.prometheus_textfile = prometheus_textfile
+
+    def export(self, recorder, snap_time, succeeded):
+        spans = sorted(recorder.spans(), key=lambda x: x.start_time)
+
+        try:
+            if self.json_lines_file is not None:
+                self._write_json_line(recorder, spans, snap_time, succeeded)
+            if self.prometheus_textfile is not None:
+                self._write_prometheus_textfile(spans, succeeded)
+        except OSError as e:
+            print("Could not write metrics: {}".format(e))
+
+    def _write_json_line(self, recorder, spans, snap_time, succeeded):
+        line = json.dumps({
+            "snap_time": snap_time.isoformat(timespec="seconds"),
+            "start_time": recorder.start_time,
+            "succeeded": succeeded,
+            "spans": [
+                dict(
+                    name=x.name,
+                    offset=round(x.start_time - recorder.start_time, 6),
+                    duration=round(x.duration, 6),
+                    peak_rss_kb=x.peak_rss_kb,
+                    **x.fields
+                )
+                for x in spans
+            ]
+        })
+
+        with open(self.json_lines_file, "a") as f:
+            f.write(line + "\n")
+
+    def _write_prometheus_textfile(self, spans, succeeded):
+        # Spans with the same name (e.g. one capture per target) are added together
+        durations = OrderedDict()
+        byte_counts = OrderedDict()
+        for x in spans:
+            durations[x.name] = durations.get(x.name, 0) + x.duration
+            if "bytes" in x.fields:
+                byte_counts[x.name] = byte_counts.get(x.name, 0) + x.fields["bytes"]
+        peak_rss_kbs = [x.peak_rss_kb for x in spans if x.peak_rss_kb is not None]
+
+        prefix = MetricsExporter.METRIC_PREFIX
+        lines = [
+            "# HELP {}_last_snap_timestamp_seconds When the last snap finished".format(prefix),
+            "# TYPE {}_last_snap_timestamp_seconds gauge".format(prefix),
+            "{}_last_snap_timestamp_seconds {:.3f}".format(prefix, time.time()),
+            "# HELP {}_last_snap_success Whether every target was captured in the last snap".format(prefix),
+            "# TYPE {}_last_snap_success gauge".format(prefix),
+            "{}_last_snap_success {}".format(prefix, 1 if succeeded else 0),
+            "# HELP {}_stage_duration_seconds Time spent in each stage of the last snap".format(prefix),
+            "# TYPE {}_stage_duration_seconds gauge".format(prefix)
+        ]
+        lines.extend(
+            '{}_stage_duration_seconds{{stage="{}"}} {:.6f}'.format(prefix, name, duration)
+            for name, duration in durations.items()
+        )
+        lines.extend([
+            "# HELP {}_stage_bytes Bytes read, written or transferred by each stage of the last snap".format(prefix),
+            "# TYPE {}_stage_bytes gauge".format(prefix)
+        ])
+        lines.extend(
+            '{}_stage_bytes{{stage="{}"}} {}'.format(prefix, name, byte_count)
+            for name, byte_count in byte_counts.items()
+        )
+        if len(peak_rss_kbs) > 0:
+            lines.extend([
+                "# HELP {}_peak_rss_bytes Peak resident memory of the snapper (or a render worker) during the last "
+                "snap".format(prefix),
+                "# TYPE {}_peak_rss_bytes gauge".format(prefix),
+                "{}_peak_rss_bytes {}".format(prefix, max(peak_rss_kbs) * 1024)
+            ])
+
+        write_file_atomically(self.prometheus_textfile, "\n".join(lines) + "\n")
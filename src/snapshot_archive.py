@@ -0,0 +1,84 @@
+import os
+from collections import namedtuple
+from datetime import datetime, time
+
+# Snapshots are stored as <image_destination>/<timestamp>.jpg (or another image format's extension). Unannotated
+# captures (if kept) go in <image_destination>/raw, each with a <timestamp>.json record of its annotations
+TIMESTAMP_FORMAT = "%Y-%m-%d__%H-%M"
+SNAPSHOT_EXTENSION = ".jpg"
+SNAPSHOT_EXTENSIONS = (".jpg", ".webp", ".avif", ".png")
+RAW_CAPTURE_DIRECTORY = "raw"
+ANNOTATION_RECORD_EXTENSION = ".json"
+
+ArchivedSnapshot = namedtuple("ArchivedSnapshot", "timestamp path")
+
+
+def snapshot_basename(snap_time):
+    return snap_time.strftime(TIMESTAMP_FORMAT)
+
+
+def snapshot_filename(snap_time):
+    return "{}{}".format(snapshot_basename(snap_time), SNAPSHOT_EXTENSION)
+
+
+def annotation_record_path(raw_capture_path):
+    return os.path.splitext(raw_capture_path)[0] + ANNOTATION_RECORD_EXTENSION
+
+
+def parse_snapshot_timestamp(file_name):
+    # Returns None for anything that isn't a snapshot
+    base_name, extension = os.path.splitext(os.path.basename(file_name))
+    if extension.lower() not in SNAPSHOT_EXTENSIONS:
+        return None
+
+    try:
+        return datetime.strptime(base_name, TIMESTAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def iter_snapshots(directory, start=None, end=None):
+    # Yields the snapshots in the directory in timestamp order, optionally limited to start <= timestamp <= end. Only
+    # the file names are held in memory, never the images
+    snapshots = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+
+            timestamp = parse_snapshot_timestamp(entry.name)
+            if timestamp is None:
+                continue
+            if (start is not None) and (timestamp < start):
+                continue
+            if (end is not None) and (timestamp > end):
+                continue
+
+            snapshots.append(ArchivedSnapshot(timestamp=timestamp, path=entry.path))
+
+    snapshots.sort(key=lambda x: x.timestamp)
+    for snapshot in snapshots:
+        yield snapshot
+
+
+def parse_date_argument(date_string, end_of_day=False):
+    # Command line dates, either a day (2024-05-01) or a day and time (2024-05-01T13:30). A plain day used as the end
+    # of a range (end_of_day) covers the whole of that day
+    try:
+        date = datetime.strptime(date_string, "%Y-%m-%d")
+        return datetime.combine(date.date(), time.max) if end_of_day else date
+    except ValueError:
+        pass
+
+    for date_format in ("%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(date_string, date_format)
+        except ValueError:
+            pass
+
+    raise ValueError("Unrecognised date: '{}'".format(date_string))
+
+
+def parse_end_date_argument(date_string):
+    # parse_date_argument for the end of a range, as an argparse type
+    return parse_date_argument(date_string, end_of_day=True)
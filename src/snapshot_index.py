@@ -0,0 +1,397 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from snapshot_archive import parse_date_argument, parse_end_date_argument, snapshot_basename
+
+# A row per snap (and capture target) with the data it was annotated with, so the archive can be searched without
+# listing image_destination or reading the images. value is None for readings that aren't numbers, value_text is the
+# reading as it was displayed
+IndexedReading = namedtuple("IndexedReading", "sensor_id reading_id label value value_text")
+IndexedFile = namedtuple("IndexedFile", "level path size")
+IndexedSnapshot = namedtuple(
+    "IndexedSnapshot",
+    "snapshot_id snap_time target grow_system_id grow_system_name age is_live data_timestamp readings files"
+)
+
+# Conditions on readings from the command line, e.g. "Humidity>80". Longest operators first so ">=" isn't taken as ">"
+READING_OPERATORS = (">=", "<=", "!=", ">", "<", "=")
+ReadingCondition = namedtuple("ReadingCondition", "name operator value")
+
+
+class SnapshotIndex(object):
+    INDEX_FILE = "snapshot_index.sqlite3"
+    SCHEMA_VERSION = 2
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS snapshots (
+            snapshot_id INTEGER PRIMARY KEY,
+            snap_time TEXT NOT NULL,
+            target TEXT NOT NULL,
+            grow_system_id INTEGER,
+            grow_system_name TEXT,
+            age INTEGER,
+            is_live INTEGER,
+            data_timestamp REAL,
+            name TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS readings (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots (snapshot_id) ON DELETE CASCADE,
+            sensor_id TEXT NOT NULL,
+            reading_id TEXT NOT NULL,
+            label TEXT NOT NULL,
+            value REAL,
+            value_text TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS files (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots (snapshot_id) ON DELETE CASCADE,
+            level TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS snapshots_name ON snapshots (target, name)",
+        "CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (snap_time)",
+        "CREATE INDEX IF NOT EXISTS snapshots_age ON snapshots (age, snap_time)",
+        "CREATE INDEX IF NOT EXISTS readings_snapshot ON readings (snapshot_id)",
+        "CREATE INDEX IF NOT EXISTS readings_label ON readings (label, value)",
+        "CREATE INDEX IF NOT EXISTS readings_reading_id ON readings (reading_id, value)",
+        "CREATE INDEX IF NOT EXISTS files_snapshot ON files (snapshot_id)",
+        "CREATE INDEX IF NOT EXISTS files_path ON files (path)"
+    ]
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._lock = threading.Lock()
+
+        # WAL lets queries run while the snapper is adding to the index, and only costs a sync per checkpoint rather
+        # than per snap
+        self._connection = sqlite3.connect(index_file, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        with self._connection:
+            self._upgrade_schema()
+            for statement in SnapshotIndex.SCHEMA:
+                self._connection.execute(statement)
+            self._connection.execute("PRAGMA user_version = {}".format(SnapshotIndex.SCHEMA_VERSION))
+
+    def _upgrade_schema(self):
+        # Version 1 keyed snapshots on the snap time to the second, but they are stored (and overwritten) under a name
+        # with the minute in it, so two snaps in the same minute gave two rows for one file. Adds the name and keeps
+        # only the latest row for each
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != 1:
+            return
+
+        self._connection.execute("ALTER TABLE snapshots ADD COLUMN name TEXT NOT NULL DEFAULT ''")
+        rows = self._connection.execute("SELECT snapshot_id, snap_time FROM snapshots").fetchall()
+        self._connection.executemany(
+            "UPDATE snapshots SET name = ? WHERE snapshot_id = ?",
+            [(snapshot_basename(datetime.strptime(x[1], SnapshotIndex.TIME_FORMAT)), x[0]) for x in rows]
+        )
+        self._connection.execute(
+            "DELETE FROM snapshots WHERE snapshot_id NOT IN "
+            "(SELECT MAX(snapshot_id) FROM snapshots GROUP BY target, name)"
+        )
+
+    def close(self):
+        self._connection.close()
+
+    @staticmethod
+    def format_time(snap_time):
+        return snap_time.strftime(SnapshotIndex.TIME_FORMAT)
+
+    def add(self, snap_time, target, grow_system_id, grow_system_name, age, is_live, data_timestamp, readings, files):
+        # Replaces anything already indexed for the same target under the same name, i.e. a snap stored over an
+        # earlier one from the same minute (or taken again). Files of the earlier snap at levels this one didn't store
+        # (e.g. it was unchanged, so only has a thumbnail or nothing) are still on disk, so they stay in the index
+        name = snapshot_basename(snap_time)
+        with self._lock, self._connection:
+            stored_levels = set(x.level for x in files)
+            earlier_files = [
+                IndexedFile(*x) for x in self._connection.execute(
+                    "SELECT level, path, size FROM files WHERE snapshot_id IN "
+                    "(SELECT snapshot_id FROM snapshots WHERE target = ? AND name = ?)",
+                    (target, name)
+                )
+            ]
+            files = list(files) + [x for x in earlier_files if x.level not in stored_levels]
+
+            self._connection.execute("DELETE FROM snapshots WHERE target = ? AND name = ?", (target, name))
+            cursor = self._connection.execute(
+                "INSERT INTO snapshots (snap_time, target, grow_system_id, grow_system_name, age, is_live, "
+                "data_timestamp, name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    SnapshotIndex.format_time(snap_time),
+                    target,
+                    grow_system_id,
+                    grow_system_name,
+                    age,
+                    None if is_live is None else int(is_live),
+                    data_timestamp,
+                    name
+                )
+            )
+            snapshot_id = cursor.lastrowid
+            self._connection.executemany(
+                "INSERT INTO readings (snapshot_id, sensor_id, reading_id, label, value, value_text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(snapshot_id, x.sensor_id, x.reading_id, x.label, x.value, x.value_text) for x in readings]
+            )
+            self._connection.executemany(
+                "INSERT INTO files (snapshot_id, level, path, size) VALUES (?, ?, ?, ?)",
+                [(snapshot_id, x.level, x.path, x.size) for x in files]
+            )
+
+        return snapshot_id
+
+    def remove_file(self, path):
+        # Forgets the snapshot a stored image belongs to (with all of its readings and files), for when the snapshot
+        # has been deleted. Returns whether it was indexed
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM snapshots WHERE snapshot_id IN (SELECT snapshot_id FROM files WHERE path = ?)",
+                (path,)
+            )
+
+        return cursor.rowcount > 0
+
+    def move_file(self, path, new_path, size):
+        # For a stored image that has been replaced, e.g. re-encoded in another format
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE files SET path = ?, size = ? WHERE path = ?", (new_path, size, path))
+
+    @staticmethod
+    def _where_clause(start=None, end=None, target=None, grow_system_id=None, age=None, reading_conditions=None):
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append("snap_time >= ?")
+            params.append(SnapshotIndex.format_time(start))
+        if end is not None:
+            conditions.append("snap_time <= ?")
+            params.append(SnapshotIndex.format_time(end))
+        if target is not None:
+            conditions.append("target = ?")
+            params.append(target)
+        if grow_system_id is not None:
+            conditions.append("grow_system_id = ?")
+            params.append(grow_system_id)
+        if age is not None:
+            conditions.append("age = ?")
+            params.append(age)
+
+        # A condition on a reading matches either its label or its reading ID. Written as a union of two lookups so
+        # each can use its (name, value) index
+        for reading_condition in (reading_conditions if reading_conditions is not None else []):
+            if reading_condition.operator not in READING_OPERATORS:
+                raise ValueError("Unsupported operator: {}".format(reading_condition.operator))
+
+            conditions.append(
+                "snapshot_id IN (SELECT snapshot_id FROM readings WHERE label = ? AND value {0} ? "
+                "UNION ALL SELECT snapshot_id FROM readings WHERE reading_id = ? AND value {0} ?)".format(
+                    reading_condition.operator
+                )
+            )
+            params.extend([
+                reading_condition.name,
+                reading_condition.value,
+                reading_condition.name,
+                reading_condition.value
+            ])
+
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    def _nearest(self, column, value, where_clause, params):
+        # The value of column closest to value, using the column's index from both sides rather than sorting every row
+        joiner = " AND " if where_clause else " WHERE "
+        candidates = []
+        for comparison, order in ((">=", "ASC"), ("<=", "DESC")):
+            row = self._connection.execute(
+                "SELECT {0} FROM snapshots{1}{2}{0} {3} ? ORDER BY {0} {4} LIMIT 1".format(
+                    column,
+                    where_clause,
+                    joiner,
+                    comparison,
+                    order
+                ),
+                params + [value]
+            ).fetchone()
+            if row is not None:
+                candidates.append(row[0])
+
+        return candidates
+
+    def nearest_age(self, days, **filters):
+        # The age (in days) closest to days that any matching snapshot was taken at
+        where_clause, params = SnapshotIndex._where_clause(**filters)
+        with self._lock:
+            candidates = self._nearest("age", days, where_clause, params)
+
+        return min(candidates, key=lambda x: (abs(x - days), x), default=None)
+
+    def nearest_time(self, snap_time, **filters):
+        # The time of the matching snapshot taken closest to snap_time
+        where_clause, params = SnapshotIndex._where_clause(**filters)
+        with self._lock:
+            candidates = self._nearest("snap_time", SnapshotIndex.format_time(snap_time), where_clause, params)
+
+        candidate_times = [datetime.strptime(x, SnapshotIndex.TIME_FORMAT) for x in candidates]
+        return min(candidate_times, key=lambda x: abs(x - snap_time), default=None)
+
+    def query(self, limit=None, newest_first=False, **filters):
+        # Snapshots matching all of the filters (see _where_clause), in time order
+        where_clause, params = SnapshotIndex._where_clause(**filters)
+        sql = "SELECT * FROM snapshots{} ORDER BY snap_time {}, target".format(
+            where_clause,
+            "DESC" if newest_first else "ASC"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+            snapshot_ids = [row[0] for row in rows]
+            readings = self._fetch_children(
+                "SELECT snapshot_id, sensor_id, reading_id, label, value, value_text FROM readings",
+                snapshot_ids
+            )
+            files = self._fetch_children("SELECT snapshot_id, level, path, size FROM files", snapshot_ids)
+
+        return [
+            IndexedSnapshot(
+                snapshot_id=row[0],
+                snap_time=datetime.strptime(row[1], SnapshotIndex.TIME_FORMAT),
+                target=row[2],
+                grow_system_id=row[3],
+                grow_system_name=row[4],
+                age=row[5],
+                is_live=(None if row[6] is None else bool(row[6])),
+                data_timestamp=row[7],
+                readings=[IndexedReading(*x) for x in readings.get(row[0], [])],
+                files=[IndexedFile(*x) for x in files.get(row[0], [])]
+            )
+            for row in rows
+        ]
+
+    def _fetch_children(self, select, snapshot_ids):
+        # Rows belonging to the given snapshots, grouped by snapshot. Fetched in batches to stay under SQLite's limit
+        # on the number of query parameters
+        children = {}
+        batch_size = 500
+        for batch_start in range(0, len(snapshot_ids), batch_size):
+            batch = snapshot_ids[batch_start:(batch_start + batch_size)]
+            rows = self._connection.execute(
+                "{} WHERE snapshot_id IN ({}) ORDER BY rowid".format(select, ",".join("?" * len(batch))),
+                batch
+            )
+            for row in rows:
+                children.setdefault(row[0], []).append(row[1:])
+
+        return children
+
+
+def reading_value(value):
+    # What the index stores as a reading's numeric value
+    if isinstance(value, (bool, int, float)):
+        return float(value)
+
+    return None
+
+
+def parse_reading_condition(condition_string):
+    for operator in READING_OPERATORS:
+        name, found, value = condition_string.partition(operator)
+        if found and name.strip():
+            return ReadingCondition(name=name.strip(), operator=operator, value=float(value))
+
+    raise ValueError("Unrecognised reading condition: '{}'".format(condition_string))
+
+
+def snapshot_as_dict(snapshot):
+    return {
+        "snap_time": snapshot.snap_time.isoformat(),
+        "target": snapshot.target,
+        "grow_system_id": snapshot.grow_system_id,
+        "grow_system_name": snapshot.grow_system_name,
+        "age": snapshot.age,
+        "is_live": snapshot.is_live,
+        "readings": {x.label: x.value if x.value is not None else x.value_text for x in snapshot.readings},
+        "files": [{"level": x.level, "path": x.path, "size": x.size} for x in snapshot.files]
+    }
+
+
+def format_snapshot(snapshot):
+    return "{}  {:<10} day {:<4} {}  {}".format(
+        snapshot.snap_time.strftime("%Y-%m-%d %H:%M"),
+        snapshot.target,
+        snapshot.age if snapshot.age is not None else "-",
+        " ".join("{}={}".format(x.label, x.value_text.strip()) for x in snapshot.readings),
+        snapshot.files[0].path if len(snapshot.files) > 0 else "-"
+    )
+
+
+def add_query_arguments(parser):
+    parser.add_argument("--target", dest="target", help="Only snapshots of this capture target")
+    parser.add_argument("--start", type=parse_date_argument, dest="start",
+                        help="First date to include, e.g. 2024-05-01 or 2024-05-01T06:00")
+    parser.add_argument("--end", type=parse_end_date_argument, dest="end", help="Last date to include")
+    parser.add_argument("--where", type=parse_reading_condition, action="append", dest="reading_conditions",
+                        help="Condition on a reading (label or reading ID), e.g. 'Humidity>80'. Can be repeated")
+    parser.add_argument("--day", type=int, dest="age", help="Only snapshots from this day of the grow")
+    parser.add_argument("--nearest-day", type=int, dest="nearest_age",
+                        help="Only snapshots from the day closest to this one that has any")
+    parser.add_argument("--nearest-time", type=parse_date_argument, dest="nearest_time",
+                        help="Only the snapshot taken closest to this time")
+    parser.add_argument("--limit", type=int, dest="limit", help="Most snapshots to list")
+    parser.add_argument("--newest-first", action="store_true", dest="newest_first")
+    parser.add_argument("--format", choices=["text", "json", "paths"], default="text", dest="output_format",
+                        help="json writes a JSON object per line, paths just the main image of each snapshot")
+
+
+def run_query(args, index_file):
+    if not os.path.exists(index_file):
+        print("No snapshot index at {}".format(index_file))
+        return False
+
+    filters = dict(
+        start=args.start,
+        end=args.end,
+        target=args.target,
+        age=args.age,
+        reading_conditions=args.reading_conditions
+    )
+
+    snapshot_index = SnapshotIndex(index_file)
+    try:
+        if args.nearest_age is not None:
+            filters["age"] = snapshot_index.nearest_age(args.nearest_age, **filters)
+            if filters["age"] is None:
+                return True
+
+        limit = args.limit
+        if args.nearest_time is not None:
+            nearest_time = snapshot_index.nearest_time(args.nearest_time, **filters)
+            if nearest_time is None:
+                return True
+            filters["start"] = filters["end"] = nearest_time
+            limit = 1
+
+        snapshots = snapshot_index.query(limit=limit, newest_first=args.newest_first, **filters)
+    finally:
+        snapshot_index.close()
+
+    for snapshot in snapshots:
+        if args.output_format == "json":
+            print(json.dumps(snapshot_as_dict(snapshot)))
+        elif args.output_format == "paths":
+            if len(snapshot.files) > 0:
+                print(snapshot.files[0].path)
+        else:
+            print(format_snapshot(snapshot))
+
+    return True
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+from concurrent import futures
+from datetime import datetime
+
+from file_utils import write_file_atomically
+from image_annotator import AnnotationDetails, ImageAnnotator
+from image_grabber import CapturedFrame
+from snapshot_archive import (RAW_CAPTURE_DIRECTORY, annotation_record_path, iter_snapshots, parse_date_argument,
+                              parse_end_date_argument, snapshot_basename)
+from snapshot_renderer import render_snapshot
+from timelapse_builder import ordered_bounded_map
+
+# Re-renders the annotated snapshots from the raw captures (see keep_raw_capture) and the annotation record saved next
+# to each one, e.g. after changing a label, font or the layout of the overlay
+ANNOTATION_RECORD_VERSION = 1
+SCRIPT_DIR = os.path.realpath(os.path.dirname(__file__))
+
+# Anything that changes what the annotated images look like. If any of these change every snapshot is re-rendered
+RENDER_SOURCE_FILES = (
+    "image_annotator.py",
+    "glyph_atlas.py",
+    "image_encoder.py",
+    "output_pyramid.py",
+    "snapshot_renderer.py"
+)
+
+
+def write_annotation_record(raw_capture_path, snap_time, annotation_details):
+    # annotation_details is None for snaps that were stored without annotations
+    write_file_atomically(annotation_record_path(raw_capture_path), json.dumps({
+        "version": ANNOTATION_RECORD_VERSION,
+        "snap_time": snap_time.isoformat(timespec="seconds"),
+        "annotation": annotation_details.to_record() if annotation_details is not None else None
+    }))
+
+
+def read_annotation_details(raw_capture_path):
+    with open(annotation_record_path(raw_capture_path)) as json_file:
+        record = json.load(json_file)
+
+    annotation_record = record.get("annotation", None)
+    return AnnotationDetails.from_record(annotation_record) if annotation_record is not None else None
+
+
+def render_fingerprint(output_levels, rerender_overlay):
+    sha256 = hashlib.sha256()
+
+    asset_files = (
+        ImageAnnotator.LOGO_ASSET_FILE,
+        ImageAnnotator.SENSOR_DATA_FONT_FILE,
+        ImageAnnotator.AGE_FONT_FILE,
+        ImageAnnotator.GROW_SYSTEM_NAME_FONT_FILE
+    )
+    for file_name in RENDER_SOURCE_FILES + tuple(sorted(set(asset_files))):
+        with open(os.path.join(SCRIPT_DIR, file_name), "rb") as f:
+            sha256.update(f.read())
+
+    sha256.update(json.dumps([list(x) for x in output_levels], sort_keys=True).encode())
+    sha256.update(b"rerender_overlay" if rerender_overlay else b"")
+
+    return sha256.hexdigest()
+
+
+# Which raw captures have been re-rendered, and from what. One JSON line is appended as each snapshot is finished so
+# an interrupted run picks up where it left off. The file is rewritten with just the latest line for each snapshot at
+# the end of every run
+class ReannotationState(object):
+    STATE_FILE = ".reannotate_state.jsonl"
+
+    def __init__(self, raw_directory):
+        self.state_file = os.path.join(raw_directory, ReannotationState.STATE_FILE)
+        self._entries = {}
+
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry["snapshot"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely the last line, cut short by a crash or power cut
+                        continue
+
+    @staticmethod
+    def source_stamp(raw_capture_path):
+        # Changes if the raw capture or its record are replaced. None if there is no record
+        try:
+            raw_stat = os.stat(raw_capture_path)
+            record_stat = os.stat(annotation_record_path(raw_capture_path))
+        except FileNotFoundError:
+            return None
+
+        return [raw_stat.st_mtime_ns, raw_stat.st_size, record_stat.st_mtime_ns, record_stat.st_size]
+
+    def is_up_to_date(self, snapshot_name, fingerprint, source_stamp):
+        entry = self._entries.get(snapshot_name, None)
+        if entry is None:
+            return False
+
+        return (
+            (entry.get("fingerprint") == fingerprint) and
+            (entry.get("source") == source_stamp) and
+            all(os.path.exists(x) for x in entry.get("outputs", []))
+        )
+
+    def add(self, snapshot_name, fingerprint, source_stamp, output_paths):
+        entry = {
+            "snapshot": snapshot_name,
+            "fingerprint": fingerprint,
+            "source": source_stamp,
+            "outputs": output_paths
+        }
+        self._entries[snapshot_name] = entry
+
+        with open(self.state_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        write_file_atomically(
+            self.state_file,
+            "".join(json.dumps(self._entries[x]) + "\n" for x in sorted(self._entries))
+        )
+
+
+class SnapshotReannotator(object):
+    # Picklable for the worker pool. Returns the paths written, or None if the capture couldn't be re-rendered
+    def __init__(self, image_destination, output_levels, rerender_overlay):
+        self.image_destination = image_destination
+        self.output_levels = output_levels
+        self.rerender_overlay = rerender_overlay
+
+    def __call__(self, snapshot):
+        try:
+            annotation_details = read_annotation_details(snapshot.path)
+            with open(snapshot.path, "rb") as f:
+                frame = CapturedFrame(image=None, encoded_image=f.read())
+
+            return render_snapshot(
+                frame,
+                annotation_details,
+                self.image_destination,
+                snapshot_basename(snapshot.timestamp),
+                self.output_levels,
+                self.rerender_overlay,
+                snap_time=snapshot.timestamp
+            )
+        except (OSError, SyntaxError, ValueError, KeyError, TypeError) as e:
+            print("Could not re-annotate {}: {}".format(snapshot.path, e))
+            return None
+
+
+def reannotate_target(image_destination, output_levels, rerender_overlay, start=None, end=None, num_workers=None,
+                      force=False):
+    # Re-renders the raw captures of one target taken between start and end, skipping any that are already up to date
+    # unless force is set. Returns the number of snapshots re-rendered
+    raw_directory = os.path.join(image_destination, RAW_CAPTURE_DIRECTORY)
+    if not os.path.isdir(raw_directory):
+        print("No raw captures in {}".format(image_destination))
+        return 0
+
+    fingerprint = render_fingerprint(output_levels, rerender_overlay)
+    state = ReannotationState(raw_directory)
+
+    pending_snapshots = []
+    num_unrecorded = 0
+    num_up_to_date = 0
+    for snapshot in iter_snapshots(raw_directory, start=start, end=end):
+        source_stamp = ReannotationState.source_stamp(snapshot.path)
+        if source_stamp is None:
+            num_unrecorded += 1
+        elif (not force) and state.is_up_to_date(os.path.basename(snapshot.path), fingerprint, source_stamp):
+            num_up_to_date += 1
+        else:
+            pending_snapshots.append((snapshot, source_stamp))
+
+    print("{}: {} to re-annotate, {} already up to date, {} without an annotation record".format(
+        image_destination,
+        len(pending_snapshots),
+        num_up_to_date,
+        num_unrecorded
+    ))
+
+    num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+    source_stamps = {snapshot.path: source_stamp for snapshot, source_stamp in pending_snapshots}
+    num_done = 0
+    num_failed = 0
+    try:
+        with futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            rendered_snapshots = ordered_bounded_map(
+                executor,
+                SnapshotReannotator(image_destination, output_levels, rerender_overlay),
+                (snapshot for snapshot, _ in pending_snapshots),
+                max_in_flight=(2 * num_workers)
+            )
+            for snapshot, output_paths in rendered_snapshots:
+                if output_paths is None:
+                    num_failed += 1
+                    continue
+
+                state.add(os.path.basename(snapshot.path), fingerprint, source_stamps[snapshot.path], output_paths)
+                num_done += 1
+                if (num_done % 100) == 0:
+                    print("{}: {}/{} re-annotated".format(image_destination, num_done, len(pending_snapshots)))
+    finally:
+        state.compact()
+
+    print("{}: {} re-annotated, {} failed".format(image_destination, num_done, num_failed))
+
+    return num_done
+
+
+def add_reannotate_arguments(parser):
+    parser.add_argument("--target", dest="target", help="Name of the capture target to re-annotate (defaults to all)")
+    parser.add_argument("--start", type=parse_date_argument, dest="start",
+                        help="First date to include, e.g. 2024-05-01 or 2024-05-01T06:00")
+    parser.add_argument("--end", type=parse_end_date_argument, dest="end", help="Last date to include")
+    parser.add_argument("--workers", type=int, dest="num_workers", help="Number of render processes")
+    parser.add_argument("--force", action="store_true", dest="force",
+                        help="Re-render everything in the date range, even snapshots that are up to date")
+
+
+def run_reannotate(args, config):
+    targets = [x for x in config.capture_targets if (args.target is None) or (x.name == args.target)]
+    if len(targets) == 0:
+        print("Unknown capture target: {}".format(args.target))
+        return False
+
+    start_time = datetime.now()
+    for target in targets:
+        reannotate_target(
+            target.image_destination,
+            config.output_levels,
+            config.rerender_overlay,
+            start=args.start,
+            end=args.end,
+            num_workers=args.num_workers,
+            force=args.force
+        )
+    print("Took {}".format(datetime.now() - start_time))
+
+    return True
@@ -0,0 +1,114 @@
+import io
+
+from file_utils import save_image_atomically, write_file_atomically
+from image_annotator import ImageAnnotator
+from image_encoder import build_metadata
+from image_grabber import CapturedFrame
+from output_pyramid import build_levels, build_smallest_level, output_path, save_levels
+from snapper_metrics import span
+from startup_profile import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+
+# Everything here can be run in a worker process, so it only takes (and returns) things that can be pickled
+
+
+def frame_for_transfer(frame):
+    # If we have the camera's JPEG, send that rather than the image. Pickling the image would mean decoding it in this
+    # process, and the encoded JPEG is a fraction of the size
+    if frame.encoded_image is not None:
+        return CapturedFrame(image=None, encoded_image=frame.encoded_image)
+
+    return frame
+
+
+def load_frame_image(frame):
+    if frame.image is not None:
+        return frame.image
+
+    return Image.open(io.BytesIO(frame.encoded_image))
+
+
+def save_frame(frame, image_path):
+    # Use the camera's own JPEG if we have it, rather than encoding it again
+    with span("save_frame") as span_fields:
+        if frame.encoded_image is not None:
+            write_file_atomically(image_path, frame.encoded_image)
+            span_fields["bytes"] = len(frame.encoded_image)
+        else:
+            save_image_atomically(frame.image, image_path)
+
+
+def render_snapshot(frame, annotation_details, image_destination, base_filename, output_levels, rerender_overlay=True,
+                    snap_time=None, thumbnail_only=False):
+    # The snap time, grow system and sensor readings are written into the EXIF and XMP of every image
+    metadata = build_metadata(annotation_details, snap_time)
+
+    if thumbnail_only:
+        # Just the smallest output, e.g. for a capture that hasn't changed since the last one stored
+        return render_thumbnail(frame, annotation_details, image_destination, base_filename, output_levels, metadata)
+
+    output_paths = [
+        output_path(image_destination, level_index, level, base_filename)
+        for level_index, level in enumerate(output_levels)
+    ]
+
+    if annotation_details is None:
+        # Nothing to annotate, store the capture as it is. If the main output is the camera's own size and format then
+        # its JPEG can be written out without having to encode it again
+        first_level = output_levels[0]
+        if (
+            (frame.encoded_image is not None) and
+            (first_level.reduce_factor == 1) and
+            (first_level.image_format == "JPEG") and
+            (len(first_level.save_params) == 0)
+        ):
+            save_frame(frame, output_paths[0])
+            if len(output_levels) > 1:
+                level_images = build_levels(load_frame_image(frame), output_levels)
+                save_levels(level_images[1:], output_levels[1:], output_paths[1:], metadata=metadata)
+        else:
+            level_images = build_levels(load_frame_image(frame), output_levels)
+            save_levels(level_images, output_levels, output_paths, metadata=metadata)
+
+        return output_paths
+
+    image = load_frame_image(frame)
+    with span("decode"):
+        image.load()
+
+    with span("annotate", levels=(len(output_levels) if rerender_overlay else 1)):
+        if rerender_overlay:
+            # Scale the capture down first and draw the overlay at each size, so the text stays sharp on the smaller
+            # levels
+            level_images = [
+                ImageAnnotator.annotate_frame(image=level_image, annotation_details=annotation_details)
+                for level_image in build_levels(image, output_levels)
+            ]
+        else:
+            # Cheaper, the overlay is only drawn once, but it gets scaled down along with the image so small text on
+            # the smallest levels can become hard to read
+            annotated_image = ImageAnnotator.annotate_frame(image=image, annotation_details=annotation_details)
+            level_images = build_levels(annotated_image, output_levels)
+
+    save_levels(level_images, output_levels, output_paths, metadata=metadata)
+
+    return output_paths
+
+
+def render_thumbnail(frame, annotation_details, image_destination, base_filename, output_levels, metadata):
+    thumbnail_path = output_path(image_destination, len(output_levels) - 1, output_levels[-1], base_filename)
+
+    image = load_frame_image(frame)
+    with span("decode"):
+        thumbnail = build_smallest_level(image, output_levels)
+        thumbnail.load()
+
+    if annotation_details is not None:
+        with span("annotate", levels=1):
+            thumbnail = ImageAnnotator.annotate_frame(image=thumbnail, annotation_details=annotation_details)
+
+    save_levels([thumbnail], output_levels[-1:], [thumbnail_path], metadata=metadata)
+
+    return [thumbnail_path]
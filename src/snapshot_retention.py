@@ -0,0 +1,436 @@
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from file_utils import save_image_atomically, write_file_atomically
+from image_encoder import IMAGE_FORMAT_EXTENSIONS, metadata_save_params, stored_metadata
+from snapshot_archive import ANNOTATION_RECORD_EXTENSION, RAW_CAPTURE_DIRECTORY, SNAPSHOT_EXTENSIONS, iter_snapshots
+from snapshot_index import SnapshotIndex
+from startup_profile import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+# How long snapshots are kept, and in what form. Ages are in days and every rule is optional (None turns it off):
+# - full_resolution_days: older main images are re-encoded to fit archive_max_width x archive_max_height, in
+#   archive_format with archive_quality
+# - hourly_after_days, daily_after_days: older snapshots are thinned out to the first one of each hour or day
+# - raw_capture_days: older raw captures (see keep_raw_capture) and their annotation records are deleted
+# - max_disk_mb: the oldest snapshots are deleted until the image destinations of all targets fit in this
+# - interval_seconds: how often the daemon runs a pass
+RetentionOptions = namedtuple(
+    "RetentionOptions",
+    "full_resolution_days archive_max_width archive_max_height archive_format archive_quality hourly_after_days "
+    "daily_after_days raw_capture_days max_disk_mb interval_seconds",
+    defaults=(None, 1920, 1080, "JPEG", 85, None, None, None, None, 3600)
+)
+
+
+def hour_bucket(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(timestamp):
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def directory_size(directory):
+    total_size = 0
+    for directory_path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            try:
+                total_size += os.lstat(os.path.join(directory_path, file_name)).st_size
+            except FileNotFoundError:
+                continue
+
+    return total_size
+
+
+def lower_priority():
+    # Make this process give way to captures: the lowest CPU priority and the idle I/O class, which only gets the disk
+    # when nothing else wants it (on I/O schedulers that support classes, e.g. BFQ)
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+    ionice = shutil.which("ionice")
+    if ionice is not None:
+        subprocess.run(
+            [ionice, "-c", "3", "-p", str(os.getpid())],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False
+        )
+
+
+# When each target was last processed and with which rules. Only snapshots that have crossed one of the age thresholds
+# since then are looked at, unless the rules have changed, in which case the whole archive is gone through again
+class RetentionState(object):
+    STATE_FILE = ".retention_state.json"
+
+    def __init__(self, image_destination):
+        self.state_file = os.path.join(image_destination, RetentionState.STATE_FILE)
+        self.last_pass = None
+        self.rules = None
+
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.last_pass = datetime.fromisoformat(state["last_pass"])
+            self.rules = state["rules"]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.last_pass = None
+
+    @staticmethod
+    def rules_record(options):
+        # Everything except how often passes run affects which files a pass touches
+        rules = options._asdict()
+        del rules["interval_seconds"]
+        return json.loads(json.dumps(rules))
+
+    def last_pass_for(self, options):
+        return self.last_pass if self.rules == RetentionState.rules_record(options) else None
+
+    def save(self, pass_time, options):
+        write_file_atomically(self.state_file, json.dumps({
+            "last_pass": pass_time.isoformat(timespec="seconds"),
+            "rules": RetentionState.rules_record(options)
+        }))
+
+
+class RetentionPass(object):
+    def __init__(self, options, output_levels, snapshot_index=None, dry_run=False):
+        self.options = options
+        self.output_levels = output_levels
+        self.snapshot_index = snapshot_index
+        self.dry_run = dry_run
+
+        self.num_deleted = 0
+        self.num_reencoded = 0
+        self.num_raw_deleted = 0
+        self.bytes_freed = 0
+
+        # A dry run doesn't delete anything, so it remembers what it would have deleted to not count it twice
+        self._dry_run_removed = set()
+
+    def summary(self):
+        return "{} snapshot(s) deleted, {} re-encoded, {} raw capture(s) deleted, {:.1f}MB freed".format(
+            self.num_deleted,
+            self.num_reencoded,
+            self.num_raw_deleted,
+            self.bytes_freed / (1024 * 1024)
+        )
+
+    def _update_index(self, method_name, *args):
+        if (self.snapshot_index is None) or self.dry_run:
+            return
+
+        try:
+            getattr(self.snapshot_index, method_name)(*args)
+        except sqlite3.Error as e:
+            print("Could not update the snapshot index: {}".format(e))
+
+    def _remove(self, path):
+        # Returns the number of bytes freed
+        if path in self._dry_run_removed:
+            return 0
+
+        try:
+            size = os.path.getsize(path)
+            if self.dry_run:
+                self._dry_run_removed.add(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return 0
+
+        self.bytes_freed += size
+        return size
+
+    @staticmethod
+    def _raw_capture_paths(image_destination, base_name):
+        raw_directory = os.path.join(image_destination, RAW_CAPTURE_DIRECTORY)
+        return [
+            os.path.join(raw_directory, base_name + extension)
+            for extension in SNAPSHOT_EXTENSIONS + (ANNOTATION_RECORD_EXTENSION,)
+        ]
+
+    def delete_snapshot(self, image_destination, snapshot):
+        # The main image, every other size of it and its raw capture. Returns the number of bytes freed
+        base_name = os.path.splitext(os.path.basename(snapshot.path))[0]
+        paths = [snapshot.path]
+        for level in self.output_levels[1:]:
+            paths.extend(
+                os.path.join(image_destination, level.name, base_name + extension) for extension in SNAPSHOT_EXTENSIONS
+            )
+        paths.extend(RetentionPass._raw_capture_paths(image_destination, base_name))
+
+        self._update_index("remove_file", os.path.abspath(snapshot.path))
+        freed = sum(self._remove(x) for x in paths)
+        self.num_deleted += 1
+
+        return freed
+
+    def delete_raw_capture(self, image_destination, raw_snapshot):
+        if raw_snapshot.path in self._dry_run_removed:
+            return
+
+        base_name = os.path.splitext(os.path.basename(raw_snapshot.path))[0]
+        for path in RetentionPass._raw_capture_paths(image_destination, base_name):
+            self._remove(path)
+        self.num_raw_deleted += 1
+
+    def reencode(self, snapshot):
+        # Shrinks the main image to the archive size and format. Images that are already small enough and in the
+        # right format are left alone (only their header is read), so running this twice is harmless
+        max_width = self.options.archive_max_width
+        max_height = self.options.archive_max_height
+        image_format = self.options.archive_format
+
+        with Image.open(snapshot.path) as image:
+            fits = ((max_width is None) or (image.width <= max_width)) and (
+                (max_height is None) or (image.height <= max_height)
+            )
+            if fits and (image.format == image_format):
+                return False
+
+            new_path = os.path.splitext(snapshot.path)[0] + IMAGE_FORMAT_EXTENSIONS[image_format]
+            self.num_reencoded += 1
+            if self.dry_run:
+                return True
+
+            save_params = {}
+            if (self.options.archive_quality is not None) and (image_format != "PNG"):
+                save_params["quality"] = self.options.archive_quality
+            # The snapshot's EXIF, XMP and comment are kept, in whatever form the new format supports
+            save_params.update(metadata_save_params(image_format, stored_metadata(image)))
+
+            # thumbnail lets the JPEG decoder do most of the shrinking (see Image.draft), so a 4K snapshot is never
+            # decoded at full size
+            if not fits:
+                image.thumbnail((
+                    max_width if max_width is not None else image.width,
+                    max_height if max_height is not None else image.height
+                ))
+            if (image_format == "JPEG") and (image.mode not in ("RGB", "L")):
+                image = image.convert("RGB")
+
+            old_size = os.path.getsize(snapshot.path)
+            save_image_atomically(image, new_path, image_format=image_format, **save_params)
+
+        new_size = os.path.getsize(new_path)
+        if new_path != snapshot.path:
+            os.remove(snapshot.path)
+        self.bytes_freed += old_size - new_size
+        self._update_index("move_file", os.path.abspath(snapshot.path), os.path.abspath(new_path), new_size)
+
+        return True
+
+    @staticmethod
+    def _window(days, last_pass, now, bucket=None):
+        # The snapshots that have crossed an age threshold since the last pass. For thinning the window is widened to
+        # the start of the hour or day it begins in, so the snapshot kept for that hour or day is seen again
+        end = now - timedelta(days=days)
+        if last_pass is None:
+            return None, end
+
+        start = last_pass - timedelta(days=days)
+        return (bucket(start) if bucket is not None else start), end
+
+    @staticmethod
+    def _is_main_image(image_destination, snapshot):
+        return os.path.normpath(os.path.dirname(snapshot.path)) == os.path.normpath(image_destination)
+
+    def _list_snapshots(self, image_destination):
+        # The main images, plus the captures that were only stored as a thumbnail (see change_detection_options)
+        snapshots = list(iter_snapshots(image_destination))
+        if len(self.output_levels) > 1:
+            thumbnail_directory = os.path.join(image_destination, self.output_levels[-1].name)
+            if os.path.isdir(thumbnail_directory):
+                main_timestamps = set(x.timestamp for x in snapshots)
+                snapshots.extend(
+                    x for x in iter_snapshots(thumbnail_directory) if x.timestamp not in main_timestamps
+                )
+                snapshots.sort(key=lambda x: x.timestamp)
+
+        return snapshots
+
+    def _thin(self, image_destination, snapshots, days, bucket, last_pass, now):
+        # Keeps one snapshot for each hour or day in the window: the first one stored in full, or the first thumbnail
+        # if there are only thumbnails. Returns the snapshots left
+        start, end = RetentionPass._window(days, last_pass, now, bucket)
+        kept_snapshots = []
+        bucket_snapshots = {}
+        for snapshot in snapshots:
+            if ((start is None) or (snapshot.timestamp >= start)) and (snapshot.timestamp <= end):
+                bucket_snapshots.setdefault(bucket(snapshot.timestamp), []).append(snapshot)
+            else:
+                kept_snapshots.append(snapshot)
+
+        for snapshots_in_bucket in bucket_snapshots.values():
+            kept_snapshot = next(
+                (x for x in snapshots_in_bucket if RetentionPass._is_main_image(image_destination, x)),
+                snapshots_in_bucket[0]
+            )
+            for snapshot in snapshots_in_bucket:
+                if snapshot is not kept_snapshot:
+                    self.delete_snapshot(image_destination, snapshot)
+            kept_snapshots.append(kept_snapshot)
+
+        kept_snapshots.sort(key=lambda x: x.timestamp)
+        return kept_snapshots
+
+    def run_target(self, image_destination, last_pass, now):
+        snapshots = self._list_snapshots(image_destination)
+
+        if self.options.daily_after_days is not None:
+            snapshots = self._thin(
+                image_destination, snapshots, self.options.daily_after_days, day_bucket, last_pass, now
+            )
+        if self.options.hourly_after_days is not None:
+            snapshots = self._thin(
+                image_destination, snapshots, self.options.hourly_after_days, hour_bucket, last_pass, now
+            )
+
+        if self.options.full_resolution_days is not None:
+            start, end = RetentionPass._window(self.options.full_resolution_days, last_pass, now)
+            for snapshot in snapshots:
+                if not RetentionPass._is_main_image(image_destination, snapshot):
+                    continue
+                if ((start is None) or (snapshot.timestamp >= start)) and (snapshot.timestamp <= end):
+                    try:
+                        self.reencode(snapshot)
+                    except (OSError, ValueError) as e:
+                        print("Could not re-encode {}: {}".format(snapshot.path, e))
+
+        raw_directory = os.path.join(image_destination, RAW_CAPTURE_DIRECTORY)
+        if (self.options.raw_capture_days is not None) and os.path.isdir(raw_directory):
+            start, end = RetentionPass._window(self.options.raw_capture_days, last_pass, now)
+            for raw_snapshot in iter_snapshots(raw_directory, start=start, end=end):
+                self.delete_raw_capture(image_destination, raw_snapshot)
+
+    def enforce_disk_cap(self, image_destinations):
+        # Deletes the oldest snapshots, across all of the targets, until everything fits. The newest snapshot of each
+        # target is always kept
+        max_bytes = self.options.max_disk_mb * 1024 * 1024
+        disk_usage = sum(directory_size(x) for x in image_destinations)
+        if disk_usage <= max_bytes:
+            return
+
+        candidates = []
+        for image_destination in image_destinations:
+            candidates.extend((x, image_destination) for x in self._list_snapshots(image_destination)[:-1])
+        candidates.sort(key=lambda x: x[0].timestamp)
+
+        for snapshot, image_destination in candidates:
+            if disk_usage <= max_bytes:
+                break
+            disk_usage -= self.delete_snapshot(image_destination, snapshot)
+
+        if disk_usage > max_bytes:
+            print("Still using {:.1f}MB, more than max_disk_mb".format(disk_usage / (1024 * 1024)))
+
+
+def apply_retention(options, output_levels, image_destinations, snapshot_index=None, full=False, dry_run=False):
+    # One pass over the archive of every target. full goes through everything, not just what has crossed a threshold
+    # since the last pass
+    retention_pass = RetentionPass(options, output_levels, snapshot_index=snapshot_index, dry_run=dry_run)
+
+    for image_destination in image_destinations:
+        state = RetentionState(image_destination)
+        now = datetime.now()
+        retention_pass.run_target(image_destination, None if full else state.last_pass_for(options), now)
+        if not dry_run:
+            state.save(now, options)
+
+    if options.max_disk_mb is not None:
+        retention_pass.enforce_disk_cap(image_destinations)
+
+    return retention_pass
+
+
+# Runs a retention pass every interval_seconds while the daemon is running. Each pass is a separate low priority
+# process (the retention command), so it never holds the GIL or the disk while a capture needs them
+class BackgroundRetention(object):
+    def __init__(self, command, interval_seconds):
+        self.command = command
+        self.interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+        self._process_lock = threading.Lock()
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._process_lock:
+            if self._process is not None:
+                # Safe at any point, every file is replaced atomically and an unfinished pass is repeated next time
+                self._process.terminate()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._process_lock:
+                if self._stop_event.is_set():
+                    break
+                # A session of its own so Ctrl+C on the daemon doesn't reach it, stop() ends it instead
+                self._process = subprocess.Popen(self.command, start_new_session=True)
+
+            return_code = self._process.wait()
+            with self._process_lock:
+                self._process = None
+            if (return_code != 0) and not self._stop_event.is_set():
+                print("Retention pass failed ({})".format(return_code))
+
+            self._stop_event.wait(self.interval_seconds)
+
+
+def add_retention_arguments(parser):
+    parser.add_argument("--full", action="store_true", dest="full",
+                        help="Go through the whole archive, not just snapshots that have aged since the last pass")
+    parser.add_argument("--dry-run", action="store_true", dest="dry_run",
+                        help="Only report what would be deleted and re-encoded")
+
+
+def run_retention(args, config, snapshot_index_file):
+    if config.retention_options is None:
+        print("No retention_options in the snapper config")
+        return False
+
+    lower_priority()
+
+    snapshot_index = None
+    if os.path.exists(snapshot_index_file):
+        snapshot_index = SnapshotIndex(snapshot_index_file)
+
+    start_time = datetime.now()
+    try:
+        retention_pass = apply_retention(
+            config.retention_options,
+            config.output_levels,
+            [x.image_destination for x in config.capture_targets],
+            snapshot_index=snapshot_index,
+            full=args.full,
+            dry_run=args.dry_run
+        )
+    finally:
+        if snapshot_index is not None:
+            snapshot_index.close()
+
+    print("{}{} (took {})".format(
+        "Dry run: " if args.dry_run else "",
+        retention_pass.summary(),
+        datetime.now() - start_time
+    ))
+
+    return True
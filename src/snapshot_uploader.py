@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import quote, unquote
+
+from file_utils import write_file_atomically
+from snapper_metrics import span
+from startup_profile import lazy_import
+
+grpc = lazy_import("grpc")
+
+# A snapshot waiting to be uploaded. data_file is the spool's own copy of the image, so the upload isn't affected by
+# anything happening to the original. next_attempt is the time.time() it can next be tried
+SpoolEntry = namedtuple("SpoolEntry", "entry_id data_file remote_name size attempts next_attempt")
+
+# Upload settings. spool_max_mb caps the disk used by snapshots waiting to be uploaded, retry_min/retry_max bound the
+# backoff between failed attempts and drain_timeout is how long a closing snapper waits for uploads in progress (all in
+# seconds)
+UploadOptions = namedtuple(
+    "UploadOptions",
+    "spool_max_mb chunk_size_kb timeout retry_min retry_max drain_timeout method_name",
+    defaults=(1024, 64, 120, 10, 3600, 30, "UploadSnapshot")
+)
+
+
+# Snapshots waiting to be uploaded, kept on disk so they survive restarts. Each entry is an image (hard linked from
+# the original where possible, so it costs no extra space until the original is deleted) plus a small JSON file with
+# its upload state. The total size is capped, the oldest entries are dropped to make room for new ones
+class UploadSpool(object):
+    DATA_EXTENSION = ".data"
+    STATE_EXTENSION = ".json"
+    REMOTE_NAME_KEY = "remote_name"
+    ATTEMPTS_KEY = "attempts"
+    NEXT_ATTEMPT_KEY = "next_attempt"
+
+    def __init__(self, spool_path, max_bytes):
+        self.spool_path = spool_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        if not os.path.exists(spool_path):
+            os.makedirs(spool_path, exist_ok=True)
+
+    def _state_file(self, entry_id):
+        return os.path.join(self.spool_path, entry_id + UploadSpool.STATE_EXTENSION)
+
+    def _data_file(self, entry_id):
+        return os.path.join(self.spool_path, entry_id + UploadSpool.DATA_EXTENSION)
+
+    def _write_state(self, entry_id, remote_name, attempts, next_attempt):
+        write_file_atomically(self._state_file(entry_id), json.dumps({
+            UploadSpool.REMOTE_NAME_KEY: remote_name,
+            UploadSpool.ATTEMPTS_KEY: attempts,
+            UploadSpool.NEXT_ATTEMPT_KEY: next_attempt
+        }))
+
+    def _read_entries(self):
+        # Oldest first. Anything left half written by a power cut (data without state or the other way round) is
+        # cleaned up
+        file_names = set(os.listdir(self.spool_path))
+        entries = []
+        for file_name in sorted(file_names):
+            entry_id, extension = os.path.splitext(file_name)
+            if extension != UploadSpool.STATE_EXTENSION:
+                if (
+                    (extension == UploadSpool.DATA_EXTENSION) and
+                    ((entry_id + UploadSpool.STATE_EXTENSION) not in file_names)
+                ):
+                    self._remove_files(entry_id)
+                continue
+
+            try:
+                with open(self._state_file(entry_id)) as json_file:
+                    state = json.load(json_file)
+                size = os.path.getsize(self._data_file(entry_id))
+            except (FileNotFoundError, ValueError):
+                self._remove_files(entry_id)
+                continue
+
+            entries.append(SpoolEntry(
+                entry_id=entry_id,
+                data_file=self._data_file(entry_id),
+                remote_name=state[UploadSpool.REMOTE_NAME_KEY],
+                size=size,
+                attempts=state.get(UploadSpool.ATTEMPTS_KEY, 0),
+                next_attempt=state.get(UploadSpool.NEXT_ATTEMPT_KEY, 0)
+            ))
+
+        return entries
+
+    def _remove_files(self, entry_id):
+        for file_name in (self._state_file(entry_id), self._data_file(entry_id)):
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+
+    def add(self, image_path, remote_name):
+        # Returns False if the image couldn't be added (it is bigger than the whole spool, or couldn't be read)
+        try:
+            size = os.path.getsize(image_path)
+        except FileNotFoundError:
+            return False
+
+        if size > self.max_bytes:
+            print("Not uploading {}, it is larger than the upload spool".format(image_path))
+            return False
+
+        with self._lock:
+            entries = self._read_entries()
+            spool_bytes = sum(x.size for x in entries)
+            while entries and ((spool_bytes + size) > self.max_bytes):
+                dropped_entry = entries.pop(0)
+                print("Upload spool full, dropping {}".format(dropped_entry.remote_name))
+                self._remove_files(dropped_entry.entry_id)
+                spool_bytes -= dropped_entry.size
+
+            entry_id = "{:020d}".format(time.time_ns())
+            try:
+                os.link(image_path, self._data_file(entry_id))
+            except OSError:
+                # Different file system (or one without hard links), fall back to a copy
+                shutil.copyfile(image_path, self._data_file(entry_id))
+            self._write_state(entry_id, remote_name, 0, 0)
+
+        return True
+
+    def entries(self):
+        with self._lock:
+            return self._read_entries()
+
+    def remove(self, entry):
+        with self._lock:
+            self._remove_files(entry.entry_id)
+
+    def retry_later(self, entry, next_attempt):
+        with self._lock:
+            if os.path.exists(entry.data_file):
+                self._write_state(entry.entry_id, entry.remote_name, entry.attempts + 1, next_attempt)
+
+
+# Streams an image to the controller in chunks. The name, size and SHA-256 of the image go in the call metadata so the
+# receiving end can check it got everything. Metadata values have to be ASCII, so the name is sent percent-encoded
+# (see encode_name/decode_name)
+class GrpcUploadTransport(object):
+    DEFAULT_METHOD_NAME = "UploadSnapshot"
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+    DEFAULT_TIMEOUT = 120
+    NAME_METADATA_KEY = "snapshot-name"
+    SIZE_METADATA_KEY = "snapshot-size"
+    SHA256_METADATA_KEY = "snapshot-sha256"
+
+    def __init__(self, controller_client, method_name=DEFAULT_METHOD_NAME, chunk_size=DEFAULT_CHUNK_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        self.controller_client = controller_client
+        self.method_name = method_name
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+    @staticmethod
+    def encode_name(remote_name):
+        return quote(remote_name, safe="/")
+
+    @staticmethod
+    def decode_name(encoded_name):
+        return unquote(encoded_name)
+
+    def _read_chunks(self, data_file):
+        with open(data_file, "rb") as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if len(chunk) == 0:
+                    return
+                yield chunk
+
+    def upload(self, data_file, remote_name):
+        # Raises grpc.RpcError (or OSError if the spooled file can't be read) if the upload fails
+        sha256 = hashlib.sha256()
+        for chunk in self._read_chunks(data_file):
+            sha256.update(chunk)
+
+        self.controller_client.upload(
+            self.method_name,
+            self._read_chunks(data_file),
+            metadata=[
+                (GrpcUploadTransport.NAME_METADATA_KEY, GrpcUploadTransport.encode_name(remote_name)),
+                (GrpcUploadTransport.SIZE_METADATA_KEY, "{}".format(os.path.getsize(data_file))),
+                (GrpcUploadTransport.SHA256_METADATA_KEY, sha256.hexdigest())
+            ],
+            timeout=self.timeout
+        )
+
+
+# Uploads spooled snapshots on a background thread, oldest first. Snaps only ever add to the spool, so a slow or
+# missing controller never holds up a capture. Failed uploads are retried with exponential backoff (with some jitter so
+# several snappers don't all retry together)
+class SnapshotUploader(object):
+    DEFAULT_RETRY_MIN = 10
+    DEFAULT_RETRY_MAX = 3600
+
+    def __init__(self, spool, transport, retry_min=DEFAULT_RETRY_MIN, retry_max=DEFAULT_RETRY_MAX):
+        self.spool = spool
+        self.transport = transport
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._idle_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snapshot-uploader", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, image_path, remote_name):
+        if self.spool.add(image_path, remote_name):
+            self._idle_event.clear()
+            self._wake_event.set()
+
+    def _retry_delay(self, attempts):
+        delay = min(self.retry_max, self.retry_min * (2 ** attempts))
+        return delay * random.uniform(0.75, 1.0)
+
+    def _upload_due_entries(self):
+        # Returns how long to wait before something else is due (None if the spool is empty)
+        entries = self.spool.entries()
+        if len(entries) == 0:
+            return None
+
+        for entry in entries:
+            if self._stop_event.is_set():
+                return 0
+
+            now = time.time()
+            if entry.next_attempt > now:
+                continue
+
+            try:
+                with span("upload", bytes=entry.size):
+                    self.transport.upload(entry.data_file, entry.remote_name)
+            except (grpc.RpcError, OSError) as e:
+                error = e.code() if isinstance(e, grpc.RpcError) else e
+                print("Could not upload {}: {}".format(entry.remote_name, error))
+                retry_delay = self._retry_delay(entry.attempts)
+                self.spool.retry_later(entry, now + retry_delay)
+
+                # The controller is most likely down, so don't bother trying everything else until this is due again
+                return retry_delay
+            except Exception as e:
+                # Something wrong with this entry rather than the controller, the others can still go
+                print("Could not upload {}: {!r}".format(entry.remote_name, e))
+                self.spool.retry_later(entry, now + self._retry_delay(entry.attempts))
+                continue
+
+            self.spool.remove(entry)
+
+        remaining_entries = self.spool.entries()
+        if len(remaining_entries) == 0:
+            return None
+
+        return max(0, min(x.next_attempt for x in remaining_entries) - time.time())
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake_event.clear()
+            try:
+                wait_time = self._upload_due_entries()
+            except Exception as e:
+                # e.g. the spool can't be read. Keep the thread going, snaps are still being added
+                print("Upload spool error: {!r}".format(e))
+                wait_time = self.retry_min
+            if (wait_time is None) or (wait_time > 0):
+                # Nothing left that can be uploaded right now
+                self._idle_event.set()
+            self._wake_event.wait(wait_time)
+
+    def close(self, drain_timeout=0):
+        # Gives the uploader up to drain_timeout seconds to finish what it is doing (and upload anything already due)
+        # before stopping it. Whatever is left stays in the spool for next time
+        if drain_timeout > 0:
+            self._idle_event.wait(drain_timeout)
+
+        self._stop_event.set()
+        self._wake_event.set()
+        self._thread.join(self.transport.timeout)
@@ -0,0 +1,164 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+
+from pyproto.messages import controller_pb2, controller_pb2_grpc
+from pyproto.messages.sensors_pb2 import SensorModuleStatus
+from pyproto.protomodel.database.grow_database import GrowDatabase
+from pyproto.protomodel.sensors.sensors import SensorData
+from annotation_cache import AnnotationCache
+from controller_client import ControllerClient
+from file_utils import write_file_atomically
+from snapshot_uploader import GrpcUploadTransport
+
+
+# A local stand-in for the grow controller's NetworkController service. Serves a fixed grow database and sensor
+# snapshot so the snapper can be run and tested without a real controller. Doesn't check the auth header
+class StandInNetworkController(controller_pb2_grpc.NetworkControllerServicer):
+    def __init__(self, grow_database, sensor_data, response_delay=0):
+        self.grow_database = grow_database
+        self.sensor_data = sensor_data
+        self.response_delay = response_delay
+        self.request_count = 0
+
+    def GetGrowDatabase(self, request, context):
+        self.request_count += 1
+        time.sleep(self.response_delay)
+
+        response = ControllerClient.response_class("GetGrowDatabase")()
+        if self.grow_database is not None:
+            response.statusCode = GrowDatabase.OperationResponse.ResponseType.OPERATION_OK
+            response.newGrowDatabase.CopyFrom(self.grow_database.to_protobuf())
+
+        return response
+
+    def GetSensorSnapshot(self, request, context):
+        self.request_count += 1
+        time.sleep(self.response_delay)
+
+        response = ControllerClient.response_class("GetSensorSnapshot")()
+        if self.sensor_data is not None:
+            response.moduleStatus = SensorModuleStatus.CONNECTED
+            response.sensorData.extend(sd.to_protobuf() for sd in self.sensor_data.values())
+
+        return response
+
+
+# Receives snapshots streamed by the snapper's uploader (see GrpcUploadTransport) and stores them under
+# upload_directory, using the name they were sent with
+class StandInSnapshotReceiver(object):
+    def __init__(self, upload_directory):
+        self.upload_directory = upload_directory
+        self.received_count = 0
+
+    def upload_snapshot(self, request_iterator, context):
+        metadata = dict(context.invocation_metadata())
+        remote_name = GrpcUploadTransport.decode_name(metadata.get(GrpcUploadTransport.NAME_METADATA_KEY, ""))
+        image_bytes = b"".join(request_iterator)
+
+        if hashlib.sha256(image_bytes).hexdigest() != metadata.get(GrpcUploadTransport.SHA256_METADATA_KEY, None):
+            context.abort(grpc.StatusCode.DATA_LOSS, "Checksum mismatch")
+
+        # Don't let a name with ".." in it write outside the upload directory
+        image_path = os.path.abspath(os.path.join(self.upload_directory, remote_name))
+        if not image_path.startswith(os.path.abspath(self.upload_directory) + os.sep):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid snapshot name")
+
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        write_file_atomically(image_path, image_bytes)
+        self.received_count += 1
+
+        return b""
+
+    def handler(self, method_name=GrpcUploadTransport.DEFAULT_METHOD_NAME):
+        # Raw bytes in and out, same as the uploader sends
+        service = controller_pb2.DESCRIPTOR.services_by_name[ControllerClient.SERVICE_NAME]
+        return grpc.method_handlers_generic_handler(
+            service.full_name,
+            {method_name: grpc.stream_unary_rpc_method_handler(self.upload_snapshot)}
+        )
+
+
+def synthetic_controller_data(grow_system_id, sensor_readings, grow_system_name="Stand-in Chamber"):
+    # Made up data for the grow system and sensor readings (ReadingAnnotationDetails) the snapper is configured with,
+    # so it can be served without ever having talked to a real controller. Built as the controller's own messages and
+    # decoded with the same classes the snapper uses. Returns the grow database and the sensor data keyed by sensor ID
+    grow_database_proto = AnnotationCache.grow_database_class()()
+    grow_system_proto = grow_database_proto.growSystems.add()
+    grow_system_proto.id = grow_system_id
+    grow_system_proto.name = grow_system_name
+
+    sensor_data_protos = {}
+    for count, sensor_reading in enumerate(sensor_readings):
+        sensor_data_proto = sensor_data_protos.get(sensor_reading.sensor_id, None)
+        if sensor_data_proto is None:
+            sensor_data_proto = AnnotationCache.sensor_data_class()(sensorID=sensor_reading.sensor_id)
+            sensor_data_protos[sensor_reading.sensor_id] = sensor_data_proto
+
+        sensor_data_proto.readings.add(name=sensor_reading.reading_id, value=(count * 10.25))
+
+    grow_database = GrowDatabase.from_protobuf(grow_database_proto)
+    sensor_data = {
+        sensor_id: SensorData.from_protobuf(sensor_data_proto)
+        for sensor_id, sensor_data_proto in sensor_data_protos.items()
+    }
+
+    return grow_database, sensor_data
+
+
+def start_stand_in_controller(grow_database, sensor_data, host="localhost", port=0, response_delay=0,
+                              upload_directory=None):
+    # Starts serving in the background. Returns the server, the servicer and the port actually bound (port=0 picks a
+    # free one). Uploaded snapshots are accepted and stored if upload_directory is given
+    servicer = StandInNetworkController(grow_database, sensor_data, response_delay=response_delay)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    controller_pb2_grpc.add_NetworkControllerServicer_to_server(servicer, server)
+    if upload_directory is not None:
+        server.add_generic_rpc_handlers((StandInSnapshotReceiver(upload_directory).handler(),))
+    bound_port = server.add_insecure_port("{}:{}".format(host, port))
+    server.start()
+
+    return server, servicer, bound_port
+
+
+# Serves the data from an existing snapper cache
+def main():
+    parser = argparse.ArgumentParser(description="AutoBloomer stand-in controller")
+    parser.add_argument("-a", "--cache-path", required=True, dest="cache_path",
+                        help="Directory containing the snapper cache to serve")
+    parser.add_argument("-p", "--port", type=int, default=50051, dest="port")
+    parser.add_argument("--host", default="localhost", dest="host")
+    parser.add_argument("--delay", type=float, default=0, dest="response_delay",
+                        help="Seconds to wait before answering each request")
+    parser.add_argument("-u", "--upload-dir", dest="upload_directory",
+                        help="Accept uploaded snapshots and store them in this directory")
+    args = parser.parse_args()
+
+    cached_data = AnnotationCache(args.cache_path).read()
+    if cached_data is None:
+        print("No cached data found in {}".format(args.cache_path))
+        sys.exit()
+
+    server, _, port = start_stand_in_controller(
+        grow_database=cached_data.grow_database,
+        sensor_data=dict(cached_data.sensor_data),
+        host=args.host,
+        port=args.port,
+        response_delay=args.response_delay,
+        upload_directory=args.upload_directory
+    )
+    print("Stand-in controller listening on {}:{}".format(args.host, port))
+
+    try:
+        server.wait_for_termination()
+    except KeyboardInterrupt:
+        server.stop(None)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# The heavy modules (gRPC, protobuf and the pyproto model, PIL, numpy) take seconds to import on the slower boards, so
+# the snapper only imports them when something first uses them rather than when it starts. Modules ask for them with
+# lazy_import instead of an import statement, e.g.
+#   Image = lazy_import("PIL.Image")
+#   GrowDatabase = lazy_import("pyproto.protomodel.database.grow_database", "GrowDatabase")
+# and use the result exactly as they would have used the module (or class). How long each of them took, and which
+# thread ended up importing it, is kept for the --profile-startup report
+
+# A stage of startup, from the end of the stage before it. start is seconds since the process started
+StartupStage = namedtuple("StartupStage", "name start duration")
+
+# A module imported by lazy_import the first time it was used
+DeferredImport = namedtuple("DeferredImport", "module_name start duration thread_name")
+
+
+def _process_age():
+    # Seconds since this process was started (Linux only, to the nearest clock tick), so the report can include the
+    # time it took the interpreter itself to start. None if it can't be worked out
+    try:
+        with open("/proc/self/stat") as f:
+            # Skip past the command name (which can contain spaces), start time is the 22nd field
+            fields = f.read().rsplit(")", 1)[1].split()
+        start_ticks = int(fields[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - (start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+_start_counter = time.perf_counter()
+_start_age = _process_age()
+_records_lock = threading.Lock()
+_stages = []
+_stage_counter = _start_counter
+_deferred_imports = []
+_imported_before_main = None
+_lazy_imports = {}
+
+
+def _since_process_start(counter):
+    return (counter - _start_counter) + (_start_age if _start_age is not None else 0)
+
+
+def _reset_lock():
+    # A fork (e.g. a render worker starting) while another thread held the lock would leave it held for good in the
+    # child
+    global _records_lock
+    _records_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def _import_module(module_name):
+    if module_name in sys.modules:
+        return importlib.import_module(module_name)
+
+    start_counter = time.perf_counter()
+    module = importlib.import_module(module_name)
+    end_counter = time.perf_counter()
+
+    # Two threads can both get here for the same module, the second one just waited for the first. Only the first to
+    # finish actually imported it
+    with _records_lock:
+        if all(x.module_name != module_name for x in _deferred_imports):
+            _deferred_imports.append(DeferredImport(
+                module_name=module_name,
+                start=_since_process_start(start_counter),
+                duration=(end_counter - start_counter),
+                thread_name=threading.current_thread().name
+            ))
+
+    return module
+
+
+# Stands in for a module (or something in it) until it is first used. The import system does its own locking, so
+# several threads can use one at once
+class LazyImport(object):
+    def __init__(self, module_name, attribute_name=None):
+        self._module_name = module_name
+        self._attribute_name = attribute_name
+        self._target = None
+
+    def _resolve(self):
+        target = self._target
+        if target is None:
+            target = _import_module(self._module_name)
+            if self._attribute_name is not None:
+                target = getattr(target, self._attribute_name)
+            self._target = target
+
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+def lazy_import(module_name, attribute_name=None):
+    # Every module asking for the same thing gets the same stand in
+    return _lazy_imports.setdefault((module_name, attribute_name), LazyImport(module_name, attribute_name))
+
+
+def mark_startup_stage(name):
+    # Ends the current stage of startup. The first stage is everything imported before the first call (i.e. at the
+    # top of the entry point), which also notes which of the deferred modules got imported along the way
+    global _stage_counter, _imported_before_main
+    counter = time.perf_counter()
+    with _records_lock:
+        if _imported_before_main is None:
+            _imported_before_main = sorted({
+                module_name for module_name, _ in _lazy_imports if module_name in sys.modules
+            })
+        _stages.append(StartupStage(
+            name=name,
+            start=_since_process_start(_stage_counter),
+            duration=(counter - _stage_counter)
+        ))
+        _stage_counter = counter
+
+
+def print_startup_profile():
+    with _records_lock:
+        stages = list(_stages)
+        deferred_imports = sorted(_deferred_imports, key=lambda x: x.start)
+        imported_before_main = _imported_before_main
+
+    rows = []
+    if _start_age is not None:
+        rows.append(("interpreter start", 0, _start_age))
+    rows.extend((x.name, x.start, x.duration) for x in stages)
+    name_width = max([len("stage")] + [len(x[0]) for x in rows])
+
+    print("Startup profile (seconds since the process started)")
+    print("  {:<{}}  {:>8}  {:>8}".format("stage", name_width, "start", "seconds"))
+    for name, start, duration in rows:
+        print("  {:<{}}  {:>8.3f}  {:>8.3f}".format(name, name_width, start, duration))
+
+    print("Deferred imports (imported when first used, including anything they import)")
+    if len(deferred_imports) == 0:
+        print("  none")
+    else:
+        module_width = max([len("module")] + [len(x.module_name) for x in deferred_imports])
+        print("  {:<{}}  {:>8}  {:>8}  thread".format("module", module_width, "start", "seconds"))
+        for x in deferred_imports:
+            print("  {:<{}}  {:>8.3f}  {:>8.3f}  {}".format(
+                x.module_name,
+                module_width,
+                x.start,
+                x.duration,
+                x.thread_name
+            ))
+
+    # Anything here is slowing down every start, something imports it directly rather than through lazy_import
+    if imported_before_main:
+        print("Imported at startup although they should be deferred: {}".format(", ".join(imported_before_main)))
@@ -0,0 +1,262 @@
+import os
+import subprocess
+from collections import deque
+from concurrent import futures
+
+from snapshot_archive import TIMESTAMP_FORMAT, iter_snapshots, parse_date_argument, parse_end_date_argument
+from startup_profile import lazy_import
+
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+ImageOps = lazy_import("PIL.ImageOps")
+
+
+def decode_frame(image_path, frame_size):
+    # Let the JPEG decoder do most of the downscaling (draft mode decodes at 1/2, 1/4 or 1/8 scale) so we never hold a
+    # full resolution frame, then pad to the exact frame size, keeping the aspect ratio
+    with Image.open(image_path) as image:
+        image.draft("RGB", frame_size)
+        frame = ImageOps.pad(image.convert("RGB"), frame_size, color=(0, 0, 0))
+
+    return frame.tobytes()
+
+
+def ordered_bounded_map(executor, function, items, max_in_flight):
+    # Like executor.map, but never has more than max_in_flight items submitted (or waiting to be consumed) at once, so
+    # memory use doesn't depend on the number of items
+    pending = deque()
+    for item in items:
+        pending.append((item, executor.submit(function, item)))
+        if len(pending) >= max_in_flight:
+            finished_item, finished_future = pending.popleft()
+            yield finished_item, finished_future.result()
+
+    while pending:
+        finished_item, finished_future = pending.popleft()
+        yield finished_item, finished_future.result()
+
+
+# Raises OSError if ffmpeg can't be started (e.g. it isn't installed)
+class FfmpegVideoWriter(object):
+    COMMAND = "ffmpeg"
+
+    def __init__(self, output_file, frame_size, frame_rate, codec="libx264", crf=23):
+        self.output_file = output_file
+        self.frame_size = frame_size
+        self._process = subprocess.Popen([
+            FfmpegVideoWriter.COMMAND,
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-s", "{}x{}".format(frame_size[0], frame_size[1]),
+            "-r", "{}".format(frame_rate),
+            "-i", "-",
+            "-c:v", codec,
+            "-crf", "{}".format(crf),
+            "-pix_fmt", "yuv420p",
+            output_file
+        ], stdin=subprocess.PIPE)
+
+    def add_frame(self, snapshot, frame_bytes):
+        self._process.stdin.write(frame_bytes)
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg has already gone, wait() still collects it
+            pass
+        return self._process.wait() == 0
+
+
+class ImageSequenceWriter(object):
+    FILE_NAME_FORMAT = "frame_{:06d}.jpg"
+
+    def __init__(self, output_directory, frame_size):
+        self.output_directory = output_directory
+        self.frame_size = frame_size
+        self._frame_count = 0
+
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+
+    def add_frame(self, snapshot, frame_bytes):
+        frame = Image.frombytes("RGB", self.frame_size, frame_bytes)
+        frame.save(os.path.join(self.output_directory, ImageSequenceWriter.FILE_NAME_FORMAT.format(self._frame_count)))
+        self._frame_count += 1
+
+    def close(self):
+        return True
+
+
+class ContactSheetWriter(object):
+    FILE_NAME_FORMAT = "{}_{:03d}{}"
+    BACKGROUND_COLOR = (16, 16, 16)
+    LABEL_COLOR = (220, 220, 220)
+
+    # Cells are frame_size, each sheet is columns x rows cells. Only the sheet being filled is kept in memory, a new
+    # sheet file is started whenever one fills up
+    def __init__(self, output_file, frame_size, columns, rows, spacing=4):
+        self.output_file = output_file
+        self.frame_size = frame_size
+        self.columns = columns
+        self.rows = rows
+        self.spacing = spacing
+        self.label_font = ImageFont.load_default()
+
+        self._sheet = None
+        self._cell_count = 0
+        self._sheet_count = 0
+
+    def _new_sheet(self):
+        sheet_width = (self.columns * self.frame_size[0]) + ((self.columns + 1) * self.spacing)
+        sheet_height = (self.rows * self.frame_size[1]) + ((self.rows + 1) * self.spacing)
+        return Image.new("RGB", (sheet_width, sheet_height), ContactSheetWriter.BACKGROUND_COLOR)
+
+    def _save_sheet(self):
+        base_name, extension = os.path.splitext(self.output_file)
+        self._sheet.save(ContactSheetWriter.FILE_NAME_FORMAT.format(base_name, self._sheet_count, extension))
+        self._sheet = None
+        self._cell_count = 0
+        self._sheet_count += 1
+
+    def add_frame(self, snapshot, frame_bytes):
+        if self._sheet is None:
+            self._sheet = self._new_sheet()
+
+        column = self._cell_count % self.columns
+        row = self._cell_count // self.columns
+        cell_x = self.spacing + (column * (self.frame_size[0] + self.spacing))
+        cell_y = self.spacing + (row * (self.frame_size[1] + self.spacing))
+        self._sheet.paste(Image.frombytes("RGB", self.frame_size, frame_bytes), (cell_x, cell_y))
+
+        draw = ImageDraw.Draw(self._sheet)
+        draw.text(
+            xy=((cell_x + 4), (cell_y + 4)),
+            text=snapshot.timestamp.strftime(TIMESTAMP_FORMAT),
+            fill=ContactSheetWriter.LABEL_COLOR,
+            stroke_width=1,
+            stroke_fill=ContactSheetWriter.BACKGROUND_COLOR,
+            font=self.label_font
+        )
+
+        self._cell_count += 1
+        if self._cell_count == (self.columns * self.rows):
+            self._save_sheet()
+
+    def close(self):
+        if self._sheet is not None:
+            self._save_sheet()
+        return True
+
+
+class SnapshotFrameDecoder(object):
+    # Picklable wrapper around decode_frame for the worker pool, skips files that can't be decoded
+    def __init__(self, frame_size):
+        self.frame_size = frame_size
+
+    def __call__(self, snapshot):
+        try:
+            return decode_frame(snapshot.path, self.frame_size)
+        except (OSError, SyntaxError):
+            return None
+
+
+def build_timelapse(snapshots, writer, frame_size, num_workers=None, frame_step=1):
+    # Streams the snapshots (in the order given) through the decoder workers and into the writer, one frame at a time
+    num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+    selected_snapshots = (snapshot for count, snapshot in enumerate(snapshots) if (count % frame_step) == 0)
+
+    num_frames = 0
+    written = False
+    try:
+        with futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            decoded_frames = ordered_bounded_map(
+                executor,
+                SnapshotFrameDecoder(frame_size),
+                selected_snapshots,
+                max_in_flight=(2 * num_workers)
+            )
+            for snapshot, frame_bytes in decoded_frames:
+                if frame_bytes is None:
+                    print("Skipping unreadable snapshot {}".format(snapshot.path))
+                    continue
+
+                writer.add_frame(snapshot, frame_bytes)
+                num_frames += 1
+        written = True
+    except BrokenPipeError:
+        # ffmpeg exited part way through (e.g. a size or codec it can't encode), it says why itself
+        print("Video encoder stopped after {} frames".format(num_frames))
+    finally:
+        # Always closed, so ffmpeg is never left running (or unreaped) whatever went wrong
+        written = writer.close() and written
+
+    if not written:
+        print("Could not write timelapse")
+        return 0
+
+    return num_frames
+
+
+def parse_frame_size(size_string):
+    width, height = size_string.lower().split("x")
+    if (int(width) <= 0) or (int(height) <= 0):
+        raise ValueError("Frame size must be positive: '{}'".format(size_string))
+
+    return int(width), int(height)
+
+
+def parse_positive_int(value_string):
+    value = int(value_string)
+    if value <= 0:
+        raise ValueError("Must be at least 1: '{}'".format(value_string))
+
+    return value
+
+
+def add_timelapse_arguments(parser):
+    parser.add_argument("-o", "--output", required=True, dest="output",
+                        help="Video file, directory (sequence mode) or sheet file name (contact-sheet mode)")
+    parser.add_argument("--mode", choices=["video", "sequence", "contact-sheet"], default="video", dest="mode")
+    parser.add_argument("--source", dest="source", help="Snapshot directory (defaults to the configured destination)")
+    parser.add_argument("--target", dest="target", help="Name of the capture target to use the destination of")
+    parser.add_argument("--start", type=parse_date_argument, dest="start",
+                        help="First date to include, e.g. 2024-05-01 or 2024-05-01T06:00")
+    parser.add_argument("--end", type=parse_end_date_argument, dest="end", help="Last date to include")
+    parser.add_argument("--size", type=parse_frame_size, default=(1920, 1080), dest="frame_size",
+                        help="Frame (or contact sheet cell) size, e.g. 1920x1080")
+    parser.add_argument("--step", type=parse_positive_int, default=1, dest="frame_step",
+                        help="Only use every Nth snapshot")
+    parser.add_argument("--fps", type=float, default=24, dest="frame_rate")
+    parser.add_argument("--workers", type=parse_positive_int, dest="num_workers", help="Number of decoder processes")
+    parser.add_argument("--columns", type=parse_positive_int, default=6, dest="columns", help="Contact sheet columns")
+    parser.add_argument("--rows", type=parse_positive_int, default=6, dest="rows", help="Contact sheet rows")
+
+
+def run_timelapse(args, source_directory):
+    snapshots = iter_snapshots(source_directory, start=args.start, end=args.end)
+
+    if args.mode == "video":
+        try:
+            writer = FfmpegVideoWriter(args.output, args.frame_size, args.frame_rate)
+        except OSError as e:
+            print("Could not start {} (is it installed?): {}".format(FfmpegVideoWriter.COMMAND, e))
+            return False
+    elif args.mode == "sequence":
+        writer = ImageSequenceWriter(args.output, args.frame_size)
+    else:
+        writer = ContactSheetWriter(args.output, args.frame_size, args.columns, args.rows)
+
+    num_frames = build_timelapse(
+        snapshots,
+        writer,
+        args.frame_size,
+        num_workers=args.num_workers,
+        frame_step=args.frame_step
+    )
+    print("Wrote {} frames to {}".format(num_frames, args.output))
+
+    return num_frames > 0